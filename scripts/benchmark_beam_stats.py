@@ -0,0 +1,89 @@
+"""
+Compare the time and the peak of the memory allocated to compute the
+statistics of a beam over the whole image (with ``np.meshgrid()``) and from
+its marginals with ``sirepo_bluesky.utils.get_beam_stats()``.
+
+Usage: python scripts/benchmark_beam_stats.py [--sizes 256 1024 4096] [--dtype float32] [--repeat 3]
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from sirepo_bluesky.utils import get_beam_stats, sigma_to_fwhm
+
+
+def meshgrid_beam_stats(image, x_extent, y_extent):
+    """The previous implementation of ``get_beam_stats()``."""
+    n_y, n_x = image.shape
+    image_sum = image.sum()
+
+    if image.sum() > 0:
+        X, Y = np.meshgrid(np.linspace(*x_extent, n_x), np.linspace(*y_extent, n_y))
+
+        mean_x = np.sum(X * image) / image_sum
+        mean_y = np.sum(Y * image) / image_sum
+
+        sigma_x = np.sqrt(np.sum((X - mean_x) ** 2 * image) / image_sum)
+        sigma_y = np.sqrt(np.sum((Y - mean_y) ** 2 * image) / image_sum)
+
+    else:
+        mean_x, mean_y, sigma_x, sigma_y = np.nan, np.nan, np.nan, np.nan
+
+    return {
+        "shape": (n_y, n_x),
+        "flux": image_sum,
+        "mean": image.mean(),
+        "x": mean_x,
+        "y": mean_y,
+        "fwhm_x": sigma_to_fwhm * sigma_x,
+        "fwhm_y": sigma_to_fwhm * sigma_y,
+    }
+
+
+def measure(func, repeat):
+    """The best time of ``func()``, the peak of the memory allocated by it and its result."""
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start_time)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[256, 1024, 4096], help="sizes of the images")
+    parser.add_argument("--dtype", default="float64", help="data type of the images")
+    parser.add_argument("--repeat", type=int, default=3, help="number of computations for each image")
+    args = parser.parse_args()
+
+    print(f"{'image':>12} {'meshgrid':>9} {'memory':>10} {'marginals':>9} {'memory':>10} {'speedup':>8}")
+    for size in args.sizes:
+        x = np.linspace(-1, 1, size)
+        image = np.exp(-(x[np.newaxis, :] ** 2) / 0.1 - x[:, np.newaxis] ** 2 / 0.05).astype(args.dtype)
+
+        meshgrid_time, meshgrid_memory, expected = measure(
+            lambda: meshgrid_beam_stats(image, [-1, 1], [-1, 1]), args.repeat
+        )
+        marginals_time, marginals_memory, stats = measure(
+            lambda: get_beam_stats(image, [-1, 1], [-1, 1]), args.repeat
+        )
+        for key in ("x", "y", "fwhm_x", "fwhm_y"):
+            if not np.isclose(stats[key], expected[key], rtol=1e-6, atol=1e-12):
+                raise RuntimeError(f"The {key} of the {size}x{size} image differ")
+
+        print(
+            f"{f'{size}x{size}':>12} {meshgrid_time:>8.4f}s {meshgrid_memory / 2**20:>6.1f} MiB"
+            f" {marginals_time:>8.4f}s {marginals_memory / 2**20:>6.2f} MiB"
+            f" {meshgrid_time / marginals_time:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
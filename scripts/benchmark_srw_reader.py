@@ -0,0 +1,55 @@
+"""
+Compare the time to read SRW datafiles with ``srwpy.uti_plot_com.file_load()``
+and with ``sirepo_bluesky.srw_handler.load_srw_file()``.
+
+Usage: python scripts/benchmark_srw_reader.py [--sizes 256 1024 2048] [--repeat 3]
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import srwpy.srwlib as srwlib
+import srwpy.uti_plot_com as srw_io
+
+from sirepo_bluesky.srw_handler import load_srw_file
+
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start_time)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[256, 1024, 2048], help="sizes of the images")
+    parser.add_argument("--repeat", type=int, default=3, help="number of reads of each file")
+    args = parser.parse_args()
+
+    print(f"{'image':>12} {'file size':>10} {'srwpy':>9} {'numpy':>9} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            path = Path(tmp_dir) / f"intensity_{size}.dat"
+            intensity = np.random.default_rng(0).random(size * size, dtype=np.float32) * 1e12
+            mesh = srwlib.SRWLRadMesh(1000, 1000, 1, -1e-3, 1e-3, size, -1e-3, 1e-3, size)
+            srwlib.srwl_uti_save_intens_ascii(intensity, mesh, str(path))
+
+            srw_time, (srw_data, *_) = best_time(lambda: srw_io.file_load(str(path)), args.repeat)
+            numpy_time, (data, *_) = best_time(lambda: load_srw_file(path), args.repeat)
+            if not np.array_equal(np.array(srw_data), data):
+                raise RuntimeError(f"The data of {path} differ")
+
+            file_size = f"{path.stat().st_size / 2**20:.1f} MiB"
+            print(
+                f"{f'{size}x{size}':>12} {file_size:>10} {srw_time:>8.3f}s {numpy_time:>8.3f}s"
+                f" {srw_time / numpy_time:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -9,18 +9,19 @@ del get_versions
 
 class ExternalFileReference(Signal):
     """
-    A pure software Signal that describe()s an image in an external file.
+    A pure software Signal that describe()s an image (or another ``dtype``) in an external file.
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, dtype="array", **kwargs):
         super().__init__(*args, **kwargs)
+        self._dtype = dtype
 
     def describe(self):
         resource_document_data = super().describe()
         resource_document_data[self.name].update(
             dict(
                 external="FILESTORE:",
-                dtype="array",
+                dtype=self._dtype,
             )
         )
         return resource_document_data
@@ -0,0 +1,299 @@
+import asyncio
+import hashlib
+import os
+import time
+
+import httpx
+
+from .sirepo_bluesky import DATAFILE_CHUNK_SIZE, RETRY_STATUS_CODES, SimulationResult, SirepoBlueskyBase, logger
+
+
+class AsyncSirepoBluesky(SirepoBlueskyBase):
+    """
+    Asyncio counterpart of :class:`~sirepo_bluesky.sirepo_bluesky.SirepoBluesky`.
+
+    All methods talking to the server are coroutines, so a single event loop
+    can drive many simulations (and their status polls) concurrently.
+    The client (and its copies) must be used from a single event loop.
+
+    Parameters
+    ----------
+    server: str
+        Sirepo server to call, ex. 'http://locahost:8000'
+    secret: str, optional
+        The secret key used to authenticate with the server.
+    session: httpx.AsyncClient, optional
+        An existing client to reuse. Copies of a simulation created with
+        ``copy_sim()`` share the client (and its connection pool) of the original.
+    pool_size: int, optional
+        Maximum number of keep-alive connections kept open to the server.
+    max_retries: int, optional
+        Number of times an idempotent request is re-sent when the connection
+        fails or the server responds with a transient error (502, 503, 504).
+    backoff_factor: float, optional
+        Retries are delayed by ``backoff_factor * 2 ** (retry_number - 1)`` seconds.
+    compute_cache: sirepo_bluesky.cache.ComputeCache, optional
+        A cache of the responses to the stateless-compute requests.
+    force_run: bool, optional
+        If True (default), a report is recomputed by the server when its
+        simulation is run after modifications of the models.
+    cancel_timeout: float, optional
+        The maximum time in seconds to wait for the server to acknowledge the
+        cancellation of a simulation (see ``cancel_simulations()``). Default is 5.
+
+    The cache of the results of the simulations (``cache``), the reuse of the
+    results of the clean reports (``skip_clean_runs``) and the deferred
+    computations (``defer_compute``) of ``SirepoBluesky`` are not supported.
+
+    Examples
+    --------
+    async def run(sim_ids):
+        async with AsyncSirepoBluesky('http://localhost:8000') as sb:
+            await sb.auth('srw', sim_ids[0])
+            copies = [await sb.copy_sim(f'copy {i}') for i in range(10)]
+            for copy in copies:
+                copy.data['report'] = 'intensityReport'
+            results = await asyncio.gather(*[copy.run_simulation() for copy in copies])
+            ...
+
+    asyncio.run(run(['1tNWph0M']))
+    """
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    async def aclose(self):
+        """Close the HTTP client (shared with the copies of this simulation)."""
+        if self._session is not None:
+            await self._session.aclose()
+
+    def _make_session(self):
+        return httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            # httpx only retries failed connection attempts.
+            transport=httpx.AsyncHTTPTransport(retries=self.max_retries),
+            timeout=None,
+        )
+
+    async def auth(self, sim_type, sim_id):
+        """Connect to the server and returns the data for the simulation identified by sim_id."""
+        self.cookies = None
+        res = await self._post_json("auth-bluesky-login", self._auth_request(sim_type, sim_id))
+        return self._update_from_auth(sim_type, sim_id, res)
+
+    async def copy_sim(self, sim_name):
+        """Create a copy of the current simulation. Returns a new instance of AsyncSirepoBluesky."""
+        res = await self._post_json("copy-simulation", self._copy_sim_request(sim_name))
+        return self._make_copy(res)
+
+    async def delete_copy(self):
+        """Delete a simulation which was created using copy_sim()."""
+        res = await self._post_json("delete-simulation", self._delete_copy_request())
+        self._update_from_delete_copy(res)
+
+    async def compute_crl_characteristics(self, crl_element):
+        return await self._stateless_compute(self._crl_characteristics_request(crl_element))
+
+    async def compute_crystal_init(self, crystal_element):
+        return await self._stateless_compute(self._crystal_init_request(crystal_element))
+
+    async def compute_crystal_orientation(self, crystal_element):
+        res_init = await self.compute_crystal_init(crystal_element)
+        return await self._stateless_compute(self._crystal_orientation_request(res_init))
+
+    async def compute_grazing_orientation(self, optical_element):
+        return await self._stateless_compute(self._grazing_orientation_request(optical_element))
+
+    async def _stateless_compute(self, request):
+        if self.compute_cache is None:
+            return await self._post_json("stateless-compute", request)
+        key = self.compute_cache.key(self.sim_type, request)
+        res = self.compute_cache.get(key)
+        if res is None:
+            res = await self._post_json("stateless-compute", request)
+            if self._is_cacheable_compute(res):
+                self.compute_cache.put(key, res)
+        return res
+
+    async def get_datafile(self, file_index=-1, report=None):
+        """Request the raw datafile of simulation results from the server.
+
+        The datafile of ``report`` is requested if specified, otherwise of ``data["report"]``.
+
+        Notes
+        -----
+        Call auth() and run_simulation() before this.
+        """
+        response = await self._request("GET", self._datafile_url(file_index, report))
+        return response.content
+
+    async def download_datafile(self, path, file_index=-1, chunk_size=DATAFILE_CHUNK_SIZE, hash_name=None):
+        """Stream the raw datafile of simulation results from the server to a file.
+
+        See ``SirepoBluesky.download_datafile()`` for the description of the
+        parameters and of the returned values.
+        """
+        h = hashlib.new(hash_name) if hash_name else None
+        part_path = f"{path}.part"
+        response = await self._request("GET", self._datafile_url(file_index), stream=True)
+        try:
+            with open(part_path, "wb") as f:
+                async for chunk in response.aiter_bytes(chunk_size=chunk_size):
+                    f.write(chunk)
+                    if h is not None:
+                        h.update(chunk)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        finally:
+            await response.aclose()
+        os.replace(part_path, path)
+        return path, (h.hexdigest() if h is not None else None)
+
+    async def run_and_download(self, path=None, file_index=-1, hash_name=None, max_status_calls=1000):
+        """Run the simulation and download its datafile.
+
+        See ``SirepoBluesky.run_and_download()`` for the description of the
+        parameters. The returned ``SimulationResult`` has no ``timings``.
+        """
+        self._check_runnable()
+        status, duration = await self.run_simulation(max_status_calls=max_status_calls)
+        if path is None:
+            content = await self.get_datafile(file_index=file_index)
+            hexdigest = hashlib.new(hash_name, content).hexdigest() if hash_name else None
+        else:
+            content = None
+            path, hexdigest = await self.download_datafile(path, file_index=file_index, hash_name=hash_name)
+        return SimulationResult(status, duration, path, content, hexdigest, False)
+
+    async def run_reports(self, reports, file_index=-1, hash_name=None, max_status_calls=1000):
+        """Run several reports of the simulation concurrently and download their datafiles.
+
+        Each report is run with a snapshot of the current ``data``, see
+        ``SirepoBluesky.run_reports()`` for the description of the parameters.
+
+        Returns
+        -------
+        dict
+            The ``SimulationResult`` of each report, with the ``content`` of its datafile.
+        """
+        snapshots = {}
+        for report in dict.fromkeys(reports):
+            snapshots[report] = self.snapshot()
+            snapshots[report].data["report"] = report
+        results = await asyncio.gather(
+            *[
+                snapshot.run_and_download(
+                    file_index=file_index, hash_name=hash_name, max_status_calls=max_status_calls
+                )
+                for snapshot in snapshots.values()
+            ]
+        )
+        return dict(zip(snapshots, results))
+
+    async def process_beam_parameters(self):
+        return await self._stateless_compute(self._beam_parameters_request())
+
+    async def process_undulator_definition(self):
+        return await self._stateless_compute(self._undulator_definition_request())
+
+    async def simulation_list(self):
+        """Returns a list of simulations for the authenticated user."""
+        return await self._post_json("simulation-list", dict(simulationType=self.sim_type))
+
+    async def run_simulation(self, max_status_calls=1000):
+        """Run the sirepo simulation and returns the formatted plot data.
+
+        If the task running the simulation is cancelled (e.g. by
+        ``cancel_simulations()``), the simulation is also cancelled on the server.
+
+        Parameters
+        ----------
+        max_status_calls: int, optional
+            Maximum calls to check a running simulation's status. Roughly in seconds.
+            Default is 1000.
+
+        """
+        start_time = time.monotonic()
+        request = self._run_simulation_request()
+        run = self._pending_run()
+        res = await self._post_json("run-simulation", request)
+        job = {"report": self.data["report"], "task": asyncio.current_task(), "request": None}
+        if not self._is_finished(res):
+            job["request"] = res["nextRequest"]
+            with self._jobs_lock:
+                self._active_jobs[id(job)] = job
+        try:
+            for _ in range(max_status_calls):
+                if self._is_finished(res):
+                    break
+                await asyncio.sleep(res["nextRequestSeconds"])
+                res = await self._post_json("run-status", res["nextRequest"])
+        except asyncio.CancelledError:
+            if job["request"] is not None:
+                await self._cancel_job(job, self.cancel_timeout)
+            raise
+        finally:
+            self._end_job(job)
+        self._assert_completed(res)
+        self._record_run(run)
+        return res, time.monotonic() - start_time
+
+    async def cancel_simulations(self, report=None, timeout=None):
+        """Cancel the running simulations started by the client (and its snapshots) on the server.
+
+        The tasks running the simulations are cancelled, which sends the cancel
+        requests. See ``SirepoBluesky.cancel_simulations()`` for the description
+        of the parameters and of the returned value.
+        """
+        timeout = self.cancel_timeout if timeout is None else timeout
+        with self._jobs_lock:
+            jobs = [job for job in self._active_jobs.values() if report is None or job["report"] == report]
+        tasks = {job["task"] for job in jobs} - {asyncio.current_task()}
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+        return [job["report"] for job in jobs]
+
+    async def _cancel_job(self, job, timeout):
+        try:
+            await asyncio.wait_for(self._post_json("run-cancel", job["request"]), timeout)
+        except Exception:
+            logger.warning(f"Failed to cancel the simulation of {job['report']}", exc_info=True)
+
+    async def _request(self, method, url, stream=False, **kwargs):
+        """Send a request to the server, retrying transient failures of idempotent endpoints.
+
+        The body of the response is not read if ``stream`` is True, the caller
+        must close the response.
+        """
+        attempts = self._attempts(url)
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            # The cookies are kept by the (shared) client after the first response.
+            request = self.session.build_request(method, f"{self.server}/{url}", **kwargs)
+            try:
+                response = await self.session.send(request, stream=stream)
+            except httpx.TransportError:
+                if last_attempt:
+                    raise
+            else:
+                if last_attempt or response.status_code not in RETRY_STATUS_CODES:
+                    break
+                await response.aclose()
+            await asyncio.sleep(self.backoff_factor * 2**attempt)
+        if response.status_code != httpx.codes.OK:
+            await response.aclose()
+        self._assert_success(response, url)
+        return response
+
+    async def _post_json(self, url, payload):
+        response = await self._request("POST", url, json=payload)
+        if not self.cookies:
+            self.cookies = response.cookies
+        return response.json()
@@ -0,0 +1,424 @@
+import contextlib
+import copy
+import hashlib
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+# Fields of the "simulation" model which identify a simulation but don't affect its results
+# (e.g. they differ between the copies of a simulation).
+SIMULATION_METADATA_FIELDS = (
+    "folder",
+    "isExample",
+    "lastModified",
+    "name",
+    "outOfSessionSimulationId",
+    "simulationId",
+    "simulationSerial",
+)
+
+
+# Fields of the stateless-compute requests which don't affect the response.
+COMPUTE_METADATA_FIELDS = ("simulationId",)
+
+
+def canonical_hash(obj):
+    """Return the sha256 hex digest of the canonical JSON representation of ``obj``."""
+    payload = json.dumps(obj, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class SimulationCache:
+    """
+    On-disk cache of simulation results, addressed by the content of the simulation.
+
+    Each entry holds the final run status and the downloaded datafile of one
+    report of a simulation. It is keyed by a canonical hash of the simulation
+    type, the models, the report and the index of the datafile (see ``key()``).
+    The least recently used entries are evicted once the total size of the
+    cache exceeds ``max_bytes``.
+
+    Parameters
+    ----------
+    cache_dir : str or pathlib.Path
+        The directory to store the cached results in. Existing entries are reused.
+    max_bytes : int, optional
+        The size budget of the cache in bytes. Default is 10 GiB.
+
+    Examples
+    --------
+    cache = SimulationCache('/tmp/sirepo-bluesky-cache', max_bytes=2 * 1024**3)
+    connection = SirepoBluesky('http://localhost:8000', cache=cache)
+    """
+
+    def __init__(self, cache_dir, max_bytes=10 * 1024**3):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._entries = OrderedDict()  # key -> size in bytes, least recently used first
+
+        entries = []
+        for status_file in self.cache_dir.glob("*.json"):
+            datafile = status_file.with_suffix(".dat")
+            if datafile.exists():
+                size = status_file.stat().st_size + datafile.stat().st_size
+                entries.append((datafile.stat().st_mtime, status_file.stem, size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @staticmethod
+    def key(sim_type, data, file_index=-1):
+        """The cache key of the datafile ``file_index`` of the report ``data["report"]``."""
+        models = dict(data["models"])
+        if "simulation" in models:
+            models["simulation"] = {
+                k: v for k, v in models["simulation"].items() if k not in SIMULATION_METADATA_FIELDS
+            }
+        return canonical_hash([sim_type, models, data["report"], file_index])
+
+    @property
+    def size(self):
+        """The total size of the cached entries in bytes."""
+        with self._lock:
+            return sum(self._entries.values())
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self),
+            "size": self.size,
+        }
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """Hold the lock of a key, so that concurrent identical requests are computed only once.
+
+        An entry is never evicted while its key is locked.
+        """
+        with self._lock:
+            lock, count = self._key_locks.get(key, (threading.Lock(), 0))
+            self._key_locks[key] = (lock, count + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._lock:
+                lock, count = self._key_locks.pop(key)
+                if count > 1:
+                    self._key_locks[key] = (lock, count - 1)
+
+    def get(self, key):
+        """Return the cached ``(status, datafile path)`` of the key, or None if not cached."""
+        status_file, datafile = self._paths(key)
+        with self._lock:
+            try:
+                with open(status_file) as f:
+                    status = json.load(f)
+                os.utime(datafile)
+            except (FileNotFoundError, json.JSONDecodeError):
+                # Not cached, or evicted by another process sharing the cache directory.
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries[key] = status_file.stat().st_size + datafile.stat().st_size
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return status, datafile
+
+    def put(self, key, status, datafile):
+        """Add an entry to the cache.
+
+        Parameters
+        ----------
+        key : str
+            The key returned by ``key()``.
+        status : dict
+            The final status of the simulation run.
+        datafile : bytes or str or pathlib.Path
+            The content of the datafile or the path to a file to copy it from.
+        """
+        status_file, cached_datafile = self._paths(key)
+        part_file = cached_datafile.with_suffix(f".{threading.get_ident()}.part")
+        if isinstance(datafile, bytes):
+            part_file.write_bytes(datafile)
+        else:
+            with open(datafile, "rb") as src, open(part_file, "wb") as dst:
+                while chunk := src.read(1024 * 1024):
+                    dst.write(chunk)
+        os.replace(part_file, cached_datafile)
+        with open(status_file, "w") as f:
+            json.dump(status, f)
+        with self._lock:
+            self._entries[key] = status_file.stat().st_size + cached_datafile.stat().st_size
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def clear(self):
+        """Remove all the (unlocked) entries from the cache."""
+        with self._lock:
+            for key in list(self._entries):
+                if key not in self._key_locks:
+                    self._remove(key)
+
+    def _paths(self, key):
+        return self.cache_dir / f"{key}.json", self.cache_dir / f"{key}.dat"
+
+    def _remove(self, key):
+        del self._entries[key]
+        for path in self._paths(key):
+            with contextlib.suppress(FileNotFoundError):
+                path.unlink()
+
+    def _evict(self):
+        size = sum(self._entries.values())
+        for key in list(self._entries):
+            if size <= self.max_bytes:
+                break
+            if key in self._key_locks:
+                continue
+            size -= self._entries[key]
+            self._remove(key)
+            self.evictions += 1
+
+
+class ComputeCache:
+    """
+    In-memory LRU cache of the responses to stateless-compute requests.
+
+    The CRL, crystal and grazing angle characteristics, as well as the beam
+    parameters and the undulator definition, only depend on the parameters
+    sent with the request (the optical element, the photon energy, ...), so
+    the responses can be reused when a scan revisits the same values.
+
+    Parameters
+    ----------
+    max_entries : int, optional
+        The maximum number of responses kept in memory. Default is 1024.
+    cache_dir : str or pathlib.Path, optional
+        If given, the responses are also stored in this directory and are
+        reused by the caches of later sessions.
+
+    Examples
+    --------
+    compute_cache = ComputeCache(cache_dir='/tmp/sirepo-bluesky-compute-cache')
+    connection = SirepoBluesky('http://localhost:8000', compute_cache=compute_cache)
+    """
+
+    def __init__(self, max_entries=1024, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> response, least recently used first
+
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            entries = sorted(self.cache_dir.glob("*.json"), key=lambda path: path.stat().st_mtime)
+            for path in entries[-max_entries:]:
+                try:
+                    with open(path) as f:
+                        self._entries[path.stem] = json.load(f)
+                except json.JSONDecodeError:
+                    continue
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @staticmethod
+    def key(sim_type, request):
+        """The cache key of a stateless-compute request."""
+        params = {k: v for k, v in request.items() if k not in COMPUTE_METADATA_FIELDS}
+        params["simulationType"] = sim_type
+        return canonical_hash(params)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self),
+        }
+
+    def get(self, key):
+        """Return a copy of the cached response of the key, or None if not cached."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            # The callers modify the responses (e.g. pop the "state").
+            return copy.deepcopy(self._entries[key])
+
+    def put(self, key, response):
+        """Add a response to the cache."""
+        response = copy.deepcopy(response)
+        if self.cache_dir is not None:
+            path = self.cache_dir / f"{key}.json"
+            part_file = path.with_suffix(f".{threading.get_ident()}.part")
+            with open(part_file, "w") as f:
+                json.dump(response, f)
+            os.replace(part_file, path)
+        with self._lock:
+            self._entries[key] = response
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                self.evictions += 1
+                if self.cache_dir is not None:
+                    with contextlib.suppress(FileNotFoundError):
+                        (self.cache_dir / f"{evicted}.json").unlink()
+
+    def clear(self):
+        """Remove all the entries from the cache."""
+        with self._lock:
+            keys = list(self._entries)
+            self._entries.clear()
+        if self.cache_dir is not None:
+            for key in keys:
+                with contextlib.suppress(FileNotFoundError):
+                    (self.cache_dir / f"{key}.json").unlink()
+
+
+class HandlerCache:
+    """
+    In-memory LRU cache of the data read from the datafiles by the handlers.
+
+    The entries are keyed by the kind of data, the path, the modification time
+    and size of the datafile and the keyword arguments of the read (see
+    ``key()``), so a modified datafile is read again. The least recently used
+    entries are evicted once the total size of the cached data exceeds
+    ``max_bytes``. The cached arrays are read-only, as they are shared by all
+    the handlers of the process.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        The size budget of the cache in bytes. Default is 1 GiB; 0 disables the cache.
+
+    Examples
+    --------
+    from sirepo_bluesky.cache import HANDLER_CACHE
+    HANDLER_CACHE.max_bytes = 4 * 1024**3
+    hdr.table(fill=True)
+    HANDLER_CACHE.stats()
+    """
+
+    def __init__(self, max_bytes=1024**3):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (data, size in bytes), least recently used first
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @staticmethod
+    def key(kind, filename, **kwargs):
+        """The cache key of the data of ``kind`` (e.g. "srw") read from ``filename`` with ``kwargs``."""
+        stat = os.stat(filename)
+        return (kind, os.path.abspath(filename), stat.st_mtime_ns, stat.st_size, tuple(sorted(kwargs.items())))
+
+    @property
+    def size(self):
+        """The total size of the cached data in bytes."""
+        with self._lock:
+            return sum(size for _, size in self._entries.values())
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self),
+            "size": self.size,
+        }
+
+    def get(self, key):
+        """Return the cached data of the key, or None if not cached."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+
+    def put(self, key, data):
+        """Add data to the cache, unless it is larger than ``max_bytes``. Returns the (read-only) cached data."""
+        if isinstance(data, np.ndarray):
+            data.flags.writeable = False
+        size = _nbytes(data)
+        with self._lock:
+            if size > self.max_bytes:
+                return data
+            self._entries[key] = (data, size)
+            self._entries.move_to_end(key)
+            self._evict()
+        return data
+
+    def load(self, kind, filename, read, **kwargs):
+        """Return the cached data of a datafile, calling ``read()`` to read it if it is not cached."""
+        key = self.key(kind, filename, **kwargs)
+        data = self.get(key)
+        if data is None:
+            data = self.put(key, read())
+        return data
+
+    def clear(self):
+        """Remove all the entries from the cache."""
+        with self._lock:
+            self._entries.clear()
+
+    def _evict(self):
+        size = sum(size for _, size in self._entries.values())
+        while size > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            size -= evicted_size
+            self.evictions += 1
+
+
+def _nbytes(data):
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    if hasattr(data, "memory_usage"):  # pandas.DataFrame
+        return int(data.memory_usage(deep=True).sum())
+    return sys.getsizeof(data)
+
+
+# The cache shared by the handlers of the datafiles of the process:
+HANDLER_CACHE = HandlerCache()
@@ -0,0 +1,107 @@
+import threading
+
+import h5py
+import numpy as np
+
+# The datasets of the HDF5 containers of the images of the watchpoints:
+FRAMES_DATASET = "frames"
+SHAPES_DATASET = "shapes"
+
+
+class HDF5FrameWriter:
+    """
+    Write the images of the triggers of a device to a single HDF5 file.
+
+    The images are stored in the chunked, compressed dataset "frames", one
+    frame per trigger indexed by its position in the run. The images of a run
+    may have different shapes (e.g. when the resolution of a simulation is
+    scanned): the frames are padded to the largest shape and the shape of each
+    image is stored in the dataset "shapes".
+
+    Parameters
+    ----------
+    filename : str or pathlib.Path
+        The HDF5 file to create.
+    dtype : str or numpy.dtype, optional
+        The data type of the stored frames, e.g. "float32" to halve their size.
+    compression : str, optional
+        The compression filter of the frames (see ``h5py.Group.create_dataset()``).
+    """
+
+    def __init__(self, filename, dtype="float64", compression="gzip"):
+        self._name = str(filename)
+        self._dtype = np.dtype(dtype)
+        self._compression = compression
+        self._lock = threading.Lock()
+        self._file = h5py.File(self._name, "w")
+
+    def write_frame(self, index, frame):
+        """Write the image ``frame`` as the frame ``index``."""
+        frame = np.asarray(frame)
+        with self._lock:
+            if FRAMES_DATASET not in self._file:
+                self._create_datasets(frame)
+            frames = self._file[FRAMES_DATASET]
+            shapes = self._file[SHAPES_DATASET]
+            if frame.ndim != shapes.shape[1]:
+                raise ValueError(
+                    f"Frames of {shapes.shape[1]} dimensions expected, got a frame of shape {frame.shape}"
+                )
+            new_shape = (max(frames.shape[0], index + 1), *np.maximum(frames.shape[1:], frame.shape))
+            if new_shape != frames.shape:
+                frames.resize(new_shape)
+                shapes.resize(new_shape[0], axis=0)
+            frames[(index, *(slice(0, n) for n in frame.shape))] = frame
+            shapes[index] = frame.shape
+
+    def _create_datasets(self, frame):
+        self._file.create_dataset(
+            FRAMES_DATASET,
+            shape=(0, *frame.shape),
+            maxshape=(None,) * (frame.ndim + 1),
+            chunks=(1, *frame.shape),
+            dtype=self._dtype,
+            compression=self._compression,
+            shuffle=self._compression is not None,
+        )
+        self._file.create_dataset(SHAPES_DATASET, shape=(0, frame.ndim), maxshape=(None, frame.ndim), dtype="i8")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class SirepoHDF5Handler:
+    """
+    Read the images written by ``HDF5FrameWriter``.
+
+    The file is opened at the first read and kept open, so reading the frames
+    of the datums of a resource doesn't reopen it.
+    """
+
+    specs = {"SIREPO_HDF5"}
+
+    def __init__(self, filename):
+        self._name = filename
+        self._file = None
+
+    def _datasets(self):
+        if self._file is None:
+            self._file = h5py.File(self._name, "r")
+        return self._file[FRAMES_DATASET], self._file[SHAPES_DATASET]
+
+    def __call__(self, point_number):
+        frames, shapes = self._datasets()
+        shape = shapes[point_number]
+        return frames[(point_number, *(slice(0, n) for n in shape))]
+
+    def get_frames(self, start=None, stop=None):
+        """Read the frames from ``start`` to ``stop`` at once, as an array cropped to their largest shape."""
+        frames, shapes = self._datasets()
+        shape = np.max(shapes[start:stop], axis=0, initial=0)
+        return frames[(slice(start, stop), *(slice(0, n) for n in shape))]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,11 @@
+class SirepoDataJSONHandler:
+    """Read the JSON document of the data of a simulation recorded by the Sirepo devices."""
+
+    specs = {"SIREPO_DATA_JSON"}
+
+    def __init__(self, filename):
+        self._name = filename
+
+    def __call__(self):
+        with open(self._name) as f:
+            return f.read()
@@ -33,8 +33,6 @@ class MADXFlyer(BlueskyFlyer):
     def kickoff(self):
         self.connection.data["report"] = self.report
         self.connection.data["forceRun"] = True
-        res, elapsed_time = self.connection.run_simulation()
-        datafile = self.connection.get_datafile(file_index=0)
 
         date = datetime.datetime.now()
         self._assets_dir = date.strftime("%Y/%m/%d")
@@ -55,8 +53,7 @@ class MADXFlyer(BlueskyFlyer):
             Path(self._resource_document["root"]) / Path(self._resource_document["resource_path"])
         )
 
-        with open(sim_result_file, "wb") as file:
-            file.write(datafile)
+        self.connection.run_and_download(sim_result_file, file_index=0)
 
         # Store the dataframe from raw madx datafile
         self._dataframe = read_madx_file(sim_result_file)
@@ -1,6 +1,8 @@
 import tfs
 from area_detector_handlers import HandlerBase
 
+from .cache import HANDLER_CACHE
+
 
 def read_madx_file(filename):
     df = tfs.read(filename)
@@ -8,9 +10,11 @@ def read_madx_file(filename):
 
 
 class MADXFileHandler(HandlerBase):
+    """Read the values of a TFS file, which is kept in ``sirepo_bluesky.cache.HANDLER_CACHE``."""
+
     def __init__(self, filename):
         self._filename = filename
-        self._dataframe = read_madx_file(self._filename)
+        self._dataframe = HANDLER_CACHE.load("madx", self._filename, lambda: read_madx_file(self._filename))
 
     def __call__(self, row_num=0, col_name="NAME"):
         return self._dataframe[col_name][row_num]
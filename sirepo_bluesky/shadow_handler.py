@@ -1,11 +1,12 @@
 import contextlib
 import os
+import time
 
 import numpy as np
-import Shadow.ShadowLibExtensions as sd
 import Shadow.ShadowTools
 
 from . import utils
+from .cache import HANDLER_CACHE
 
 
 def read_shadow_file_col(filename, parameter=30):
@@ -72,27 +73,102 @@ def read_shadow_file_col(filename, parameter=30):
     }
 
 
-def read_shadow_file(filename, histogram_bins=None):
-    if histogram_bins is None:
-        raise ValueError("'histogram_bins' kwarg should be specified.")
+# The factor converting the wavenumbers of the rays [cm^-1] to energies [eV], as in Shadow.Beam:
+A2EV = 2.0 * np.pi / (6.62606957e-34 * 299792458.0 / 1.602176565e-19 * 1e2)
 
-    beam = sd.Beam()
-    beam.load(filename)
+# The columns of the rays stored by default (see ``write_ray_columns()``): X, Z, X', Z', the
+# lost ray flag, the energy and the total intensity.
+DEFAULT_RAY_COLUMNS = (1, 3, 4, 6, 10, 11, 23)
+LOST_RAY_COLUMN = 10
 
-    # 1=X spatial coordinate; 3=Z spatial coordinate
-    with open(os.devnull, "w") as devnull:
-        with contextlib.redirect_stdout(devnull):
-            data_dict = beam.histo2(1, 3, nolost=1, nbins=histogram_bins)
+# The phase-space histograms of the rays (see ``phase_space_histograms()``) by
+# name, with the columns of their axes: X vs Z, X vs X', Z vs Z' and the energy.
+PHASE_SPACE_PROJECTIONS = {"x_z": (1, 3), "x_xp": (1, 4), "z_zp": (3, 6), "energy": (11,)}
+
+
+def load_shadow_beam(filename):
+    """Read the rays of a Shadow3 binary beam file, see ``load_shadow_buffer()``."""
+    with open(filename, "rb") as f:
+        return load_shadow_buffer(f.read())
+
+
+def load_shadow_buffer(content):
+    """Parse the content of a Shadow3 binary beam file.
+
+    The file is a Fortran sequential file: a record with the number of
+    columns, the number of rays and a flag, then one record of the columns of
+    each ray (see ``read_shadow_file_col()`` for the columns).
+
+    Returns
+    -------
+    numpy.ndarray
+        The array of the rays, of shape (number of rays, number of columns)
+        like ``Shadow.Beam().rays``. It is a view of ``content``.
+    """
+    for byteorder in "<>":
+        marker, ncol, npoint, _, end_marker = np.frombuffer(content, dtype=f"{byteorder}i4", count=5)
+        if marker == end_marker == 12:
+            break
+    else:
+        raise ValueError("The content is not a Shadow3 beam file.")
 
-            # This returns a list of N values (N=number of rays)
-            photon_energy_list = Shadow.ShadowTools.getshcol(filename, col=11)  # 11=Energy [eV]
+    ray_record = np.dtype(
+        [("marker", f"{byteorder}i4"), ("columns", f"{byteorder}f8", (ncol,)), ("end_marker", f"{byteorder}i4")]
+    )
+    records = np.frombuffer(content, dtype=ray_record, count=npoint, offset=20)
+    if npoint and not (records["marker"][0] == records["end_marker"][-1] == ncol * 8):
+        raise ValueError("The records of the rays of the Shadow3 beam file are malformed.")
+    return records["columns"]
 
-    data = data_dict["histogram"]
-    photon_energy = np.mean(photon_energy_list)
+
+def read_shadow_file(filename, histogram_bins=None, timings=None, phase_space=(), phase_space_bins=None):
+    """Read a Shadow3 output binary file, histogram the rays and compute the statistics of the beam.
+
+    If ``timings`` is given, the times spent reading and histogramming the
+    rays ("parse") and computing the statistics ("stats") are stored in it.
+    """
+    with open(filename, "rb") as f:
+        return read_shadow_buffer(
+            f.read(),
+            histogram_bins=histogram_bins,
+            timings=timings,
+            phase_space=phase_space,
+            phase_space_bins=phase_space_bins,
+        )
+
+
+def read_shadow_buffer(content, histogram_bins=None, timings=None, phase_space=(), phase_space_bins=None):
+    """Parse the content of a Shadow3 output binary file in memory, see ``read_shadow_file()``.
+
+    The rays are parsed once with NumPy, the histogram of the good rays
+    weighted by their intensity is the same as
+    ``Shadow.Beam.histo2(1, 3, nolost=1, nbins=histogram_bins)`` and the
+    photon energy is the mean energy of all the rays. The array of the rays
+    (see ``load_shadow_buffer()``) is returned as "rays".
+
+    The histograms of ``PHASE_SPACE_PROJECTIONS`` named in ``phase_space``
+    (with ``phase_space_bins`` bins, ``histogram_bins`` by default) are
+    returned as "phase_space" and, if ``phase_space`` contains "moments",
+    the second moments of the beam (see ``beam_moments()``) as "moments".
+    They are computed from the same columns of the rays.
+    """
+    if histogram_bins is None:
+        raise ValueError("'histogram_bins' kwarg should be specified.")
+
+    start_time = time.monotonic()
+    rays = load_shadow_buffer(content)
+
+    # 1=X spatial coordinate; 3=Z spatial coordinate; 11=Energy [eV]; 23=|E|^2 (total intensity)
+    # 4=X' and 6=Z' for the phase-space products
+    cols = (1, 3, 4, 6, LOST_RAY_COLUMN, 11, 23) if phase_space else (1, 3, LOST_RAY_COLUMN, 11, 23)
+    columns = ray_columns(rays, cols)
+    data, xrange, zrange = histogram_rays(columns, nbins=histogram_bins)
+    photon_energy = np.mean(columns[11])
 
     # convert to um
-    horizontal_extent = 1e3 * np.array(data_dict["xrange"][:2])
-    vertical_extent = 1e3 * np.array(data_dict["yrange"][:2])
+    horizontal_extent = 1e3 * np.array(xrange)
+    vertical_extent = 1e3 * np.array(zrange)
+    parse_time = time.monotonic()
 
     ret = {
         "data": data,
@@ -103,20 +179,305 @@ def read_shadow_file(filename, histogram_bins=None):
         "horizontal_extent": horizontal_extent,
         "vertical_extent": vertical_extent,
         "units": "um",
+        "rays": rays,
     }
 
     ret.update(utils.get_beam_stats(data, horizontal_extent, vertical_extent))
+    if phase_space:
+        projections = {name: PHASE_SPACE_PROJECTIONS[name] for name in phase_space if name != "moments"}
+        nbins = histogram_bins if phase_space_bins is None else phase_space_bins
+        ret["phase_space"] = phase_space_histograms(columns, projections, nbins=nbins)
+        if "moments" in phase_space:
+            ret["moments"] = beam_moments(columns)
 
+    if timings is not None:
+        timings["parse"] = parse_time - start_time
+        timings["stats"] = time.monotonic() - parse_time
     return ret
 
 
+def shadow_column(rays, col):
+    """The column ``col`` of the rays, numbered from 1 as in Shadow3 (see ``read_shadow_file_col()``).
+
+    The columns 1 to 19 and the intensities (23, 24 and 25) are supported.
+    """
+    if col == 11:
+        return rays[:, 10] / A2EV
+    if 1 <= col <= 18:
+        return rays[:, col - 1]
+    if col == 19:
+        return 2 * np.pi * 1.0e8 / rays[:, 10]
+    components = {23: (6, 7, 8, 15, 16, 17), 24: (6, 7, 8), 25: (15, 16, 17)}.get(col)
+    if components is None:
+        raise ValueError(f"The column {col} of the rays is not supported.")
+    intensity = rays[:, components[0]] ** 2
+    for i in components[1:]:
+        intensity += rays[:, i] ** 2
+    return intensity
+
+
+def ray_columns(rays, columns=DEFAULT_RAY_COLUMNS):
+    """The columns of the rays, as a dict ``{column number: values}``."""
+    return {col: shadow_column(rays, col) for col in columns}
+
+
+def write_ray_columns(filename, rays, columns=DEFAULT_RAY_COLUMNS, dtype="float64"):
+    """Write the columns of the rays of a Shadow3 datafile to ``<filename>.rays.npy``.
+
+    The columns are stored as the rows of a 2D array of ``dtype`` (e.g.
+    "float32" to halve the size), in the order of ``columns``. The lost ray
+    flag (column 10) is always stored. The directory of the file is created
+    if needed, as the file may be written before the datafile. Returns the
+    stored columns.
+    """
+    columns = stored_ray_columns(columns)
+    table = np.empty((len(columns), len(rays)), dtype=dtype)
+    for row, col in zip(table, columns):
+        row[:] = shadow_column(rays, col)
+    path = ray_columns_path(filename)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    part_path = f"{path}.part"
+    with open(part_path, "wb") as f:
+        np.save(f, table)
+    os.replace(part_path, path)
+    return columns
+
+
+def stored_ray_columns(columns):
+    """The columns stored by ``write_ray_columns()``: ``columns`` and the lost ray flag."""
+    return tuple(dict.fromkeys((*columns, LOST_RAY_COLUMN)))
+
+
+def ray_columns_path(filename):
+    return f"{filename}.rays.npy"
+
+
+def histogram_rays(columns, col_h=1, col_v=3, nbins=25, xrange=None, yrange=None, nolost=1, ref=23):
+    """Histogram the rays like ``Shadow.Beam.histo2()``.
+
+    Parameters
+    ----------
+    columns : dict
+        The columns of the rays, see ``ray_columns()``.
+    col_h, col_v : int
+        The columns of the horizontal and vertical axes of the histogram.
+    nbins : int
+        The number of bins along each axis.
+    xrange, yrange : list, optional
+        The ranges of the histogram, the range of the values (see
+        ``Shadow.Beam.get_good_range()``) if not specified.
+    nolost : int
+        0 for all the rays, 1 for the good rays and 2 for the lost rays.
+    ref : int
+        The column weighting the rays (23 for the total intensity), or 0 to count the rays.
+
+    Returns
+    -------
+    histogram, xrange, yrange
+    """
+    (h, v), weights = _selected_rays(columns, (col_h, col_v), nolost, ref)
+    xrange = _good_range(h) if xrange is None else xrange
+    yrange = _good_range(v) if yrange is None else yrange
+    return histogram2d(h, v, nbins, xrange, yrange, weights=weights), xrange, yrange
+
+
+def histogram_ray_column(columns, col, nbins=25, xrange=None, nolost=1, ref=23):
+    """Histogram a column of the rays like ``Shadow.Beam.histo1()``, see ``histogram_rays()``.
+
+    The range of the histogram is the range of the values if not specified.
+
+    Returns
+    -------
+    histogram, xrange
+    """
+    (values,), weights = _selected_rays(columns, (col,), nolost, ref)
+    if xrange is None:
+        xrange = [values.min(), values.max()] if values.size else [-1, 1]
+    histogram, _ = np.histogram(values, bins=nbins, range=xrange, weights=weights)
+    return histogram.astype(np.float64, copy=False), xrange
+
+
+def phase_space_histograms(columns, projections=PHASE_SPACE_PROJECTIONS, nbins=25, nolost=1, ref=23):
+    """Histogram the rays along several projections of the phase space.
+
+    Parameters
+    ----------
+    columns : dict
+        The columns of the rays, see ``ray_columns()``.
+    projections : dict
+        The columns of the axes of the histograms by name: two columns for a
+        2D histogram (see ``histogram_rays()``), one for a 1D histogram (see
+        ``histogram_ray_column()``).
+    nbins, nolost, ref
+        See ``histogram_rays()``.
+
+    Returns
+    -------
+    dict
+        The histogram and its extent (``[xmin, xmax]`` or ``[xmin, xmax, ymin, ymax]``) by name.
+    """
+    products = {}
+    for name, cols in projections.items():
+        if len(cols) == 2:
+            histogram, xrange, yrange = histogram_rays(columns, *cols, nbins=nbins, nolost=nolost, ref=ref)
+            extent = [*xrange, *yrange]
+        else:
+            histogram, extent = histogram_ray_column(columns, *cols, nbins=nbins, nolost=nolost, ref=ref)
+        products[name] = (histogram, np.array(extent, dtype=np.float64))
+    return products
+
+
+def beam_moments(columns, nolost=1, ref=23):
+    """The second moments of the rays in the horizontal (X, X') and vertical (Z, Z') phase spaces.
+
+    The moments are weighted by the column ``ref`` (the intensity by
+    default), in the units of the rays. The emittance is the RMS emittance
+    ``sqrt(<x^2><x'^2> - <xx'>^2)`` of the centered moments.
+
+    Returns
+    -------
+    dict
+        "sigma_x", "sigma_xp", "cov_x_xp" and "emittance_x", and the same for "z".
+    """
+    moments = {}
+    for plane, cols in (("x", (1, 4)), ("z", (3, 6))):
+        (u, up), weights = _selected_rays(columns, cols, nolost, ref)
+        if u.size == 0 or (weights is not None and not weights.sum()):
+            keys = (f"sigma_{plane}", f"sigma_{plane}p", f"cov_{plane}_{plane}p", f"emittance_{plane}")
+            moments.update(dict.fromkeys(keys, np.nan))
+            continue
+        u = u - np.average(u, weights=weights)
+        up = up - np.average(up, weights=weights)
+        var_u = np.average(u * u, weights=weights)
+        var_up = np.average(up * up, weights=weights)
+        cov = np.average(u * up, weights=weights)
+        moments[f"sigma_{plane}"] = np.sqrt(var_u)
+        moments[f"sigma_{plane}p"] = np.sqrt(var_up)
+        moments[f"cov_{plane}_{plane}p"] = cov
+        moments[f"emittance_{plane}"] = np.sqrt(max(var_u * var_up - cov * cov, 0.0))
+    return moments
+
+
+def _selected_rays(columns, cols, nolost, ref):
+    """The columns ``cols`` and weights (None to count the rays) of the rays selected by ``nolost``."""
+    values = [columns[col] for col in cols]
+    weights = columns[ref] if ref else None
+    if nolost:
+        flags = columns[LOST_RAY_COLUMN]
+        selected = flags > 0.0 if nolost == 1 else flags < 0.0
+        values = [v[selected] for v in values]
+        if weights is not None:
+            weights = weights[selected]
+    return values, weights
+
+
+def histogram2d(x, y, nbins, xrange, yrange, weights=None):
+    """The same histogram as ``np.histogram2d(x, y, bins=nbins, range=[xrange, yrange], weights=weights)``.
+
+    The bins are uniform, so the bin of each value is computed directly
+    rather than searched among the edges of the bins. As for ``np.histogram()``,
+    a range with equal bounds is widened by 0.5 on each side, and a reversed
+    or non-finite range raises ``ValueError``.
+    """
+    ix, x_in_range = _bin_indices(x, nbins, *xrange)
+    iy, y_in_range = _bin_indices(y, nbins, *yrange)
+    in_range = x_in_range & y_in_range
+    if weights is not None:
+        weights = weights[in_range]
+    counts = np.bincount(ix[in_range] * nbins + iy[in_range], weights=weights, minlength=nbins * nbins)
+    return counts.reshape((nbins, nbins)).astype(np.float64, copy=False)
+
+
+def _bin_indices(values, nbins, first_edge, last_edge):
+    """The indices of the uniform bins of the values, as computed by ``np.histogram()``."""
+    if first_edge > last_edge:
+        raise ValueError(f"The range [{first_edge}, {last_edge}] of the histogram is reversed.")
+    if not (np.isfinite(first_edge) and np.isfinite(last_edge)):
+        raise ValueError(f"The range [{first_edge}, {last_edge}] of the histogram is not finite.")
+    if first_edge == last_edge:
+        first_edge, last_edge = first_edge - 0.5, last_edge + 0.5
+    edges = np.linspace(first_edge, last_edge, nbins + 1)
+    in_range = (values >= first_edge) & (values <= last_edge)
+    indices = ((values - first_edge) * (nbins / (last_edge - first_edge))).astype(np.intp)
+    np.clip(indices, 0, nbins - 1, out=indices)
+    # The computed indices can be off by one due to the rounding errors:
+    indices[values < edges[indices]] -= 1
+    indices[(values >= edges[indices + 1]) & (indices != nbins - 1)] += 1
+    return indices, in_range
+
+
+def _good_range(values):
+    """The range of the histogram of the values, as ``Shadow.Beam.get_good_range()``."""
+    if values.size == 0:
+        return [-1, 1]
+    rmin0 = values.min()
+    rmax0 = values.max()
+    rmin = rmin0 * 0.95 if rmin0 > 0.0 else rmin0 * 1.05
+    rmax = rmax0 * 0.95 if rmax0 < 0.0 else rmax0 * 1.05
+    if rmin0 == rmax0 and rmin0 != 0.0:
+        rmin = rmin0 * 0.95
+        rmax = rmax0 * 1.05
+    if rmin0 == 0.0:
+        rmin = -1.0
+        rmax = 1.0
+    if (rmax - rmin) / 1.25 > (rmax0 - rmin0) and rmin0 != rmax0:
+        rmin = 0.5 * (rmax0 + rmin0) - 0.55 * (rmax0 - rmin0)
+        rmax = 0.5 * (rmax0 + rmin0) + 0.55 * (rmax0 - rmin0)
+    return [rmin, rmax]
+
+
 class ShadowFileHandler:
+    """Read the histogram of a Shadow3 datafile, memory-mapped from its ``.npy`` sidecar if it exists.
+
+    The histogram of the rays recorded at acquisition (X vs Z weighted by the
+    intensity, with ``histogram_bins`` bins) is returned by default. Other
+    bins, ranges or columns can be requested at read time, which histograms
+    the rays again (see ``histogram_rays()``), e.g.
+    ``ShadowFileHandler(filename, histogram_bins=100)(nbins=50, xrange=[-0.1, 0.1])``.
+    The rays are read from the columnar file written at acquisition
+    (``ray_columns``, see ``write_ray_columns()``) if it exists, otherwise
+    from the datafile.
+
+    The histograms and the rays are kept in ``sirepo_bluesky.cache.HANDLER_CACHE``.
+    """
+
     specs = {"shadow"}
 
-    def __init__(self, filename, histogram_bins, **kwargs):
+    def __init__(self, filename, histogram_bins, ray_columns=None, **kwargs):
         self._name = filename
         self._histogram_bins = histogram_bins
+        self._ray_columns = tuple(ray_columns) if ray_columns is not None else None
+
+    def __call__(self, nbins=None, col_h=1, col_v=3, xrange=None, yrange=None, nolost=1, ref=23, **kwargs):
+        nbins = self._histogram_bins if nbins is None else nbins
+        if (nbins, col_h, col_v, xrange, yrange, nolost, ref) != (self._histogram_bins, 1, 3, None, None, 1, 23):
+            columns = self.rays({col_h, col_v, ref or col_h, LOST_RAY_COLUMN})
+            return histogram_rays(columns, col_h, col_v, nbins, xrange, yrange, nolost, ref)[0]
+
+        data = utils.load_sidecar(self._name)
+        if data is None:
+            data = HANDLER_CACHE.load(
+                "shadow",
+                self._name,
+                lambda: read_shadow_file(self._name, histogram_bins=self._histogram_bins)["data"],
+                histogram_bins=self._histogram_bins,
+            )
+        return data
+
+    def rays(self, columns=None):
+        """The columns of the rays (all the stored ones by default), as a dict ``{column number: values}``."""
+        if self._ray_columns is not None and (columns is None or set(columns) <= set(self._ray_columns)):
+            table = HANDLER_CACHE.load("shadow-rays", ray_columns_path(self._name), self._read_ray_columns)
+            return {col: table[self._ray_columns.index(col)] for col in columns or self._ray_columns}
+
+        columns = tuple(sorted(columns or DEFAULT_RAY_COLUMNS))
+
+        def read():
+            rays = load_shadow_beam(self._name)
+            return np.stack([shadow_column(rays, col) for col in columns])
+
+        table = HANDLER_CACHE.load("shadow-rays", self._name, read, columns=columns)
+        return dict(zip(columns, table))
 
-    def __call__(self, **kwargs):
-        d = read_shadow_file(self._name, histogram_bins=self._histogram_bins)
-        return d["data"]
+    def _read_ray_columns(self):
+        return np.load(ray_columns_path(self._name))
@@ -1,61 +1,123 @@
 import base64
+import contextlib
+import copy
 import hashlib
+import heapq
+import itertools
+import logging
+import os
 import random
+import re
+import shutil
+import threading
 import time
+from collections import Counter, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import numconv
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from .cache import canonical_hash
 
-class SirepoBlueskyClientException(Exception):
-    pass
+logger = logging.getLogger("sirepo-bluesky")
+
+# Endpoints which can be safely re-sent if the server responds with a transient error.
+IDEMPOTENT_ENDPOINTS = ("download-data-file", "run-status", "simulation-list", "stateless-compute")
+RETRY_STATUS_CODES = (502, 503, 504)
+DATAFILE_CHUNK_SIZE = 1024 * 1024
+WATCHPOINT_REPORT_RE = re.compile(r"watchpointReport(\d+)")
+# Fields of ``data`` which control how a simulation is run, but are not part of its definition:
+RUN_CONTROL_FIELDS = ("forceRun",)
+
+SimulationResult = namedtuple(
+    "SimulationResult", "status duration path content hexdigest cached timings", defaults=(None,)
+)
+
+# The phases of a simulation run (in seconds) and its counts, see new_timings():
+TIMING_PHASES = ("upload", "queue", "compute", "poll_slack", "download", "write")
+TIMING_COUNTS = ("status_calls", "upload_bytes", "download_bytes")
 
 
-class SirepoBluesky(object):
+def new_timings():
+    """Return an empty breakdown of the time spent in a simulation run.
+
+    The keys are:
+
+    - ``upload``: sending the models to the server until it acknowledges the run,
+    - ``queue``: the status polls while the server reports the simulation as pending,
+    - ``compute``: the status polls while the server reports the simulation as running,
+    - ``poll_slack``: the last status poll, during which the simulation finished
+      (an upper bound of the time its completion went unnoticed),
+    - ``download``: transferring the datafile,
+    - ``write``: writing the datafile to disk,
+    - ``status_calls``: the number of status requests,
+    - ``upload_bytes`` and ``download_bytes``: the sizes of the request and of the datafile.
     """
-    Invoke a remote sirepo simulation with custom arguments.
+    timings = {phase: 0.0 for phase in TIMING_PHASES}
+    timings.update({count: 0 for count in TIMING_COUNTS})
+    return timings
 
-    Parameters
-    ----------
-    server: str
-        Sirepo server to call, ex. 'http://locahost:8000'
 
-    Examples
-    --------
-    # sim_id is the last section from the simulation url
-    # e.g., '.../1tNWph0M'
-    sim_id = '1tNWph0M'
-    sb = SirepoBluesky('http://localhost:8000')
-    data, schema = sb.auth('srw', sim_id)
-    # update the model values and choose the report
-    data['models']['undulator']['verticalAmplitude'] = 0.95
-    data['report'] = 'trajectoryReport'
-    sb.run_simulation()
-    f = sb.get_datafile()
+class SirepoBlueskyClientException(Exception):
+    pass
 
-    # assumes there is an aperture named A1 and a watchpoint named W1 in the beamline
-    aperture = sb.find_element(data['models']['beamline'], 'title', 'A1')
-    aperture['horizontalSize'] = 0.1
-    aperture['verticalSize'] = 0.1
-    watch = sb.find_element(data['models']['beamline'], 'title', 'W1')
-    data['report'] = 'watchpointReport{}'.format(watch['id'])
-    sb.run_simulation()
-    f2 = sb.get_datafile()
 
-    Start Sirepo Server
-    -------------------
-    $ SIREPO_BLUESKY_AUTH_SECRET=bluesky sirepo service http
-    - 'bluesky' is the secret key in this case
+class SirepoBlueskyBase(object):
+    """
+    The state of a client of a Sirepo simulation, without any I/O.
 
+    The base of the synchronous (:class:`SirepoBluesky`) and asyncio
+    (:class:`~sirepo_bluesky.async_sirepo_bluesky.AsyncSirepoBluesky`) clients:
+    it builds the payloads and URLs of the requests, processes the responses
+    and tracks the modifications of the models and the runs of the reports.
+    The requests are sent by the subclasses. See ``SirepoBluesky`` for the
+    description of the parameters.
     """
 
-    def __init__(self, server, secret="bluesky"):
+    def __init__(
+        self,
+        server,
+        secret="bluesky",
+        session=None,
+        pool_size=10,
+        max_retries=3,
+        backoff_factor=0.5,
+        compute_cache=None,
+        force_run=True,
+        cancel_timeout=5,
+    ):
         self.server = server
         self.secret = secret
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.compute_cache = compute_cache
+        self.compute_counts = Counter()  # element name -> number of stateless computations
+        self.force_run = force_run
+        self.cancel_timeout = cancel_timeout
+        # The simulations started by the client (and its snapshots) which are still running:
+        self._active_jobs = {}
+        self._jobs_lock = threading.Lock()
+        self._reset_changes()
+        self._session = session
+        self._session_pid = os.getpid()
 
-    def auth(self, sim_type, sim_id):
-        """Connect to the server and returns the data for the simulation identified by sim_id."""
+    @property
+    def session(self):
+        """The pooled keep-alive HTTP session used for all requests to the server.
+
+        A new session is created if the client is used from a forked process,
+        so that the processes never share sockets of the same connection pool.
+        """
+        if self._session is None or self._session_pid != os.getpid():
+            self._session = self._make_session()
+            self._session_pid = os.getpid()
+        return self._session
+
+    def _auth_request(self, sim_type, sim_id):
         req = dict(simulationType=sim_type, simulationId=sim_id)
         r = random.SystemRandom()
         req["authNonce"] = str(int(time.time())) + "-" + "".join(r.choice(numconv.BASE62) for x in range(32))
@@ -71,31 +133,30 @@ class SirepoBluesky(object):
             ).encode()
         )
         req["authHash"] = "v1:" + base64.urlsafe_b64encode(h.digest()).decode()
+        return req
 
-        self.cookies = None
-        res = self._post_json("auth-bluesky-login", req)
+    def _update_from_auth(self, sim_type, sim_id, res):
         if not ("state" in res and res["state"] == "ok"):
             raise SirepoBlueskyClientException(f"bluesky_auth failed: {res}")
         self.sim_type = sim_type
         self.sim_id = sim_id
         self.schema = res["schema"]
         self.data = res["data"]
+        self._reset_changes()
         return self.data, self.schema
 
-    def copy_sim(self, sim_name):
-        """Create a copy of the current simulation. Returns a new instance of SirepoBluesky."""
+    def _copy_sim_request(self, sim_name):
         if not self.sim_id:
             raise ValueError(f"sim_id is {self.sim_id!r}")
-        res = self._post_json(
-            "copy-simulation",
-            {
-                "simulationId": self.sim_id,
-                "simulationType": self.sim_type,
-                "folder": self.data["models"]["simulation"]["folder"],
-                "name": sim_name,
-            },
-        )
-        copy = SirepoBluesky(self.server, self.secret)
+        return {
+            "simulationId": self.sim_id,
+            "simulationType": self.sim_type,
+            "folder": self.data["models"]["simulation"]["folder"],
+            "name": sim_name,
+        }
+
+    def _make_copy(self, res):
+        copy = type(self)(self.server, self.secret, **self._copy_kwargs())
         copy.cookies = self.cookies
         copy.sim_type = self.sim_type
         copy.sim_id = res["models"]["simulation"]["simulationId"]
@@ -104,75 +165,205 @@ class SirepoBluesky(object):
         copy.is_copy = True
         return copy
 
-    def delete_copy(self):
-        """Delete a simulation which was created using copy_sim()."""
+    def _copy_kwargs(self):
+        """The parameters of the client passed to the clients of the copies of the simulation."""
+        return dict(
+            session=self.session,
+            pool_size=self.pool_size,
+            max_retries=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            compute_cache=self.compute_cache,
+            cancel_timeout=self.cancel_timeout,
+        )
+
+    def snapshot(self):
+        """Return a client for the simulation with a copy of the current ``data``.
+
+        The snapshot shares the session, the caches and the record of the runs
+        with the client, so the simulation of the snapshot can be run (e.g. in
+        a background thread or task) while ``data`` is modified.
+        """
+        snapshot = copy.copy(self)
+        snapshot.data = copy.deepcopy(self.data)
+        # The digests of the models (see data_hash()) are shared, at the versions of the snapshot.
+        snapshot._model_versions = dict(self._model_versions)
+        return snapshot
+
+    def _delete_copy_request(self):
         if not self.is_copy:
             raise ValueError("This simulation is not a copy")
-        res = self._post_json(
-            "delete-simulation",
-            {
-                "simulationId": self.sim_id,
-                "simulationType": self.sim_type,
-            },
-        )
+        return {
+            "simulationId": self.sim_id,
+            "simulationType": self.sim_type,
+        }
+
+    def _update_from_delete_copy(self, res):
         if not res["state"] == "ok":
             raise SirepoBlueskyClientException(f"Could not delete simulation: {res}")
         self.sim_id = None
 
-    def compute_crl_characteristics(self, crl_element):
-        res = self._post_json(
-            "stateless-compute",
-            {
-                "method": "crl_characteristics",
-                "optical_element": crl_element,
-                "photon_energy": self.data["models"]["simulation"]["photonEnergy"],
-                "simulationId": self.sim_id,
-                "simulationType": self.sim_type,
-            },
-        )
+    def mark_modified(self, sirepo_dict, param):
+        """Record the modification of the parameter ``param`` of a model (or element) of ``data``.
 
-        return res
+        ``sirepo_dict`` is the model, as found in ``data["models"]``. The ophyd
+        signals created by ``create_classes()`` record their modifications.
+        """
+        self.data_version += 1
+        model_name, label, element_id = self._model_label(sirepo_dict)
+        self._modified.setdefault(label, {})[param] = self.data_version
+        if element_id is not None:
+            self._modified_elements[label] = element_id
+        if model_name is None:
+            # The digests of all the models are recomputed by data_hash().
+            self._model_digests.clear()
+        else:
+            self._model_versions[model_name] = self.data_version
 
-    def compute_crystal_init(self, crystal_element):
-        res = self._post_json(
-            "stateless-compute",
-            {
-                "method": "crystal_init",
-                "optical_element": crystal_element,
-                "simulationId": self.sim_id,
-                "simulationType": self.sim_type,
-            },
-        )
-        return res
+    def data_hash(self):
+        """Return a digest identifying the content of ``data``.
 
-    def compute_crystal_orientation(self, crystal_element):
-        res_init = self.compute_crystal_init(crystal_element)
+        The models are hashed separately, and the digest of a model is only
+        recomputed if the model was modified (see ``mark_modified()``) since
+        the previous call, so that the unchanged models are not serialized
+        again. Modifications of the models made outside of the ophyd signals
+        must therefore be recorded with ``mark_modified()``, or the digests
+        reset with ``reset_data_hash()``. The fields in ``RUN_CONTROL_FIELDS``
+        are ignored.
+        """
+        ignored_fields = ("models", *RUN_CONTROL_FIELDS)
+        digests = [canonical_hash({key: value for key, value in self.data.items() if key not in ignored_fields})]
+        for name, model in self.data["models"].items():
+            version = self._model_versions.get(name, 0)
+            entry = self._model_digests.get(name)
+            if entry is None or entry[0] != version:
+                entry = (version, canonical_hash(model))
+                self._model_digests[name] = entry
+            digests.append(f"{name}:{entry[1]}")
+        return canonical_hash(digests)
+
+    def reset_data_hash(self):
+        """Recompute the digests of all the models at the next ``data_hash()``.
+
+        This accounts for the modifications of ``data`` which were not
+        recorded with ``mark_modified()``. The devices do it when they are
+        staged, so that the data recorded by a run is never identified by the
+        digest of a previous content.
+        """
+        self._model_digests.clear()
+
+    def modified_since(self, version):
+        """The modified parameters of the models since ``version`` of ``data_version``, by model.
+
+        The models are labeled by their name, and the elements of the beamline
+        (or of the lattice) by their title (or name).
+        """
+        modified = {}
+        for label, params in self._modified.items():
+            params = [param for param, param_version in params.items() if param_version > version]
+            if params:
+                modified[label] = params
+        return modified
+
+    def is_modified(self, report=None):
+        """Whether the report (the current one by default) is affected by the modifications since its last run.
+
+        The result of a watchpoint report only depends on the elements of the
+        beamline up to the watchpoint, so the modifications of the elements
+        downstream of the watchpoint (by ``position``) are ignored.
+        """
+        report = report or self.data["report"]
+        if report not in self._run_versions:
+            return True
+        modified = self.modified_since(self._run_versions[report])
+        return any(self._affects(label, params, report) for label, params in modified.items())
+
+    def _affects(self, label, params, report):
+        """Whether the modification of the parameters of a model can change the result of the report."""
+        if WATCHPOINT_REPORT_RE.fullmatch(label):
+            # The model of a watchpoint report only affects that report.
+            return label == report
+        match = WATCHPOINT_REPORT_RE.fullmatch(report)
+        if not match or label not in self._modified_elements or "position" in params:
+            return True
+        beamline = self.data["models"].get("beamline", [])
+        positions = {
+            str(element["id"]): float(element["position"]) for element in beamline if "position" in element
+        }
+        element_id = self._modified_elements[label]
+        watchpoint_id = match.group(1)
+        if element_id not in positions or watchpoint_id not in positions:
+            return True
+        return positions[element_id] <= positions[watchpoint_id]
+
+    def _reset_changes(self):
+        self.data_version = 0
+        self.last_run_modified = {}  # the modified parameters by model since the previous run of the report
+        self._modified = {}  # model label -> {param: data version of the last modification}
+        self._modified_elements = {}  # model label -> id of the element of the beamline
+        self._run_versions = {}  # report -> data version at its last run
+        self._model_versions = {}  # model name -> data version of its last modification
+        self._model_digests = {}  # model name -> (model version, digest), see data_hash()
+
+    def _model_label(self, sirepo_dict):
+        """Return the name of the model containing a dict of ``data``, its label and the id of its element.
+
+        The label is the name of the model, or the title (or name) of an
+        element. The id is the id of the element of the beamline (if any).
+        """
+        for name, model in self.data["models"].items():
+            if model is sirepo_dict:
+                return name, name, None
+            if isinstance(model, list):
+                for i, element in enumerate(model):
+                    if element is sirepo_dict:
+                        element_id = str(element["id"]) if name == "beamline" and "id" in element else None
+                        return name, element.get("title", element.get("name", f"{name}[{i}]")), element_id
+            elif isinstance(model, dict):
+                # e.g. the propagation parameters of the elements of the beamline, by element id
+                for key, value in model.items():
+                    if value is sirepo_dict or (isinstance(value, list) and any(v is sirepo_dict for v in value)):
+                        return name, f"{name}[{key}]", key if name == "propagation" else None
+        return None, "unknown", None
+
+    @staticmethod
+    def _is_cacheable_compute(res):
+        return isinstance(res, dict) and res.get("state", "completed") == "completed"
+
+    def _crl_characteristics_request(self, crl_element):
+        return {
+            "method": "crl_characteristics",
+            "optical_element": crl_element,
+            "photon_energy": self.data["models"]["simulation"]["photonEnergy"],
+            "simulationId": self.sim_id,
+            "simulationType": self.sim_type,
+        }
+
+    def _crystal_init_request(self, crystal_element):
+        return {
+            "method": "crystal_init",
+            "optical_element": crystal_element,
+            "simulationId": self.sim_id,
+            "simulationType": self.sim_type,
+        }
+
+    def _crystal_orientation_request(self, res_init):
         if res_init.pop("state") != "completed":
             raise SirepoBlueskyClientException("crystal_init returned error state")
-        res = self._post_json(
-            "stateless-compute",
-            {
-                "method": "crystal_orientation",
-                "optical_element": dict(res_init),
-                "photon_energy": self.data["models"]["simulation"]["photonEnergy"],
-                "simulationId": self.sim_id,
-                "simulationType": self.sim_type,
-            },
-        )
+        return {
+            "method": "crystal_orientation",
+            "optical_element": dict(res_init),
+            "photon_energy": self.data["models"]["simulation"]["photonEnergy"],
+            "simulationId": self.sim_id,
+            "simulationType": self.sim_type,
+        }
 
-        return res
-
-    def compute_grazing_orientation(self, optical_element):
-        res = self._post_json(
-            "stateless-compute",
-            {
-                "method": "compute_grazing_orientation",
-                "optical_element": optical_element,
-                "simulationId": self.sim_id,
-                "simulationType": self.sim_type,
-            },
-        )
-        return res
+    def _grazing_orientation_request(self, optical_element):
+        return {
+            "method": "compute_grazing_orientation",
+            "optical_element": optical_element,
+            "simulationId": self.sim_id,
+            "simulationType": self.sim_type,
+        }
 
     @staticmethod
     def find_element(elements, field, value):
@@ -189,57 +380,37 @@ class SirepoBluesky(object):
                 return optic_id
         raise ValueError(f"Not valid optic {optic_name}")
 
-    def get_datafile(self, file_index=-1):
-        """Request the raw datafile of simulation results from the server.
-
-        Notes
-        -----
-        Call auth() and run_simulation() before this.
-        """
+    def _datafile_url(self, file_index, report=None):
         if not hasattr(self, "cookies"):
             raise Exception("must call auth() before get_datafile()")
-        url = f"download-data-file/{self.sim_type}/{self.sim_id}/{self.data['report']}/{file_index}"
-        response = requests.get(f"{self.server}/{url}", cookies=self.cookies)
-        self._assert_success(response, url)
-        return response.content
+        report = report or self.data["report"]
+        return f"download-data-file/{self.sim_type}/{self.sim_id}/{report}/{file_index}"
 
-    def process_beam_parameters(self):
-        res = self._post_json(
-            "stateless-compute",
-            {
-                "ebeam": self.data["models"]["electronBeam"],
-                "ebeam_position": self.data["models"]["electronBeamPosition"],
-                "method": "process_beam_parameters",
-                "simulationId": self.sim_id,
-                "simulationType": self.sim_type,
-                "source_type": self.data["models"]["simulation"]["sourceType"],
-                "undulator_length": self.data["models"]["undulator"]["length"],
-                "undulator_period": self.data["models"]["undulator"]["period"] / 1000.0,
-                "undulator_type": self.data["models"]["tabulatedUndulator"]["undulatorType"],
-            },
-        )
-        return res
+    def _beam_parameters_request(self):
+        return {
+            "ebeam": self.data["models"]["electronBeam"],
+            "ebeam_position": self.data["models"]["electronBeamPosition"],
+            "method": "process_beam_parameters",
+            "simulationId": self.sim_id,
+            "simulationType": self.sim_type,
+            "source_type": self.data["models"]["simulation"]["sourceType"],
+            "undulator_length": self.data["models"]["undulator"]["length"],
+            "undulator_period": self.data["models"]["undulator"]["period"] / 1000.0,
+            "undulator_type": self.data["models"]["tabulatedUndulator"]["undulatorType"],
+        }
 
-    def process_undulator_definition(self):
-        res = self._post_json(
-            "stateless-compute",
-            {
-                "amplitude": self.data["models"]["undulator"]["verticalAmplitude"],
-                "method": "process_undulator_definition",
-                "methodSignature": "process_undulator_definitionverticalDeflectingParameter",
-                "simulationId": self.sim_id,
-                "simulationType": self.sim_type,
-                # Could not locate undulator_definition in source code, using "B" as a placeholder
-                "undulator_definition": "B",
-                "undulator_parameter": self.data["models"]["undulator"]["horizontalDeflectingParameter"],
-                "undulator_period": self.data["models"]["undulator"]["period"] / 1000.0,
-            },
-        )
-        return res
-
-    def simulation_list(self):
-        """Returns a list of simulations for the authenticated user."""
-        return self._post_json("simulation-list", dict(simulationType=self.sim_type))
+    def _undulator_definition_request(self):
+        return {
+            "amplitude": self.data["models"]["undulator"]["verticalAmplitude"],
+            "method": "process_undulator_definition",
+            "methodSignature": "process_undulator_definitionverticalDeflectingParameter",
+            "simulationId": self.sim_id,
+            "simulationType": self.sim_type,
+            # Could not locate undulator_definition in source code, using "B" as a placeholder
+            "undulator_definition": "B",
+            "undulator_parameter": self.data["models"]["undulator"]["horizontalDeflectingParameter"],
+            "undulator_period": self.data["models"]["undulator"]["period"] / 1000.0,
+        }
 
     @staticmethod
     def update_grazing_vectors(data_to_update, grazing_vectors_params):
@@ -260,9 +431,582 @@ class SirepoBluesky(object):
         grazing_params["normalVectorZ"] = nvz
         data_to_update.update(grazing_params)
 
+    def _end_job(self, job):
+        with self._jobs_lock:
+            self._active_jobs.pop(id(job), None)
+
+    @property
+    def active_reports(self):
+        """The reports of the simulations started by the client (and its snapshots) which are still running."""
+        with self._jobs_lock:
+            return [job["report"] for job in self._active_jobs.values()]
+
+    def _run_simulation_request(self):
+        self._check_runnable()
+        self.data["simulationId"] = self.sim_id
+        # Let the server reuse its cached result of the report if nothing was modified since its last run.
+        self.data["forceRun"] = self.force_run and self.is_modified()
+        return self.data
+
+    def _pending_run(self):
+        """The report, data version and modified models of a run of the current report, see ``_record_run()``."""
+        report = self.data["report"]
+        return report, self.data_version, self.modified_since(self._run_versions.get(report, 0))
+
+    def _record_run(self, run=None):
+        """Record a run which produced a result (by default of the current report, with the current data).
+
+        Only the completed runs are recorded, so that a failed or cancelled run
+        is not taken as the clean result of its report by ``is_modified()``.
+        """
+        report, version, modified = run or self._pending_run()
+        if version >= self._run_versions.get(report, -1):
+            self._run_versions[report] = version
+            self.last_run_modified = modified
+
+    def _check_runnable(self):
+        if not hasattr(self, "cookies"):
+            raise Exception("call auth() before run_simulation()")
+        if "report" not in self.data:
+            raise Exception("client needs to set data['report']")
+
+    @staticmethod
+    def _is_finished(res):
+        if res["state"] in ("completed", "error"):
+            return True
+        if "nextRequestSeconds" not in res:
+            raise Exception(f'missing "nextRequestSeconds" in response: {res}')
+        return False
+
+    @staticmethod
+    def _assert_completed(res):
+        if not res["state"] == "completed":
+            raise SirepoBlueskyClientException(f"simulation failed to complete: {res['state']}")
+
+    @staticmethod
+    def _assert_success(response, url):
+        if not response.status_code == requests.codes.ok:
+            raise SirepoBlueskyClientException(f"{url} request failed, status: {response.status_code}")
+
+    def _attempts(self, url):
+        if url.split("/")[0] in IDEMPOTENT_ENDPOINTS:
+            return 1 + self.max_retries
+        return 1
+
+
+class SirepoBluesky(SirepoBlueskyBase):
+    """
+    Invoke a remote sirepo simulation with custom arguments.
+
+    Parameters
+    ----------
+    server: str
+        Sirepo server to call, ex. 'http://locahost:8000'
+    secret: str, optional
+        The secret key used to authenticate with the server.
+    session: requests.Session, optional
+        An existing session to reuse. Copies of a simulation created with
+        ``copy_sim()`` share the session (and its connection pool) of the original.
+    pool_size: int, optional
+        Maximum number of keep-alive connections kept open to the server.
+    max_retries: int, optional
+        Number of times an idempotent request is re-sent when the connection
+        fails or the server responds with a transient error (502, 503, 504).
+    backoff_factor: float, optional
+        Retries are delayed by ``backoff_factor * 2 ** (retry_number - 1)`` seconds.
+    cache: sirepo_bluesky.cache.SimulationCache, optional
+        A cache of simulation results used by ``run_and_download()`` to skip
+        the runs of simulations identical to previously finished ones.
+        Copies of the simulation share the cache.
+    compute_cache: sirepo_bluesky.cache.ComputeCache, optional
+        A cache of the responses to the stateless-compute requests (CRL, crystal
+        and grazing angle characteristics, beam parameters, undulator definition),
+        so that they are not requested again for the same parameters.
+        Copies of the simulation share the cache.
+    defer_compute: bool, optional
+        If True, the stateless computations triggered by setting the parameters
+        of the optical elements (CRL, crystal, grazing angle) are deferred and
+        done once per element before the next simulation run or read of the
+        element. See also ``deferred_compute()``.
+    force_run: bool, optional
+        If True (default), a report is recomputed by the server when its
+        simulation is run after modifications of the models. If False, or if
+        the models were not modified since the last run of the report (see
+        ``mark_modified()``), the server may reuse its cached result.
+    skip_clean_runs: bool, optional
+        If True, ``run_and_download()`` returns the previous result of the
+        report without contacting the server if it is not affected by the
+        modifications of the models since (see ``is_modified()``).
+        Modifications of ``data`` made outside of the ophyd signals must then
+        be recorded with ``mark_modified()``.
+    cancel_timeout: float, optional
+        The maximum time in seconds to wait for the server to acknowledge the
+        cancellation of a simulation (see ``cancel_simulations()``). Default is 5.
+
+    Examples
+    --------
+    # sim_id is the last section from the simulation url
+    # e.g., '.../1tNWph0M'
+    sim_id = '1tNWph0M'
+    sb = SirepoBluesky('http://localhost:8000')
+    data, schema = sb.auth('srw', sim_id)
+    # update the model values and choose the report
+    data['models']['undulator']['verticalAmplitude'] = 0.95
+    data['report'] = 'trajectoryReport'
+    sb.run_simulation()
+    f = sb.get_datafile()
+
+    # assumes there is an aperture named A1 and a watchpoint named W1 in the beamline
+    aperture = sb.find_element(data['models']['beamline'], 'title', 'A1')
+    aperture['horizontalSize'] = 0.1
+    aperture['verticalSize'] = 0.1
+    watch = sb.find_element(data['models']['beamline'], 'title', 'W1')
+    data['report'] = 'watchpointReport{}'.format(watch['id'])
+    sb.run_simulation()
+    f2 = sb.get_datafile()
+
+    Start Sirepo Server
+    -------------------
+    $ SIREPO_BLUESKY_AUTH_SECRET=bluesky sirepo service http
+    - 'bluesky' is the secret key in this case
+
+    """
+
+    def __init__(
+        self,
+        server,
+        secret="bluesky",
+        session=None,
+        pool_size=10,
+        max_retries=3,
+        backoff_factor=0.5,
+        cache=None,
+        compute_cache=None,
+        defer_compute=False,
+        force_run=True,
+        skip_clean_runs=False,
+        cancel_timeout=5,
+    ):
+        self.cache = cache
+        self.defer_compute = defer_compute
+        self._pending_computes = {}
+        self.skip_clean_runs = skip_clean_runs
+        self.last_timings = None  # the breakdown of the time of the last run, see new_timings()
+        super().__init__(
+            server,
+            secret,
+            session=session,
+            pool_size=pool_size,
+            max_retries=max_retries,
+            backoff_factor=backoff_factor,
+            compute_cache=compute_cache,
+            force_run=force_run,
+            cancel_timeout=cancel_timeout,
+        )
+
+    def _reset_changes(self):
+        super()._reset_changes()
+        self._last_results = {}  # (report, file_index) -> SimulationResult
+
+    def _copy_kwargs(self):
+        return dict(super()._copy_kwargs(), cache=self.cache)
+
+    def snapshot(self):
+        """Return a client for the simulation with a copy of the current ``data``.
+
+        See ``SirepoBlueskyBase.snapshot()``. The pending deferred computations are done first.
+        """
+        self.flush_computes()
+        snapshot = super().snapshot()
+        snapshot._pending_computes = {}
+        return snapshot
+
+    def _make_session(self):
+        session = requests.Session()
+        # Only retry connection errors here (the request did not reach the
+        # server), other errors are retried for idempotent endpoints in _request().
+        retry = Retry(
+            total=None,
+            connect=self.max_retries,
+            read=0,
+            redirect=0,
+            status=0,
+            other=0,
+            backoff_factor=self.backoff_factor,
+        )
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def auth(self, sim_type, sim_id):
+        """Connect to the server and returns the data for the simulation identified by sim_id."""
+        self.cookies = None
+        res = self._post_json("auth-bluesky-login", self._auth_request(sim_type, sim_id))
+        return self._update_from_auth(sim_type, sim_id, res)
+
+    def copy_sim(self, sim_name):
+        """Create a copy of the current simulation. Returns a new instance of SirepoBluesky."""
+        res = self._post_json("copy-simulation", self._copy_sim_request(sim_name))
+        return self._make_copy(res)
+
+    def delete_copy(self):
+        """Delete a simulation which was created using copy_sim()."""
+        res = self._post_json("delete-simulation", self._delete_copy_request())
+        self._update_from_delete_copy(res)
+
+    def compute_crl_characteristics(self, crl_element):
+        return self._stateless_compute(self._crl_characteristics_request(crl_element))
+
+    def compute_crystal_init(self, crystal_element):
+        return self._stateless_compute(self._crystal_init_request(crystal_element))
+
+    def compute_crystal_orientation(self, crystal_element):
+        res_init = self.compute_crystal_init(crystal_element)
+        return self._stateless_compute(self._crystal_orientation_request(res_init))
+
+    def compute_grazing_orientation(self, optical_element):
+        return self._stateless_compute(self._grazing_orientation_request(optical_element))
+
+    @contextlib.contextmanager
+    def deferred_compute(self):
+        """Defer the stateless computations of the elements until the end of the block.
+
+        Several parameters of an element can be set within the block at the cost
+        of a single computation.
+
+        Examples
+        --------
+        with connection.deferred_compute():
+            crystal.h.set(2)
+            crystal.k.set(2)
+            crystal.l.set(0)
+        """
+        defer_compute = self.defer_compute
+        self.defer_compute = True
+        try:
+            yield self
+        finally:
+            self.defer_compute = defer_compute
+            self.flush_computes()
+
+    def defer(self, key, compute):
+        """Schedule ``compute()`` to be called by ``flush_computes()``.
+
+        A pending computation with the same key (e.g. of the same element) is replaced.
+        """
+        self._pending_computes[key] = compute
+
+    def has_pending_compute(self, key):
+        return key in self._pending_computes
+
+    def flush_computes(self):
+        """Call the pending (deferred) computations."""
+        while self._pending_computes:
+            key = next(iter(self._pending_computes))
+            self._pending_computes.pop(key)()
+
+    def _stateless_compute(self, request):
+        if self.compute_cache is None:
+            return self._post_json("stateless-compute", request)
+        key = self.compute_cache.key(self.sim_type, request)
+        res = self.compute_cache.get(key)
+        if res is None:
+            res = self._post_json("stateless-compute", request)
+            if self._is_cacheable_compute(res):
+                self.compute_cache.put(key, res)
+        return res
+
+    def get_datafile(self, file_index=-1, report=None, timings=None):
+        """Request the raw datafile of simulation results from the server.
+
+        The datafile of ``report`` is requested if specified, otherwise of ``data["report"]``.
+        If ``timings`` (see ``new_timings()``) is given, the time of the download
+        and the size of the datafile are added to it.
+
+        Notes
+        -----
+        Call auth() and run_simulation() before this.
+        """
+        start_time = time.monotonic()
+        response = self._request("GET", self._datafile_url(file_index, report))
+        if timings is not None:
+            timings["download"] += time.monotonic() - start_time
+            timings["download_bytes"] += len(response.content)
+        return response.content
+
+    def download_datafile(self, path, file_index=-1, chunk_size=DATAFILE_CHUNK_SIZE, hash_name=None, timings=None):
+        """Stream the raw datafile of simulation results from the server to a file.
+
+        Only one chunk of the datafile is kept in memory at a time.
+
+        Parameters
+        ----------
+        path: str or pathlib.Path
+            The file to write the datafile to. The data is first written to
+            ``<path>.part``, which is renamed to ``path`` once the download is complete.
+        file_index: int, optional
+            The index of the datafile of the report to download.
+        chunk_size: int, optional
+            The maximum number of bytes to read from the server at a time.
+        hash_name: str, optional
+            The name of a :mod:`hashlib` algorithm (e.g. "md5" or "sha256") used
+            to compute the digest of the datafile while it is written.
+        timings: dict, optional
+            The times of the download and of the writes of the datafile, and
+            its size, are added to this dict (see ``new_timings()``).
+
+        Returns
+        -------
+        path, hexdigest
+            The path of the datafile and its hexadecimal digest (None if
+            ``hash_name`` is not specified).
+
+        Notes
+        -----
+        Call auth() and run_simulation() before this.
+        """
+        start_time = time.monotonic()
+        write_time = 0.0
+        num_bytes = 0
+        h = hashlib.new(hash_name) if hash_name else None
+        part_path = f"{path}.part"
+        response = self._request("GET", self._datafile_url(file_index), stream=True)
+        try:
+            with response, open(part_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    write_start_time = time.monotonic()
+                    f.write(chunk)
+                    write_time += time.monotonic() - write_start_time
+                    num_bytes += len(chunk)
+                    if h is not None:
+                        h.update(chunk)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        os.replace(part_path, path)
+        if timings is not None:
+            timings["download"] += time.monotonic() - start_time - write_time
+            timings["write"] += write_time
+            timings["download_bytes"] += num_bytes
+        return path, (h.hexdigest() if h is not None else None)
+
+    def run_and_download(self, path=None, file_index=-1, hash_name=None, max_status_calls=1000):
+        """Run the simulation and download its datafile, reusing a cached result if possible.
+
+        If the client has a cache, the result of a simulation identical to a
+        previously finished one (same models, report and ``file_index``) is
+        taken from the cache without contacting the server. Concurrent calls
+        for identical simulations are coalesced into a single server run.
+
+        Parameters
+        ----------
+        path: str or pathlib.Path, optional
+            The file to write the datafile to. If not specified, the content of
+            the datafile is returned in memory.
+        file_index: int, optional
+            The index of the datafile of the report to download.
+        hash_name: str, optional
+            The name of a :mod:`hashlib` algorithm used to compute the digest of the datafile.
+        max_status_calls: int, optional
+            Maximum calls to check a running simulation's status.
+
+        Returns
+        -------
+        SimulationResult
+            A namedtuple with the final ``status`` of the run, its ``duration``,
+            the ``path`` or the ``content`` of the datafile, its ``hexdigest``,
+            whether the result was ``cached`` and the breakdown of its duration
+            (``timings``, see ``new_timings()``).
+        """
+        self.flush_computes()
+        self._check_runnable()
+        result = self._clean_result(path, file_index, hash_name)
+        if result is not None:
+            return result
+        if self.cache is None:
+            result = self._run_and_download(path, file_index, hash_name, max_status_calls)
+        else:
+            key = self.cache.key(self.sim_type, self.data, file_index)
+            with self.cache.lock(key):
+                result = self._cached_result(key, path, hash_name)
+                if result is None:
+                    result = self._run_and_download(path, file_index, hash_name, max_status_calls)
+                    self.cache.put(key, result.status, result.path if path is not None else result.content)
+                else:
+                    self._record_run()
+        self._last_results[(self.data["report"], file_index)] = result
+        return result
+
+    def run_reports(self, reports, file_index=-1, hash_name=None, max_status_calls=1000):
+        """Run several reports of the simulation together and download their datafiles.
+
+        The simulations of the reports are started at once, their status is
+        polled by a single ``SimulationPoller`` and their datafiles are
+        downloaded concurrently, so the reports cost about the time of the
+        longest one. As in ``run_and_download()``, the cached results and the
+        results of the reports not affected by modifications (with
+        ``skip_clean_runs``) are reused.
+
+        Parameters
+        ----------
+        reports: list of str
+            The names of the reports, e.g. ``["watchpointReport12", "beamStatisticsReport"]``.
+        file_index: int, optional
+            The index of the datafile of the reports to download.
+        hash_name: str, optional
+            The name of a :mod:`hashlib` algorithm used to compute the digest of the datafiles.
+        max_status_calls: int, optional
+            Maximum calls to check a running simulation's status.
+
+        Returns
+        -------
+        dict
+            The ``SimulationResult`` of each report, with the ``content`` of its datafile.
+        """
+        self.flush_computes()
+        current_report = self.data.get("report")
+        results = {}
+        futures = {}
+        poller = SimulationPoller(max_status_calls=max_status_calls)
+        try:
+            for report in dict.fromkeys(reports):
+                self.data["report"] = report
+                self._check_runnable()
+                results[report] = self._clean_result(None, file_index, hash_name)
+                if results[report] is None and self.cache is not None:
+                    results[report] = self._cached_result(
+                        self.cache.key(self.sim_type, self.data, file_index), None, hash_name
+                    )
+                    if results[report] is not None:
+                        self._record_run()
+                if results[report] is None:
+                    futures[report] = poller.submit(self)
+            if futures:
+                with ThreadPoolExecutor(max_workers=min(len(futures), self.pool_size)) as executor:
+                    downloads = {
+                        report: executor.submit(self._download_report, report, future, file_index, hash_name)
+                        for report, future in futures.items()
+                    }
+                    for report, download in downloads.items():
+                        results[report] = download.result()
+            for report in futures:
+                self.data["report"] = report
+                self.cache_result(results[report].status, results[report].content, file_index=file_index)
+                self._last_results[(report, file_index)] = results[report]
+        finally:
+            poller.shutdown(wait=False)
+            if current_report is None:
+                self.data.pop("report", None)
+            else:
+                self.data["report"] = current_report
+        return results
+
+    def _download_report(self, report, future, file_index, hash_name):
+        status, duration = future.result()
+        timings = future.timings
+        content = self.get_datafile(file_index=file_index, report=report, timings=timings)
+        hexdigest = hashlib.new(hash_name, content).hexdigest() if hash_name else None
+        return SimulationResult(status, duration, None, content, hexdigest, False, timings)
+
+    def _clean_result(self, path, file_index, hash_name):
+        """Return the previous result of the report if it is not affected by modifications since, or None."""
+        last_result = self._last_results.get((self.data["report"], file_index))
+        if not self.skip_clean_runs or last_result is None or self.is_modified():
+            return None
+        if last_result.content is None and not os.path.exists(last_result.path):
+            return None
+        datafile = last_result.path if last_result.content is None else last_result.content
+        result = self._copy_result(last_result.status, datafile, path, hash_name)
+        self._record_run()
+        return result
+
+    def cached_result(self, path=None, file_index=-1, hash_name=None):
+        """Return the cached result of the simulation (see ``run_and_download()``), or None."""
+        if self.cache is None:
+            return None
+        self._check_runnable()
+        key = self.cache.key(self.sim_type, self.data, file_index)
+        with self.cache.lock(key):
+            return self._cached_result(key, path, hash_name)
+
+    def cache_result(self, status, datafile, file_index=-1):
+        """Add the result of a simulation run outside of ``run_and_download()`` to the cache.
+
+        ``datafile`` is the content of the datafile or the path of a file to copy it from.
+        """
+        if self.cache is not None:
+            self.cache.put(self.cache.key(self.sim_type, self.data, file_index), status, datafile)
+
+    def _cached_result(self, key, path, hash_name):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        status, cached_datafile = entry
+        return self._copy_result(status, cached_datafile, path, hash_name)
+
+    @staticmethod
+    def _copy_result(status, datafile, path, hash_name):
+        """Make a cached result from the content (or the path) of a previously downloaded datafile."""
+        start_time = time.monotonic()
+        timings = new_timings()
+        content = None
+        if path is None:
+            if isinstance(datafile, bytes):
+                content = datafile
+            else:
+                with open(datafile, "rb") as f:
+                    content = f.read()
+            hexdigest = hashlib.new(hash_name, content).hexdigest() if hash_name else None
+        elif isinstance(datafile, bytes):
+            with open(path, "wb") as f:
+                f.write(datafile)
+            hexdigest = hashlib.new(hash_name, datafile).hexdigest() if hash_name else None
+        elif hash_name:
+            h = hashlib.new(hash_name)
+            with open(datafile, "rb") as src, open(path, "wb") as dst:
+                while chunk := src.read(DATAFILE_CHUNK_SIZE):
+                    dst.write(chunk)
+                    h.update(chunk)
+            hexdigest = h.hexdigest()
+        else:
+            shutil.copyfile(datafile, path)
+            hexdigest = None
+        duration = time.monotonic() - start_time
+        if path is not None:
+            timings["write"] = duration
+        return SimulationResult(status, duration, path, content, hexdigest, True, timings)
+
+    def _run_and_download(self, path, file_index, hash_name, max_status_calls):
+        status, duration = self.run_simulation(max_status_calls=max_status_calls)
+        timings = self.last_timings
+        if path is None:
+            content = self.get_datafile(file_index=file_index, timings=timings)
+            hexdigest = hashlib.new(hash_name, content).hexdigest() if hash_name else None
+        else:
+            content = None
+            path, hexdigest = self.download_datafile(
+                path, file_index=file_index, hash_name=hash_name, timings=timings
+            )
+        return SimulationResult(status, duration, path, content, hexdigest, False, timings)
+
+    def process_beam_parameters(self):
+        return self._stateless_compute(self._beam_parameters_request())
+
+    def process_undulator_definition(self):
+        return self._stateless_compute(self._undulator_definition_request())
+
+    def simulation_list(self):
+        """Returns a list of simulations for the authenticated user."""
+        return self._post_json("simulation-list", dict(simulationType=self.sim_type))
+
     def run_simulation(self, max_status_calls=1000):
         """Run the sirepo simulation and returns the formatted plot data.
 
+        The simulation can be cancelled from another thread with ``cancel_simulations()``.
+        The breakdown of the time of the run is kept in ``last_timings`` (see ``new_timings()``).
+
         Parameters
         ----------
         max_status_calls: int, optional
@@ -271,33 +1015,261 @@ class SirepoBluesky(object):
 
         """
         start_time = time.monotonic()
-        if not hasattr(self, "cookies"):
-            raise Exception("call auth() before run_simulation()")
-        if "report" not in self.data:
-            raise Exception("client needs to set data['report']")
-        self.data["simulationId"] = self.sim_id
-        self.data["forceRun"] = True
-        res = self._post_json("run-simulation", self.data)
-        for _ in range(max_status_calls):
-            state = res["state"]
-            if state == "completed" or state == "error":
-                break
-            if "nextRequestSeconds" not in res:
-                raise Exception(f'missing "nextRequestSeconds" in response: {res}')
-            time.sleep(res["nextRequestSeconds"])
-            res = self._post_json("run-status", res["nextRequest"])
-        if not state == "completed":
-            raise SirepoBlueskyClientException(f"simulation failed to complete: {state}")
+        res, job = self._start_simulation()
+        try:
+            for _ in range(max_status_calls):
+                if self._is_finished(res):
+                    break
+                if job["cancelled"].wait(res["nextRequestSeconds"]):
+                    break
+                res = self._post_json("run-status", res["nextRequest"])
+                self._record_status(job, res)
+        finally:
+            self._end_job(job)
+            self.last_timings = job["timings"]
+        self._assert_not_cancelled(job)
+        self._assert_completed(res)
+        self._record_run(job["run"])
         return res, time.monotonic() - start_time
 
+    def _start_simulation(self):
+        """Start the simulation of the current report, returns the response and the job of the run."""
+        self.flush_computes()
+        timings = new_timings()
+        start_time = time.monotonic()
+        request = self._run_simulation_request()
+        run = self._pending_run()
+        response = self._post("run-simulation", request)
+        res = response.json()
+        job = {
+            "report": self.data["report"],
+            "run": run,
+            "cancelled": threading.Event(),
+            "request": None,
+            "timings": timings,
+            "state": res["state"],
+            "last_response_time": time.monotonic(),
+        }
+        timings["upload"] = job["last_response_time"] - start_time
+        timings["upload_bytes"] = len(response.request.body or b"")
+        if not self._is_finished(res):
+            job["request"] = res["nextRequest"]
+            with self._jobs_lock:
+                self._active_jobs[id(job)] = job
+        return res, job
+
     @staticmethod
-    def _assert_success(response, url):
-        if not response.status_code == requests.codes.ok:
-            raise SirepoBlueskyClientException(f"{url} request failed, status: {response.status_code}")
+    def _record_status(job, res):
+        """Add the time since the previous response about the simulation of a job to its phase."""
+        now = time.monotonic()
+        timings = job["timings"]
+        if res["state"] in ("completed", "error"):
+            phase = "poll_slack"
+        elif job["state"] == "pending":
+            phase = "queue"
+        else:
+            phase = "compute"
+        timings[phase] += now - job["last_response_time"]
+        timings["status_calls"] += 1
+        job["state"] = res["state"]
+        job["last_response_time"] = now
+
+    def cancel_simulations(self, report=None, timeout=None):
+        """Cancel the running simulations started by the client (and its snapshots) on the server.
+
+        The cancel requests are sent concurrently, and the calls of
+        ``run_simulation()`` (or the futures of a ``SimulationPoller``) waiting
+        for the simulations fail with a ``SirepoBlueskyClientException``.
+        A failed cancel request is logged, as the server then finishes the
+        simulation on its own.
 
-    def _post_json(self, url, payload):
-        response = requests.post(f"{self.server}/{url}", json=payload, cookies=self.cookies)
+        Parameters
+        ----------
+        report: str, optional
+            Only cancel the simulations of this report.
+        timeout: float, optional
+            The maximum time in seconds to wait for each cancel request.
+            Default is ``cancel_timeout``.
+
+        Returns
+        -------
+        list
+            The reports of the cancelled simulations.
+        """
+        timeout = self.cancel_timeout if timeout is None else timeout
+        with self._jobs_lock:
+            jobs = [job for job in self._active_jobs.values() if report is None or job["report"] == report]
+            for job in jobs:
+                del self._active_jobs[id(job)]
+        for job in jobs:
+            job["cancelled"].set()
+        if jobs:
+            with ThreadPoolExecutor(max_workers=min(len(jobs), self.pool_size)) as executor:
+                list(executor.map(lambda job: self._cancel_job(job, timeout), jobs))
+        return [job["report"] for job in jobs]
+
+    def _cancel_job(self, job, timeout):
+        try:
+            self._post_json("run-cancel", job["request"], timeout=timeout)
+        except Exception:
+            logger.warning(f"Failed to cancel the simulation of {job['report']}", exc_info=True)
+
+    @staticmethod
+    def _assert_not_cancelled(job):
+        if job["cancelled"].is_set():
+            raise SirepoBlueskyClientException(f"simulation of {job['report']} was cancelled")
+
+    def _request(self, method, url, **kwargs):
+        """Send a request to the server, retrying transient failures of idempotent endpoints."""
+        attempts = self._attempts(url)
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            try:
+                response = self.session.request(method, f"{self.server}/{url}", cookies=self.cookies, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if last_attempt:
+                    raise
+            else:
+                if last_attempt or response.status_code not in RETRY_STATUS_CODES:
+                    break
+                response.close()
+            time.sleep(self.backoff_factor * 2**attempt)
+        if response.status_code != requests.codes.ok:
+            response.close()
         self._assert_success(response, url)
+        return response
+
+    def _post(self, url, payload, **kwargs):
+        response = self._request("POST", url, json=payload, **kwargs)
         if not self.cookies:
             self.cookies = response.cookies
-        return response.json()
+        return response
+
+    def _post_json(self, url, payload, **kwargs):
+        return self._post(url, payload, **kwargs).json()
+
+
+class SimulationPoller:
+    """
+    Poll the status of many in-flight simulations from a single background thread.
+
+    Instead of running one sleep/poll loop per simulation (as ``run_simulation()``
+    does), the submitted simulations are kept in a single queue ordered by the
+    time of their next status request, as requested by the server with
+    ``nextRequestSeconds``. The returned futures are resolved in the order in
+    which the simulations finish.
+
+    Parameters
+    ----------
+    max_status_calls: int, optional
+        Maximum calls to check a running simulation's status before its future
+        is failed. Default is 1000.
+
+    Examples
+    --------
+    poller = SimulationPoller()
+    futures = [poller.submit(copy) for copy in copies]
+    for future in concurrent.futures.as_completed(futures):
+        res, duration = future.result()
+    poller.shutdown()
+    """
+
+    def __init__(self, max_status_calls=1000):
+        self.max_status_calls = max_status_calls
+        self._queue = []  # heap of (next request time, sequence number, job)
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._shutdown = False
+
+    def submit(self, connection):
+        """Start the simulation of the connection and return a future for its result.
+
+        The simulation is started with the current data of the connection before
+        this method returns, so the data can be modified right after.
+        The result of the future is ``(res, duration)``, as returned by
+        ``SirepoBluesky.run_simulation()``, and its ``timings`` attribute is the
+        breakdown of the time of the run (see ``new_timings()``).
+        """
+        if not isinstance(connection, SirepoBluesky):
+            raise TypeError(f"Only the simulations of SirepoBluesky clients can be polled, not of {connection!r}")
+        future = Future()
+        start_time = time.monotonic()
+        res, sim_job = connection._start_simulation()
+        future.timings = sim_job["timings"]
+        job = {
+            "connection": connection,
+            "future": future,
+            "res": res,
+            "sim_job": sim_job,
+            "start_time": start_time,
+            "status_calls": 0,
+        }
+        if self._resolve(job):
+            return future
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("cannot submit simulations after shutdown")
+            self._schedule(job)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sirepo-poller", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return future
+
+    def shutdown(self, wait=True):
+        """Stop the polling thread, optionally waiting for all simulations to finish."""
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify()
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def _schedule(self, job):
+        next_request_time = time.monotonic() + job["res"]["nextRequestSeconds"]
+        heapq.heappush(self._queue, (next_request_time, next(self._counter), job))
+
+    def _resolve(self, job):
+        """Resolve the future of a finished job, returns False if the job is still running."""
+        future = job["future"]
+        connection = job["connection"]
+        try:
+            if future.cancelled():
+                connection._end_job(job["sim_job"])
+                return True
+            connection._assert_not_cancelled(job["sim_job"])
+            if not connection._is_finished(job["res"]):
+                if job["status_calls"] < self.max_status_calls:
+                    return False
+            connection._assert_completed(job["res"])
+            connection._record_run(job["sim_job"]["run"])
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result((job["res"], time.monotonic() - job["start_time"]))
+        connection._end_job(job["sim_job"])
+        return True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if not self._queue and self._shutdown:
+                        return
+                    timeout = self._queue[0][0] - time.monotonic() if self._queue else None
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+                _, _, job = heapq.heappop(self._queue)
+            if not job["future"].cancelled() and not job["sim_job"]["cancelled"].is_set():
+                try:
+                    job["res"] = job["connection"]._post_json("run-status", job["res"]["nextRequest"])
+                    job["connection"]._record_status(job["sim_job"], job["res"])
+                    job["status_calls"] += 1
+                except Exception as e:
+                    job["future"].set_exception(e)
+                    job["connection"]._end_job(job["sim_job"])
+                    continue
+            if not self._resolve(job):
+                with self._condition:
+                    self._schedule(job)
@@ -1,16 +1,15 @@
 import datetime
-import hashlib
 import os
+import shutil
 import time as ttime
 from collections import deque
-from multiprocessing import Manager, Process
 from pathlib import Path
 
 from ophyd.sim import NullStatus, new_uid
 
 from sirepo_bluesky.srw_handler import read_srw_file
 
-from .sirepo_bluesky import SirepoBluesky
+from .sirepo_bluesky import SimulationPoller, SirepoBluesky
 
 
 class BlueskyFlyer:
@@ -39,7 +38,7 @@ class BlueskyFlyer:
 
 class SirepoFlyer(BlueskyFlyer):
     """
-    Multiprocessing "flyer" for Sirepo simulations
+    Parallel "flyer" for Sirepo simulations
 
     Parameters
     ----------
@@ -62,7 +61,11 @@ class SirepoFlyer(BlueskyFlyer):
     watch_name : str, optional
         The name of the watchpoint viewing the simulation
     run_parallel : bool
-        States whether the user want to run flyer using multiprocessing or serially
+        States whether the user want to run the simulations concurrently (their
+        statuses are polled by a single ``SimulationPoller``) or serially
+    cache : sirepo_bluesky.cache.SimulationCache, optional
+        A cache of simulation results. The copies with cached results are not
+        run, and copies with identical parameters are run only once.
 
     Examples
     --------
@@ -98,6 +101,7 @@ class SirepoFlyer(BlueskyFlyer):
         sim_code="srw",
         watch_name="Watchpoint",
         run_parallel=True,
+        cache=None,
     ):
         super().__init__()
         self.name = "sirepo_flyer"
@@ -109,11 +113,16 @@ class SirepoFlyer(BlueskyFlyer):
         self._copy_count = len(self.params_to_change)
         self._watch_name = watch_name
         self._run_parallel = run_parallel
+        self._cache = cache
         self.return_status = {}
         self.return_duration = {}
         self._copies = None
         self._srw_files = None
-        self.procs = None
+        self._poller = None
+        self._futures = None
+        self._statuses = None
+        self._cached_results = None
+        self._duplicates = None
 
     def __repr__(self):
         return f'{self.name} with sim_code="{self._sim_code}" and sim_id="{self._sim_id}" at {self._server_name}'
@@ -192,7 +201,7 @@ class SirepoFlyer(BlueskyFlyer):
             raise TypeError(f"invalid type: {type(value)}. Must be boolean")
 
     def kickoff(self):
-        sb = SirepoBluesky(self.server_name)
+        sb = SirepoBluesky(self.server_name, cache=self._cache)
         data, schema = sb.auth(self.sim_code, self.sim_id)
         self._copies = []
         self._srw_files = []
@@ -256,36 +265,71 @@ class SirepoFlyer(BlueskyFlyer):
             c1.data["report"] = "watchpointReport{}".format(watch["id"])
             self._copies.append(c1)
 
+        self.return_status = {}
+        self.return_duration = {}
+        self._statuses = {}
+        self._cached_results = {}
+        self._duplicates = {}
+        if self._cache is not None:
+            keys = {}
+            for i, sim in enumerate(self._copies):
+                result = sim.cached_result(self._srw_files[i], hash_name="md5")
+                if result is not None:
+                    print(f"Using cached result for sim {sim.sim_id}")
+                    self._cached_results[i] = result
+                    self._record_status(sim, result.status, result.duration)
+                    continue
+                key = self._cache.key(sim.sim_type, sim.data)
+                if key in keys:
+                    # identical to a previous copy, reuse its result
+                    self._duplicates[i] = keys[key]
+                else:
+                    keys[key] = i
+        to_run = [i for i in range(self.copy_count) if i not in self._cached_results and i not in self._duplicates]
+
         if self.run_parallel:
-            manager = Manager()
-            self.return_status = manager.dict()
-            self.return_duration = manager.dict()
-            self.procs = []
-
-            for i in range(self.copy_count):
-                p = Process(
-                    target=self._run,
-                    args=(self._copies[i], self.return_status, self.return_duration),
-                )
-                p.start()
-                self.procs.append(p)
-            # wait for procs to finish
-            # for p in self.procs:
-            #     p.join()
+            self._poller = SimulationPoller()
+            self._futures = {}
+            for i in to_run:
+                print(f"running sim {self._copies[i].sim_id}")
+                self._futures[i] = self._poller.submit(self._copies[i])
         else:
             # run serial
-            for i in range(self.copy_count):
+            for i in to_run:
                 print(f"running sim: {self._copies[i].sim_id}")
                 status, duration = self._copies[i].run_simulation()
-                print(f"Status of sim {self._copies[i].sim_id}: {status['state']} in {duration:.01f} seconds")
-                self.return_status[self._copies[i].sim_id] = status["state"]
-                self.return_duration[self._copies[i].sim_id] = duration
+                self._statuses[i] = status
+                self._record_status(self._copies[i], status, duration)
         return NullStatus()
 
+    def stop(self, *, success=False):
+        """Cancel the simulations of the copies still running on the server."""
+        if success or not self._copies:
+            return
+        for sim in self._copies:
+            for _ in sim.cancel_simulations():
+                print(f"cancelled sim {sim.sim_id}")
+        if self._poller is not None:
+            self._poller.shutdown(wait=False)
+
+    def pause(self):
+        self.stop(success=False)
+
+    def _record_status(self, sim, status, duration):
+        print(f"Status of sim {sim.sim_id}: {status['state']} in {duration:.01f} seconds")
+        self.return_status[sim.sim_id] = status["state"]
+        self.return_duration[sim.sim_id] = duration
+
     def complete(self, *args, **kwargs):
         if self.run_parallel:
-            for p in self.procs:
-                p.join()
+            for i, future in self._futures.items():
+                status, duration = future.result()
+                self._statuses[i] = status
+                self._record_status(self._copies[i], status, duration)
+            self._poller.shutdown()
+        for i, j in self._duplicates.items():
+            self._statuses[i] = self._statuses[j]
+            self._record_status(self._copies[i], self._statuses[j], self.return_duration[self._copies[j].sim_id])
         for i in range(len(self._copies)):
             datum_id = self._resource_uids[i]
             datum = {
@@ -376,10 +420,18 @@ class SirepoFlyer(BlueskyFlyer):
         horizontal_extents = []
         vertical_extents = []
         hash_values = []
+        # The simulations may finish in any order, match the results by simulation id.
+        statuses = [self.return_status[sim.sim_id] for sim in self._copies]
+        durations = [self.return_duration[sim.sim_id] for sim in self._copies]
         for i in range(len(self._copies)):
-            data_file = self._copies[i].get_datafile()
-            with open(self._srw_files[i], "wb") as f:
-                f.write(data_file)
+            if i in self._cached_results:
+                hash_value = self._cached_results[i].hexdigest
+            elif i in self._duplicates:
+                shutil.copyfile(self._srw_files[self._duplicates[i]], self._srw_files[i])
+                hash_value = hash_values[self._duplicates[i]]
+            else:
+                _, hash_value = self._copies[i].download_datafile(self._srw_files[i], hash_name="md5")
+                self._copies[i].cache_result(self._statuses[i], self._srw_files[i])
 
             ret = read_srw_file(self._srw_files[i])
             means.append(ret["mean"])
@@ -387,14 +439,11 @@ class SirepoFlyer(BlueskyFlyer):
             photon_energies.append(ret["photon_energy"])
             horizontal_extents.append(ret["horizontal_extent"])
             vertical_extents.append(ret["vertical_extent"])
-            hash_values.append(hashlib.md5(data_file).hexdigest())
+            hash_values.append(hash_value)
 
             print(f"copy {self._copies[i].sim_id} data hash: {hash_values[i]}")
             self._copies[i].delete_copy()
 
-        statuses = [status for sim, status in self.return_status.items()]
-        durations = [duration for sim, duration in self.return_duration.items()]
-
         if not len(self._copies) == len(self._datum_ids):
             raise Exception(
                 f"len(self._copies) != len(self._datum_ids) \
@@ -432,12 +481,3 @@ class SirepoFlyer(BlueskyFlyer):
                 "time": now,
                 "filled": {key: False for key in data},
             }
-
-    @staticmethod
-    def _run(sim, return_status, return_duration):
-        """Run simulations using multiprocessing."""
-        print(f"running sim {sim.sim_id}")
-        status, duration = sim.run_simulation()
-        print(f"Status of sim {sim.sim_id}: {status['state']} in {duration:.01f} seconds")
-        return_status[sim.sim_id] = status["state"]
-        return_duration[sim.sim_id] = duration
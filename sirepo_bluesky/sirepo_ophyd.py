@@ -1,23 +1,33 @@
 import copy
 import datetime
-import hashlib
+import itertools
 import json
 import logging
+import os
+import threading
 import time
 from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import inflection
 from event_model import compose_resource
 from ophyd import Component as Cpt
-from ophyd import Device, Signal
+from ophyd import Device, DeviceStatus, Kind, Signal
 from ophyd.sim import NullStatus, new_uid
 
-from sirepo_bluesky.sirepo_bluesky import SirepoBluesky
+from sirepo_bluesky.sirepo_bluesky import (
+    RUN_CONTROL_FIELDS,
+    TIMING_COUNTS,
+    TIMING_PHASES,
+    SirepoBluesky,
+    new_timings,
+)
 
-from . import ExternalFileReference
-from .shadow_handler import read_shadow_file
-from .srw_handler import read_srw_file
+from . import ExternalFileReference, utils
+from .hdf5_handler import HDF5FrameWriter
+from .shadow_handler import PHASE_SPACE_PROJECTIONS, read_shadow_buffer, stored_ray_columns, write_ray_columns
+from .srw_handler import read_srw_buffer
 
 logger = logging.getLogger("sirepo-bluesky")
 # Note: the following handler could be created/added to the logger on the client side:
@@ -32,24 +42,69 @@ RESERVED_OPHYD_TO_SIREPO_ATTRS = {  # ophyd <-> sirepo
 }
 RESERVED_SIREPO_TO_OPHYD_ATTRS = {v: k for k, v in RESERVED_OPHYD_TO_SIREPO_ATTRS.items()}
 
+# The signals of the breakdown of the duration of a trigger (see DeviceWithJSONData.timings):
+TIMING_SIGNALS = {phase: f"{phase}_time" for phase in (*TIMING_PHASES, "parse", "stats")}
+TIMING_SIGNALS.update({count: count for count in TIMING_COUNTS})
+
+# The simulations of the devices are run (and their results parsed) in these threads:
+TRIGGER_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix="sirepo-trigger")
+# The datafiles parsed in memory are written to the assets directory in these threads:
+ASSET_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="sirepo-asset")
+# The layouts of the assets of the watchpoints (see SirepoWatchpoint):
+ASSET_FORMATS = ("dat", "hdf5")
+# The phase-space products of the Shadow3 watchpoints (see SirepoWatchpoint):
+PHASE_SPACE_PRODUCTS = (*PHASE_SPACE_PROJECTIONS, "moments")
+# The number of the regions of interest of the watchpoints (roi1, roi2, ...):
+ROI_COUNT = 4
+
+
+def write_datafile(path, content):
+    """Write the content of a datafile to ``path``, creating its directory if needed.
+
+    The content is first written to ``<path>.part``, which is renamed to ``path`` once complete.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    part_path = path.with_name(f"{path.name}.part")
+    part_path.write_bytes(content)
+    os.replace(part_path, path)
+
 
 class SirepoSignal(Signal):
-    def __init__(self, sirepo_dict, sirepo_param, *args, **kwargs):
+    def __init__(self, sirepo_dict, sirepo_param, *args, connection=None, **kwargs):
         super().__init__(*args, **kwargs)
         self._sirepo_dict = sirepo_dict
         self._sirepo_param = sirepo_param
+        self._sirepo_connection = connection
         if sirepo_param in RESERVED_SIREPO_TO_OPHYD_ATTRS:
             self._sirepo_param = RESERVED_SIREPO_TO_OPHYD_ATTRS[sirepo_param]
 
+    @property
+    def sirepo_connection(self):
+        """The connection of the simulation whose data the signal modifies, if known."""
+        if self._sirepo_connection is not None:
+            return self._sirepo_connection
+        return getattr(self.parent, "connection", None)
+
     def set(self, value, *, timeout=None, settle_time=None):
         logger.debug(f"Setting value for {self.name} to {value}")
         self._sirepo_dict[self._sirepo_param] = value
         self._readback = value
+        connection = self.sirepo_connection
+        if connection is not None:
+            connection.mark_modified(self._sirepo_dict, self._sirepo_param)
         return NullStatus()
 
     def put(self, *args, **kwargs):
         self.set(*args, **kwargs).wait()
 
+    def get(self, **kwargs):
+        # Make sure the parameters computed from deferred sets are up to date.
+        connection = self.sirepo_connection
+        if connection is not None and connection.has_pending_compute(id(self._sirepo_dict)):
+            connection.flush_computes()
+        return super().get(**kwargs)
+
 
 class ReadOnlyException(Exception):
     ...
@@ -61,22 +116,273 @@ class SirepoSignalRO(SirepoSignal):
 
 
 class DeviceWithJSONData(Device):
-    sirepo_data_json = Cpt(Signal, kind="normal", value="")
+    """
+    Base of the devices running a report of a simulation.
+
+    The data of the simulation used by a trigger is identified by
+    ``sirepo_data_hash`` (see ``SirepoBluesky.data_hash()``). The full JSON
+    document is only written (to ``<root_dir>/sirepo_data/<hash>.json``) and
+    recorded as a "SIREPO_DATA_JSON" resource when the hash changes during a
+    run, and ``sirepo_data_json`` is the datum of the document (read by
+    ``sirepo_bluesky.json_handler.SirepoDataJSONHandler``).
+    """
+
+    sirepo_data_json = Cpt(ExternalFileReference, kind="normal", dtype="string")
     sirepo_data_hash = Cpt(Signal, kind="normal", value="")
     duration = Cpt(Signal, kind="normal", value=-1.0)
+    cached = Cpt(Signal, kind="omitted", value=False)
+    modified = Cpt(Signal, kind="omitted", value="")
+
+    # The breakdown of the duration of the last trigger, see ``timings``:
+    upload_time = Cpt(Signal, kind="omitted", value=0.0)
+    queue_time = Cpt(Signal, kind="omitted", value=0.0)
+    compute_time = Cpt(Signal, kind="omitted", value=0.0)
+    poll_slack_time = Cpt(Signal, kind="omitted", value=0.0)
+    download_time = Cpt(Signal, kind="omitted", value=0.0)
+    write_time = Cpt(Signal, kind="omitted", value=0.0)
+    parse_time = Cpt(Signal, kind="omitted", value=0.0)
+    stats_time = Cpt(Signal, kind="omitted", value=0.0)
+    status_calls = Cpt(Signal, kind="omitted", value=0)
+    # The sizes don't change during a scan in general:
+    upload_bytes = Cpt(Signal, kind="config", value=0)
+    download_bytes = Cpt(Signal, kind="config", value=0)
+
+    report_group = None
+    report_name = None
+    _trigger_status = None
+    _trigger_round = None  # the token of the trigger round of the report group, see SirepoReportGroup
+
+    def __init__(self, *args, root_dir="/tmp/sirepo-bluesky-data", **kwargs):
+        super().__init__(*args, **kwargs)
+        self._root_dir = root_dir
+        self._asset_docs_cache = deque()
+        self._json_record = None  # (hash, datum id) of the data recorded in the current run
 
     def trigger(self, *args, **kwargs):
+        """Run the report of the device in the background, the status finishes once the signals are updated."""
         super().trigger(*args, **kwargs)
 
-        json_str = json.dumps(self.connection.data)
-        json_hash = hashlib.sha256(json_str.encode()).hexdigest()
-        self.sirepo_data_json.put(json_str)
+        if self.report_name is not None:
+            self.connection.data["report"] = self.report_name
+        # The simulation runs with a snapshot of the data, which can be modified
+        # (e.g. by the next step of a plan) in the meantime.
+        connection = self.connection.snapshot()
+        if self.report_group is not None:
+            self._trigger_round = self.report_group.trigger_round(self)
+        status = DeviceStatus(self)
+
+        def run():
+            try:
+                self._trigger(connection)
+            except Exception as e:
+                logger.exception(f"Trigger of {self.name} failed")
+                status.set_exception(e)
+            else:
+                status.set_finished()
+
+        self._trigger_status = status
+        TRIGGER_EXECUTOR.submit(run)
+        return status
+
+    def read(self):
+        if self.report_group is not None:
+            # The devices of the group triggered in the current step are read once they are all triggered.
+            self.report_group.end_round()
+        return super().read()
+
+    def cancel_trigger(self):
+        """Cancel the simulation of a trigger in progress on the server.
+
+        The status of the trigger then fails. This is done when the device is
+        paused, stopped or unstaged (e.g. by the RunEngine when a scan is
+        paused, aborted or halted), so that the server is not kept busy.
+        Returns the reports of the cancelled simulations.
+        """
+        status = self._trigger_status
+        if status is None or status.done or self.report_name is None:
+            return []
+        reports = self.connection.cancel_simulations(report=self.report_name)
+        if reports:
+            logger.info(f"Cancelled the simulation of {self.name}")
+        return reports
+
+    def pause(self):
+        super().pause()
+        self.cancel_trigger()
+
+    def stop(self, *, success=False):
+        super().stop(success=success)
+        if not success:
+            self.cancel_trigger()
+
+    def stage(self):
+        # The documents of the data recorded in a previous run can't be referenced.
+        self._json_record = None
+        # The data may have been modified without mark_modified() since the previous run.
+        self.connection.reset_data_hash()
+        return super().stage()
+
+    def unstage(self):
+        self.cancel_trigger()
+        self._json_record = None
+        return super().unstage()
+
+    def collect_asset_docs(self):
+        items = list(self._asset_docs_cache)
+        self._asset_docs_cache.clear()
+        for item in items:
+            yield item
+
+    def _trigger(self, connection):
+        """Run the simulation of the snapshot ``connection`` and update the signals of the device."""
+        self._update_json_data(connection)
+
+    def _update_json_data(self, connection):
+        json_hash = connection.data_hash()
+        if self._json_record is None or self._json_record[0] != json_hash:
+            resource_path = Path("sirepo_data") / f"{json_hash}.json"
+            path = Path(self._root_dir) / resource_path
+            if not path.exists():
+                path.parent.mkdir(parents=True, exist_ok=True)
+                part_path = path.with_suffix(f".{threading.get_ident()}.part")
+                data = {key: value for key, value in connection.data.items() if key not in RUN_CONTROL_FIELDS}
+                part_path.write_text(json.dumps(data))
+                os.replace(part_path, path)
+
+            resource_document, datum_factory, _ = compose_resource(
+                start={"uid": "needed for compose_resource() but will be discarded"},
+                spec="SIREPO_DATA_JSON",
+                root=self._root_dir,
+                resource_path=str(resource_path),
+                resource_kwargs={},
+            )
+            resource_document.pop("run_start")
+            datum_document = datum_factory(datum_kwargs={})
+            self._asset_docs_cache.append(("resource", resource_document))
+            self._asset_docs_cache.append(("datum", datum_document))
+            self._json_record = (json_hash, datum_document["datum_id"])
+
+        self.sirepo_data_json.put(self._json_record[1])
         self.sirepo_data_hash.put(json_hash)
 
-        return NullStatus()
+    def _run_report(self, connection, path=None):
+        """Run the report of the device (or get its result from the report group) and download its datafile."""
+        if self.report_group is None:
+            return connection.run_and_download(path, file_index=-1)
+        result = self.report_group.result(self, connection, self._trigger_round)
+        if path is not None:
+            copied = connection._copy_result(result.status, result.content, path, None)
+            timings = dict(result.timings, write=result.timings["write"] + copied.timings["write"])
+            result = copied._replace(duration=result.duration, cached=result.cached, timings=timings)
+        return result
+
+    def _update_from_result(self, connection, result):
+        """Record the duration of a run, whether its result was taken from the cache and the modified models."""
+        self.duration.put(result.duration)
+        self.cached.put(result.cached)
+        self.modified.put(json.dumps(connection.last_run_modified))
+        self._update_timings(dict(result.timings or new_timings(), parse=0.0, stats=0.0))
+        if connection.cache is not None:
+            logger.debug(f"Result cache for {self.name}: cached={result.cached}, {connection.cache.stats()}")
+
+    def _update_timings(self, timings):
+        for key, value in timings.items():
+            getattr(self, TIMING_SIGNALS[key]).put(value)
+
+    @property
+    def timings(self):
+        """The breakdown of the duration of the last trigger.
+
+        The keys are described in ``sirepo_bluesky.sirepo_bluesky.new_timings()``,
+        with the times spent parsing the datafile ("parse") and computing the
+        statistics of the beam ("stats") in addition.
+        """
+        return {key: getattr(self, name).get() for key, name in TIMING_SIGNALS.items()}
+
+
+class RayHistogram(Device):
+    """A histogram of the rays of a Shadow3 watchpoint, with its extent in the units of the rays."""
+
+    histogram = Cpt(Signal)
+    extent = Cpt(Signal)
+
+
+class BeamMoments(Device):
+    """The second moments of the rays of a Shadow3 watchpoint, see ``shadow_handler.beam_moments()``."""
+
+    sigma_x = Cpt(Signal)
+    sigma_xp = Cpt(Signal)
+    cov_x_xp = Cpt(Signal)
+    emittance_x = Cpt(Signal)
+    sigma_z = Cpt(Signal)
+    sigma_zp = Cpt(Signal)
+    cov_z_zp = Cpt(Signal)
+    emittance_z = Cpt(Signal)
+
+
+class WatchpointROI(Device):
+    """The statistics of the beam in a region of interest of a watchpoint, see ``utils.get_roi_stats()``."""
+
+    flux = Cpt(Signal, kind="hinted")
+    x = Cpt(Signal, kind="hinted")
+    y = Cpt(Signal, kind="hinted")
+    fwhm_x = Cpt(Signal, kind="hinted")
+    fwhm_y = Cpt(Signal, kind="hinted")
+    region = Cpt(Signal, kind="config")
 
 
 class SirepoWatchpoint(DeviceWithJSONData):
+    """
+    A watchpoint of a Sirepo simulation.
+
+    The datafiles are parsed from the memory and written to ``root_dir`` in
+    the background (see ``flush_assets()``), so the writes are not part of the
+    triggers.
+
+    Parameters
+    ----------
+    root_dir : str, optional
+        The directory of the assets of the device.
+    asset_format : {"dat", "hdf5"}, optional
+        With "dat", the datafile of each trigger is kept as a resource. With
+        "hdf5", the images of the triggers between ``stage()`` and
+        ``unstage()`` are written to a single HDF5 file (see
+        ``sirepo_bluesky.hdf5_handler``), recorded as one "SIREPO_HDF5"
+        resource with a datum per frame, and the datafiles are not kept.
+    image_dtype : str or numpy.dtype, optional
+        The data type of the images stored in the HDF5 files (e.g. "float32").
+    npy_sidecars : bool, optional
+        With the "dat" asset format, also write the image read from each
+        datafile to a ``.npy`` sidecar (see ``sirepo_bluesky.utils.write_sidecar()``),
+        which the handlers memory-map instead of parsing the datafile again.
+    ray_columns : sequence of int, optional
+        With the "dat" asset format, also write these columns of the rays of
+        the Shadow3 datafiles (e.g. ``sirepo_bluesky.shadow_handler.DEFAULT_RAY_COLUMNS``)
+        to a columnar ``.rays.npy`` file (see ``sirepo_bluesky.shadow_handler.write_ray_columns()``),
+        which the handler histograms with the bins, ranges and columns requested at read time.
+    ray_dtype : str or numpy.dtype, optional
+        The data type of the stored columns of the rays (e.g. "float32").
+    phase_space : sequence of str, optional
+        The phase-space products of the Shadow3 watchpoints to compute from
+        the rays of each datafile, among ``PHASE_SPACE_PRODUCTS``: the
+        weighted histograms "x_z", "x_xp", "z_zp" and "energy" (see
+        ``sirepo_bluesky.shadow_handler.PHASE_SPACE_PROJECTIONS``), read as
+        the ``histogram`` and ``extent`` of the component of the same name,
+        and the second moments of the beam "moments". The components of the
+        other products are not read.
+    phase_space_bins : int, optional
+        The number of bins of the phase-space histograms, the
+        ``histogramBins`` of the report by default.
+    rois : sequence, optional
+        Up to ``ROI_COUNT`` rectangular regions of interest of the images, as
+        ``(x_min, x_max, y_min, y_max)`` in the units of
+        ``horizontal_extent`` and ``vertical_extent``. The flux, centroid and
+        FWHM of the beam in the ROIs are computed at once (see
+        ``sirepo_bluesky.utils.get_roi_stats()``) and read from the hinted
+        signals of the components ``roi1``, ``roi2``, etc. The region of each
+        ROI is a configuration signal, and the unused components are not read.
+    """
+
     image = Cpt(ExternalFileReference, kind="normal")
     shape = Cpt(Signal)
     flux = Cpt(Signal, kind="hinted")
@@ -89,23 +395,67 @@ class SirepoWatchpoint(DeviceWithJSONData):
     horizontal_extent = Cpt(Signal)
     vertical_extent = Cpt(Signal)
 
+    x_z = Cpt(RayHistogram, kind="omitted")
+    x_xp = Cpt(RayHistogram, kind="omitted")
+    z_zp = Cpt(RayHistogram, kind="omitted")
+    energy = Cpt(RayHistogram, kind="omitted")
+    moments = Cpt(BeamMoments, kind="omitted")
+
+    roi1 = Cpt(WatchpointROI, kind="omitted")
+    roi2 = Cpt(WatchpointROI, kind="omitted")
+    roi3 = Cpt(WatchpointROI, kind="omitted")
+    roi4 = Cpt(WatchpointROI, kind="omitted")
+
     def __init__(
         self,
         *args,
         root_dir="/tmp/sirepo-bluesky-data",
         assets_dir=None,
         result_file=None,
+        asset_format="dat",
+        image_dtype="float64",
+        npy_sidecars=False,
+        ray_columns=None,
+        ray_dtype="float64",
+        phase_space=(),
+        phase_space_bins=None,
+        rois=(),
         **kwargs,
     ):
-        super().__init__(*args, **kwargs)
+        if asset_format not in ASSET_FORMATS:
+            raise ValueError(f"Unknown asset format: {asset_format!r}\nAllowed asset formats: {ASSET_FORMATS}")
+        unknown_products = set(phase_space) - set(PHASE_SPACE_PRODUCTS)
+        if unknown_products:
+            raise ValueError(
+                f"Unknown phase-space products: {sorted(unknown_products)}\n"
+                f"Allowed phase-space products: {PHASE_SPACE_PRODUCTS}"
+            )
+        rois = [tuple(float(bound) for bound in region) for region in rois]
+        if len(rois) > ROI_COUNT:
+            raise ValueError(f"At most {ROI_COUNT} ROIs are supported, got {len(rois)}")
+        for region in rois:
+            if len(region) != 4 or region[0] > region[1] or region[2] > region[3]:
+                raise ValueError(f"Invalid ROI: {region}, expected (x_min, x_max, y_min, y_max)")
+        if rois and self.ndim != 2:
+            raise ValueError(f"The ROIs are computed for images, not for data of {self.ndim} dimension(s)")
+        super().__init__(*args, root_dir=root_dir, **kwargs)
 
-        self._root_dir = root_dir
         self._assets_dir = assets_dir
         self._result_file = result_file
 
-        self._asset_docs_cache = deque()
         self._resource_document = None
         self._datum_factory = None
+        self._asset_writes = []
+        self._asset_format = asset_format
+        self._image_dtype = image_dtype
+        self._npy_sidecars = npy_sidecars
+        self._ray_columns = tuple(ray_columns) if ray_columns is not None else None
+        self._ray_dtype = ray_dtype
+        self._phase_space = tuple(phase_space)
+        self._phase_space_bins = phase_space_bins
+        self._rois = rois
+        self._container = None  # (writer, datum factory, frame numbers) of the HDF5 file of the images
+        self._container_lock = threading.Lock()
 
         sim_type = self.connection.data["simulationType"]
         allowed_sim_types = ("srw", "shadow", "madx")
@@ -113,161 +463,222 @@ class SirepoWatchpoint(DeviceWithJSONData):
             raise RuntimeError(
                 f"Unknown simulation type: {sim_type}\nAllowed simulation types: {allowed_sim_types}"
             )
+        if self._phase_space and sim_type != "shadow":
+            raise ValueError(f"The phase-space products are computed for Shadow3 simulations, not {sim_type}")
+        for name in self._phase_space:
+            getattr(self, name).kind = Kind.normal
+        for roi, region in zip(self._roi_devices(), self._rois):
+            roi.kind = Kind.normal
+            roi.region.put(list(region))
 
-    def trigger(self, *args, **kwargs):
-        logger.debug(f"Custom trigger for {self.name}")
+    @property
+    def report_name(self):
+        return f"watchpointReport{self.id._sirepo_dict['id']}"
 
-        date = datetime.datetime.now()
-        self._assets_dir = date.strftime("%Y/%m/%d")
-        self._result_file = f"{new_uid()}.dat"
+    ndim = 2  # the dimensions of the data of the SRW reports
 
-        self._resource_document, self._datum_factory, _ = compose_resource(
-            start={"uid": "needed for compose_resource() but will be discarded"},
-            spec=self.connection.data["simulationType"],
-            root=self._root_dir,
-            resource_path=str(Path(self._assets_dir) / Path(self._result_file)),
-            resource_kwargs={},
-        )
-        # now discard the start uid, a real one will be added later
-        self._resource_document.pop("run_start")
-        self._asset_docs_cache.append(("resource", self._resource_document))
+    def _trigger(self, connection):
+        logger.debug(f"Custom trigger for {self.name}")
 
-        sim_result_file = str(
-            Path(self._resource_document["root"]) / Path(self._resource_document["resource_path"])
-        )
+        ret, read_timings = self._read_report(connection)
 
-        self.connection.data["report"] = f"watchpointReport{self.id._sirepo_dict['id']}"
+        self._update_components(ret)
+        self._update_timings(read_timings)
 
-        _, duration = self.connection.run_simulation()
-        self.duration.put(duration)
+        logger.debug(f"\nReport for {self.name}: {connection.data['report']}\n")
 
-        datafile = self.connection.get_datafile(file_index=-1)
+        # We update the sirepo_data_json and the corresponding hash after the simulation is run.
+        self._update_json_data(connection)
 
-        with open(sim_result_file, "wb") as f:
-            f.write(datafile)
+    def _read_report(self, connection):
+        """Run the report, read its datafile and compose its resource, returns the read data and timings."""
+        result = self._run_report(connection)
+        self._update_from_result(connection, result)
 
-        conn_data = self.connection.data
+        conn_data = connection.data
         sim_type = conn_data["simulationType"]
+        read_timings = {}
         if sim_type == "srw":
-            ndim = 2  # this will always be a report with 2D data.
-            ret = read_srw_file(sim_result_file, ndim=ndim)
-            self._resource_document["resource_kwargs"]["ndim"] = ndim
+            ret = read_srw_buffer(result.content, ndim=self.ndim, timings=read_timings)
+            resource_kwargs = {"ndim": self.ndim}
         elif sim_type == "shadow":
             nbins = conn_data["models"][conn_data["report"]]["histogramBins"]
-            ret = read_shadow_file(sim_result_file, histogram_bins=nbins)
-            self._resource_document["resource_kwargs"]["histogram_bins"] = nbins
-
-        def update_components(_data):
-            self.shape.put(_data["shape"])
-            self.flux.put(_data["flux"])
-            self.mean.put(_data["mean"])
-            self.x.put(_data["x"])
-            self.y.put(_data["y"])
-            self.fwhm_x.put(_data["fwhm_x"])
-            self.fwhm_y.put(_data["fwhm_y"])
-            self.photon_energy.put(_data["photon_energy"])
-            self.horizontal_extent.put(_data["horizontal_extent"])
-            self.vertical_extent.put(_data["vertical_extent"])
-
-        update_components(ret)
-
-        datum_document = self._datum_factory(datum_kwargs={})
-        self._asset_docs_cache.append(("datum", datum_document))
-
-        self.image.put(datum_document["datum_id"])
-
-        self._resource_document = None
-        self._datum_factory = None
-
-        logger.debug(f"\nReport for {self.name}: {self.connection.data['report']}\n")
-
-        # We call the trigger on super at the end to update the sirepo_data_json
-        # and the corresponding hash after the simulation is run.
-        super().trigger(*args, **kwargs)
-        return NullStatus()
-
-    def describe(self):
-        res = super().describe()
-        res[self.image.name].update(dict(external="FILESTORE"))
-        return res
-
-    def unstage(self):
-        super().unstage()
-        self._resource_document = None
+            ret = read_shadow_buffer(
+                result.content,
+                histogram_bins=nbins,
+                timings=read_timings,
+                phase_space=self._phase_space,
+                phase_space_bins=self._phase_space_bins,
+            )
+            resource_kwargs = {"histogram_bins": nbins}
+            if self._ray_columns is not None:
+                resource_kwargs["ray_columns"] = list(stored_ray_columns(self._ray_columns))
+
+        if self._rois:
+            start_time = time.monotonic()
+            ret["rois"] = utils.get_roi_stats(
+                ret["data"], ret["horizontal_extent"], ret["vertical_extent"], self._rois
+            )
+            read_timings["stats"] += time.monotonic() - start_time
+
+        if self._asset_format == "dat":
+            sim_result_file = self._compose_resource(connection)
+            self._resource_document["resource_kwargs"].update(resource_kwargs)
+            self._write_asset(sim_result_file, result.content)
+            if self._npy_sidecars:
+                self._asset_writes.append(ASSET_EXECUTOR.submit(utils.write_sidecar, sim_result_file, ret["data"]))
+            if "ray_columns" in resource_kwargs:
+                self._asset_writes.append(
+                    ASSET_EXECUTOR.submit(
+                        write_ray_columns, sim_result_file, ret["rays"], self._ray_columns, self._ray_dtype
+                    )
+                )
+        return ret, read_timings
 
-    def collect_asset_docs(self):
-        items = list(self._asset_docs_cache)
-        self._asset_docs_cache.clear()
-        for item in items:
-            yield item
+    def _write_asset(self, path, content):
+        """Write the content of a datafile to ``path`` in the background."""
+        self._asset_writes.append(ASSET_EXECUTOR.submit(write_datafile, path, content))
 
+    def flush_assets(self, timeout=None):
+        """Wait until the datafiles of the previous triggers are written.
 
-class SingleElectronSpectrumReport(SirepoWatchpoint):
-    def trigger(self, *args, **kwargs):
-        logger.debug(f"Custom trigger for {self.name}")
+        This is done when the device is unstaged, so that the datafiles
+        referenced by the documents of a run exist at its end.
+        """
+        writes, self._asset_writes = self._asset_writes, []
+        for future in writes:
+            future.result(timeout=timeout)
 
+    def _datafile_path(self, suffix=".dat"):
+        """A new path of an asset, relative to ``root_dir``."""
         date = datetime.datetime.now()
         self._assets_dir = date.strftime("%Y/%m/%d")
-        self._result_file = f"{new_uid()}.dat"
+        self._result_file = f"{new_uid()}{suffix}"
+        return Path(self._assets_dir) / Path(self._result_file)
 
+    def _compose_resource(self, connection):
+        """Compose the resource document of the datafile, returns the path of the datafile."""
         self._resource_document, self._datum_factory, _ = compose_resource(
             start={"uid": "needed for compose_resource() but will be discarded"},
-            spec=self.connection.data["simulationType"],
+            spec=connection.data["simulationType"],
             root=self._root_dir,
-            resource_path=str(Path(self._assets_dir) / Path(self._result_file)),
+            resource_path=str(self._datafile_path()),
             resource_kwargs={},
         )
         # now discard the start uid, a real one will be added later
         self._resource_document.pop("run_start")
         self._asset_docs_cache.append(("resource", self._resource_document))
 
-        sim_result_file = str(
-            Path(self._resource_document["root"]) / Path(self._resource_document["resource_path"])
+        return str(Path(self._resource_document["root"]) / Path(self._resource_document["resource_path"]))
+
+    def _open_container(self):
+        """Create a new HDF5 file for the images of the next triggers and compose its resource."""
+        self._close_container()
+        resource_path = self._datafile_path(suffix=".h5")
+        path = Path(self._root_dir) / resource_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        writer = HDF5FrameWriter(path, dtype=self._image_dtype)
+        resource_document, datum_factory, _ = compose_resource(
+            start={"uid": "needed for compose_resource() but will be discarded"},
+            spec="SIREPO_HDF5",
+            root=self._root_dir,
+            resource_path=str(resource_path),
+            resource_kwargs={},
         )
+        resource_document.pop("run_start")
+        self._asset_docs_cache.append(("resource", resource_document))
+        self._container = (writer, datum_factory, itertools.count())
+
+    def _close_container(self):
+        if self._container is None:
+            return
+        try:
+            self.flush_assets()
+        finally:
+            self._container[0].close()
+            self._container = None
+
+    def _record_image(self, data):
+        """Compose the datum of the image of a trigger, returns its id.
+
+        With the "hdf5" asset format, the image is written to the HDF5 file in
+        the background, as the frame ``point_number`` of the datum. The file is
+        created at the first trigger if the device is not staged.
+        """
+        if self._asset_format == "hdf5":
+            with self._container_lock:
+                if self._container is None:
+                    self._open_container()
+                writer, datum_factory, frame_numbers = self._container
+                point_number = next(frame_numbers)
+            self._asset_writes.append(ASSET_EXECUTOR.submit(writer.write_frame, point_number, data))
+            datum_document = datum_factory(datum_kwargs={"point_number": point_number})
+        else:
+            datum_document = self._datum_factory(datum_kwargs={})
+            self._resource_document = None
+            self._datum_factory = None
+        self._asset_docs_cache.append(("datum", datum_document))
+        return datum_document["datum_id"]
+
+    def _update_components(self, _data):
+        self.shape.put(_data["shape"])
+        self.flux.put(_data["flux"])
+        self.mean.put(_data["mean"])
+        self.x.put(_data["x"])
+        self.y.put(_data["y"])
+        self.fwhm_x.put(_data["fwhm_x"])
+        self.fwhm_y.put(_data["fwhm_y"])
+        self.photon_energy.put(_data["photon_energy"])
+        self.horizontal_extent.put(_data["horizontal_extent"])
+        self.vertical_extent.put(_data["vertical_extent"])
+        self.image.put(self._record_image(_data["data"]))
+        for name, (histogram, extent) in _data.get("phase_space", {}).items():
+            getattr(self, name).histogram.put(histogram)
+            getattr(self, name).extent.put(extent)
+        for key, value in _data.get("moments", {}).items():
+            getattr(self.moments, key).put(value)
+        for i, roi in enumerate(self._roi_devices() if "rois" in _data else ()):
+            for key, values in _data["rois"].items():
+                getattr(roi, key).put(values[i])
+
+    def _roi_devices(self):
+        """The components of the configured ROIs."""
+        return [getattr(self, f"roi{i + 1}") for i in range(len(self._rois))]
 
-        self.connection.data["report"] = "intensityReport"
+    def describe(self):
+        res = super().describe()
+        res[self.image.name].update(dict(external="FILESTORE"))
+        return res
 
-        start_time = time.monotonic()
-        self.connection.run_simulation()
-        self.duration.put(time.monotonic() - start_time)
+    def stage(self):
+        if self._asset_format == "hdf5":
+            with self._container_lock:
+                self._open_container()
+        return super().stage()
 
-        datafile = self.connection.get_datafile()
+    def unstage(self):
+        super().unstage()
+        self._resource_document = None
+        if self.report_group is not None:
+            self.report_group.clear()
+        self.flush_assets()
+        with self._container_lock:
+            self._close_container()
 
-        with open(sim_result_file, "wb") as f:
-            f.write(datafile)
 
-        conn_data = self.connection.data
-        sim_type = conn_data["simulationType"]
-        if sim_type == "srw":
-            ndim = 1
-            ret = read_srw_file(sim_result_file, ndim=ndim)
-            self._resource_document["resource_kwargs"]["ndim"] = ndim
-
-        def update_components(_data):
-            self.shape.put(_data["shape"])
-            self.flux.put(_data["flux"])
-            self.mean.put(_data["mean"])
-            self.x.put(_data["x"])
-            self.y.put(_data["y"])
-            self.fwhm_x.put(_data["fwhm_x"])
-            self.fwhm_y.put(_data["fwhm_y"])
-            self.photon_energy.put(_data["photon_energy"])
-            self.horizontal_extent.put(_data["horizontal_extent"])
-            self.vertical_extent.put(_data["vertical_extent"])
-
-        update_components(ret)
-
-        datum_document = self._datum_factory(datum_kwargs={})
-        self._asset_docs_cache.append(("datum", datum_document))
+class SingleElectronSpectrumReport(SirepoWatchpoint):
+    report_name = "intensityReport"
+    ndim = 1
 
-        self.image.put(datum_document["datum_id"])
+    def _trigger(self, connection):
+        logger.debug(f"Custom trigger for {self.name}")
 
-        self._resource_document = None
-        self._datum_factory = None
+        ret, read_timings = self._read_report(connection)
 
-        logger.debug(f"\nReport for {self.name}: {self.connection.data['report']}\n")
+        self._update_components(ret)
+        self._update_timings(read_timings)
 
-        return NullStatus()
+        logger.debug(f"\nReport for {self.name}: {connection.data['report']}\n")
 
 
 class BeamStatisticsReport(DeviceWithJSONData):
@@ -276,28 +687,26 @@ class BeamStatisticsReport(DeviceWithJSONData):
 
     report = Cpt(Signal, value="", kind="normal")  # values are always strings, not dictionaries
 
+    report_name = "beamStatisticsReport"
+
     def __init__(self, connection, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.connection = connection
 
-    def trigger(self, *args, **kwargs):
+    def _trigger(self, connection):
         logger.debug(f"Custom trigger for {self.name}")
 
-        self.connection.data["report"] = "beamStatisticsReport"
+        result = self._run_report(connection)
+        self._update_from_result(connection, result)
 
         start_time = time.monotonic()
-        self.connection.run_simulation()
-        self.duration.put(time.monotonic() - start_time)
-
-        datafile = self.connection.get_datafile(file_index=-1)
-        self.report.put(json.dumps(json.loads(datafile.decode())))
+        self.report.put(json.dumps(json.loads(result.content.decode())))
+        self.parse_time.put(time.monotonic() - start_time)
 
-        logger.debug(f"\nReport for {self.name}: {self.connection.data['report']}\n")
+        logger.debug(f"\nReport for {self.name}: {connection.data['report']}\n")
 
-        # We call the trigger on super at the end to update the sirepo_data_json
-        # and the corresponding hash after the simulation is run.
-        super().trigger(*args, **kwargs)
-        return NullStatus()
+        # We update the sirepo_data_json and the corresponding hash after the simulation is run.
+        self._update_json_data(connection)
 
     def stage(self):
         super().stage()
@@ -306,71 +715,178 @@ class BeamStatisticsReport(DeviceWithJSONData):
     def unstage(self):
         super().unstage()
         self.report.put("")
+        if self.report_group is not None:
+            self.report_group.clear()
 
 
-class SirepoSignalGrazingAngle(SirepoSignal):
-    def set(self, value):
-        super().set(value)
-        ret = self.parent.connection.compute_grazing_orientation(self._sirepo_dict)
-        # State is added to the ret dict from compute_grazing_orientation and we
-        # want to make sure the vectors are updated properly every time the
-        # grazing angle is updated.
-        ret.pop("state")
-        # Update vector components
-        for cpt in [
-            "normalVectorX",
-            "normalVectorY",
-            "normalVectorZ",
-            "tangentialVectorX",
-            "tangentialVectorY",
-        ]:
-            getattr(self.parent, cpt).put(ret[cpt])
-        return NullStatus()
+class SirepoReportGroup:
+    """
+    Run the reports of several devices of a simulation together.
 
+    In a plan, the detectors are triggered one after the other. When a device
+    of the group is triggered, the reports of all the devices of the group are
+    run together (see ``SirepoBluesky.run_reports()``), and the results of the
+    other devices are kept until they are triggered in the same step. The
+    devices of a group should therefore be used together in the plans.
 
-class SirepoSignalCRL(SirepoSignal):
-    def set(self, value):
-        super().set(value)
-        ret = self.parent.connection.compute_crl_characteristics(self._sirepo_dict)
-        # State is added to the ret dict from compute_crl_characteristics and we
-        # want to make sure the crl element is updated properly when parameters are changed.
-        ret.pop("state")
-        # Update crl element
-        for cpt in ["absoluteFocusPosition", "focalDistance"]:
-            getattr(self.parent, cpt).put(ret[cpt])
-        return NullStatus()
+    The triggers of a step form a round, which ends when a device of the group
+    is read or triggered again. The reports are run again at each round, even
+    if the models were not modified (the results of e.g. Shadow ray tracing
+    or SRW multi-electron reports are stochastic), and a device which was not
+    triggered in a round never gets the result of another round.
 
+    Parameters
+    ----------
+    devices : list
+        The watchpoints and reports (e.g. ``BeamStatisticsReport``) sharing the
+        same connection.
+
+    Examples
+    --------
+    SirepoReportGroup([w9, w10, w11])
+    RE(bp.scan([w9, w10, w11], mirror.grazingAngle, 1, 2, 5))
+    """
+
+    def __init__(self, devices):
+        self.devices = list(devices)
+        connections = {id(device.connection) for device in self.devices}
+        if len(connections) != 1:
+            raise ValueError("The devices of a report group must share the same connection.")
+        self.connection = self.devices[0].connection
+        self._lock = threading.Lock()
+        self._results = {}  # device name -> (trigger round, SimulationResult)
+        self._round = 0
+        self._round_devices = None  # the names of the devices triggered in the current round, None if it ended
+        for device in self.devices:
+            device.report_group = self
+
+    def trigger_round(self, device):
+        """Return the token of the trigger round of a device which is triggered.
+
+        A new round starts with the first trigger after the end of the
+        previous round, or with a second trigger of a device in the round.
+        """
+        with self._lock:
+            if self._round_devices is None or device.name in self._round_devices:
+                self._round += 1
+                self._round_devices = set()
+            self._round_devices.add(device.name)
+            return self._round
+
+    def end_round(self):
+        """End the current trigger round (e.g. when the triggered devices are read)."""
+        with self._lock:
+            self._round_devices = None
+
+    def result(self, device, connection, trigger_round):
+        """Return the result of the report of a device, running the reports of the group if needed.
+
+        ``connection`` is the snapshot of the connection taken by the trigger of
+        the device, and ``trigger_round`` the token of its round (see ``trigger_round()``).
+        """
+        with self._lock:
+            entry = self._results.pop(device.name, None)
+            if entry is None or entry[0] != trigger_round:
+                results = connection.run_reports([d.report_name for d in self.devices])
+                self._results = {d.name: (trigger_round, results[d.report_name]) for d in self.devices}
+                entry = self._results.pop(device.name)
+            return entry[1]
+
+    def clear(self):
+        """Discard the results which were not taken by their devices, and end the current round."""
+        with self._lock:
+            self._results = {}
+            self._round_devices = None
+
+
+class SirepoSignalCompute(SirepoSignal):
+    """
+    Signal of an element whose other parameters are computed by the server.
+
+    Setting the signal updates the computed parameters of the element with a
+    stateless-compute request. If the connection defers the computations (see
+    ``SirepoBluesky.deferred_compute()``), the request is sent once for all the
+    parameters of the element set before the next simulation run or read.
+
+    The subclasses define the ``computed_params`` and the ``compute_method``,
+    the name of the method of the connection computing them from the
+    dictionary of the element (e.g. "compute_crl_characteristics"), which is
+    checked when the subclass is defined.
+    """
+
+    computed_params = ()
+    compute_method = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if not cls.computed_params or cls.compute_method is None:
+            raise TypeError(f"{cls.__name__} must define its computed_params and compute_method")
+        if not callable(getattr(SirepoBluesky, cls.compute_method, None)):
+            raise TypeError(f"{cls.__name__}.compute_method: SirepoBluesky has no method {cls.compute_method!r}")
+
+    def __init__(self, *args, **kwargs):
+        if self.compute_method is None:
+            raise TypeError(f"{type(self).__name__} is abstract, use one of its subclasses")
+        super().__init__(*args, **kwargs)
 
-class SirepoSignalCrystal(SirepoSignal):
     def set(self, value):
         super().set(value)
-        ret = self.parent.connection.compute_crystal_orientation(self._sirepo_dict)
-        # State is added to the ret dict from compute_crystal_orientation and we
-        # want to make sure the crystal element is updated properly when parameters are changed.
+        connection = self.parent.connection
+        if connection.defer_compute:
+            connection.defer(id(self._sirepo_dict), self._update_computed_params)
+        else:
+            self._update_computed_params()
+        return NullStatus()
+
+    def _update_computed_params(self):
+        connection = self.parent.connection
+        ret = getattr(connection, self.compute_method)(self._sirepo_dict)
+        connection.compute_counts[self.parent.name] += 1
+        # State is added to the ret dict by the server and we want to make sure
+        # the element is updated properly when parameters are changed.
         ret.pop("state")
-        # Update crystal element
-        for cpt in [
-            "dSpacing",
-            "grazingAngle",
-            "nvx",
-            "nvy",
-            "nvz",
-            "outframevx",
-            "outframevy",
-            "outoptvx",
-            "outoptvy",
-            "outoptvz",
-            "psi0i",
-            "psi0r",
-            "psiHBi",
-            "psiHBr",
-            "psiHi",
-            "psiHr",
-            "tvx",
-            "tvy",
-        ]:
+        for cpt in self.computed_params:
             getattr(self.parent, cpt).put(ret[cpt])
-        return NullStatus()
+
+
+class SirepoSignalGrazingAngle(SirepoSignalCompute):
+    computed_params = (
+        "normalVectorX",
+        "normalVectorY",
+        "normalVectorZ",
+        "tangentialVectorX",
+        "tangentialVectorY",
+    )
+    compute_method = "compute_grazing_orientation"
+
+
+class SirepoSignalCRL(SirepoSignalCompute):
+    computed_params = ("absoluteFocusPosition", "focalDistance")
+    compute_method = "compute_crl_characteristics"
+
+
+class SirepoSignalCrystal(SirepoSignalCompute):
+    computed_params = (
+        "dSpacing",
+        "grazingAngle",
+        "nvx",
+        "nvy",
+        "nvz",
+        "outframevx",
+        "outframevy",
+        "outoptvx",
+        "outoptvy",
+        "outoptvz",
+        "psi0i",
+        "psi0r",
+        "psiHBi",
+        "psiHBr",
+        "psiHi",
+        "psiHr",
+        "tvx",
+        "tvy",
+    )
+    compute_method = "compute_crystal_orientation"
 
 
 SimplePropagationConfig = namedtuple(
@@ -392,26 +908,30 @@ class PropagationConfig(SimplePropagationConfig):
         return propagation_read
 
 
-def create_classes(connection, create_objects=True, extra_model_fields=[]):
-    classes = {}
-    objects = {}
-    data = copy.deepcopy(connection.data)
+SimTypeConfig = namedtuple("SimTypeConfig", "element_location class_name_field")
 
-    sim_type = connection.sim_type
+SIM_TYPE_CONFIGS = {
+    "srw": SimTypeConfig("beamline", "title"),
+    "shadow": SimTypeConfig("beamline", "title"),
+    "madx": SimTypeConfig("elements", "element_name"),
+}
 
-    SimTypeConfig = namedtuple("SimTypeConfig", "element_location class_name_field")
 
-    srw_config = SimTypeConfig("beamline", "title")
-    shadow_config = SimTypeConfig("beamline", "title")
-    madx_config = SimTypeConfig("elements", "element_name")
+def iter_model_elements(connection, extra_model_fields=[]):
+    """
+    Iterate over the elements of the simulation to create the devices of.
+
+    Yields ``(model_field, index, el, class_name, object_name, sirepo_dict)``
+    where ``el`` is a copy of the element with the reserved attribute names
+    renamed and ``sirepo_dict`` is the dictionary of the element in the data
+    of the connection.
+    """
+    data = copy.deepcopy(connection.data)
 
-    config_dict = {
-        "srw": srw_config,
-        "shadow": shadow_config,
-        "madx": madx_config,
-    }
+    sim_type = connection.sim_type
+    config = SIM_TYPE_CONFIGS[sim_type]
 
-    model_fields = [config_dict[sim_type].element_location] + extra_model_fields
+    model_fields = [config.element_location] + extra_model_fields
 
     data_models = {}
     for model_field in model_fields:
@@ -442,7 +962,7 @@ def create_classes(connection, create_objects=True, extra_model_fields=[]):
                 else:
                     pass
 
-            class_name = el[config_dict[sim_type].class_name_field]
+            class_name = el[config.class_name_field]
             if model_field == "commands":
                 # Use command type and index in the model as class name to
                 # prevent overwriting any other elements or rpnVariables
@@ -450,115 +970,108 @@ def create_classes(connection, create_objects=True, extra_model_fields=[]):
                 class_name = inflection.camelize(f"{el['_type']}{i}")
             else:
                 class_name = inflection.camelize(
-                    el[config_dict[sim_type].class_name_field].replace(" ", "_").replace(".", "").replace("-", "_")
+                    el[config.class_name_field].replace(" ", "_").replace(".", "").replace("-", "_")
                 )
             object_name = inflection.underscore(class_name)
 
-            base_classes = (Device,)
-            extra_kwargs = {"connection": connection}
-            if "type" in el and el["type"] == "watch":
-                base_classes = (SirepoWatchpoint, Device)
-            elif "type" in el and el["type"] == "intensityReport":
-                base_classes = (SingleElectronSpectrumReport, Device)
-
-            components = {}
-            for k, v in el.items():
-                if (
-                    "type" in el
-                    and el["type"] in ["sphericalMirror", "toroidalMirror", "ellipsoidMirror"]
-                    and k == "grazingAngle"
-                ):
-                    cpt_class = SirepoSignalGrazingAngle
-                elif "type" in el and el["type"] == "crl" and k not in ["absoluteFocusPosition", "focalDistance"]:
-                    cpt_class = SirepoSignalCRL
-                elif (
-                    "type" in el
-                    and el["type"] == "crystal"
-                    and k
-                    not in [
-                        "dSpacing",
-                        "grazingAngle",
-                        "nvx",
-                        "nvy",
-                        "nvz",
-                        "outframevx",
-                        "outframevy",
-                        "outoptvx",
-                        "outoptvy",
-                        "outoptvz",
-                        "psi0i",
-                        "psi0r",
-                        "psiHBi",
-                        "psiHBr",
-                        "psiHi",
-                        "psiHr",
-                        "tvx",
-                        "tvy",
-                    ]
-                ):
-                    cpt_class = SirepoSignalCrystal
-                else:
-                    # TODO: Cover the cases for mirror and crystal grazing angles
-                    cpt_class = SirepoSignal
+            if "type" in el and el["type"] not in ["undulator", "intensityReport"]:
+                sirepo_dict = connection.data["models"][model_field][i]
+            elif sim_type == "madx" and model_field in ["rpnVariables", "commands"]:
+                sirepo_dict = connection.data["models"][model_field][i]
+            else:
+                sirepo_dict = connection.data["models"][model_field]
 
-                if "type" in el and el["type"] not in ["undulator", "intensityReport"]:
-                    sirepo_dict = connection.data["models"][model_field][i]
-                elif sim_type == "madx" and model_field in ["rpnVariables", "commands"]:
-                    sirepo_dict = connection.data["models"][model_field][i]
-                else:
-                    sirepo_dict = connection.data["models"][model_field]
+            yield model_field, i, el, class_name, object_name, sirepo_dict
 
-                components[k] = Cpt(
-                    cpt_class,
-                    value=(float(v) if type(v) is int else v),
-                    sirepo_dict=sirepo_dict,
-                    sirepo_param=k,
-                )
-            components.update(**extra_kwargs)
 
-            cls = type(
-                class_name,
-                base_classes,
-                components,
+def signal_class(el, param):
+    """The class of the signal of the parameter ``param`` of the element ``el``."""
+    if (
+        "type" in el
+        and el["type"] in ["sphericalMirror", "toroidalMirror", "ellipsoidMirror"]
+        and param == "grazingAngle"
+    ):
+        return SirepoSignalGrazingAngle
+    elif "type" in el and el["type"] == "crl" and param not in SirepoSignalCRL.computed_params:
+        return SirepoSignalCRL
+    elif "type" in el and el["type"] == "crystal" and param not in SirepoSignalCrystal.computed_params:
+        return SirepoSignalCrystal
+    else:
+        # TODO: Cover the cases for mirror and crystal grazing angles
+        return SirepoSignal
+
+
+def create_classes(connection, create_objects=True, extra_model_fields=[]):
+    classes = {}
+    objects = {}
+
+    sim_type = connection.sim_type
+
+    for model_field, i, el, class_name, object_name, sirepo_dict in iter_model_elements(
+        connection, extra_model_fields
+    ):
+        base_classes = (Device,)
+        extra_kwargs = {"connection": connection}
+        if "type" in el and el["type"] == "watch":
+            base_classes = (SirepoWatchpoint, Device)
+        elif "type" in el and el["type"] == "intensityReport":
+            base_classes = (SingleElectronSpectrumReport, Device)
+
+        components = {}
+        for k, v in el.items():
+            components[k] = Cpt(
+                signal_class(el, k),
+                value=(float(v) if type(v) is int else v),
+                sirepo_dict=sirepo_dict,
+                sirepo_param=k,
             )
+        components.update(**extra_kwargs)
 
-            classes[object_name] = cls
-            if create_objects:
-                objects[object_name] = cls(name=object_name)
-
-            if sim_type == "srw" and model_field == "beamline":
-                prop_params = connection.data["models"]["propagation"][str(el["id"])][0]
-                sirepo_propagation = []
-                object_name += "_propagation"
-                for i in range(9):
-                    sirepo_propagation.append(
-                        SirepoSignal(
-                            name=f"{object_name}_{SimplePropagationConfig._fields[i]}",
-                            value=float(prop_params[i]),
-                            sirepo_dict=prop_params,
-                            sirepo_param=i,
-                        )
-                    )
-                if create_objects:
-                    objects[object_name] = PropagationConfig(*sirepo_propagation[:])
+        cls = type(
+            class_name,
+            base_classes,
+            components,
+        )
 
-        if sim_type == "srw":
-            post_prop_params = connection.data["models"]["postPropagation"]
+        classes[object_name] = cls
+        if create_objects:
+            objects[object_name] = cls(name=object_name)
+
+        if sim_type == "srw" and model_field == "beamline":
+            prop_params = connection.data["models"]["propagation"][str(el["id"])][0]
             sirepo_propagation = []
-            object_name = "post_propagation"
+            object_name += "_propagation"
             for i in range(9):
                 sirepo_propagation.append(
                     SirepoSignal(
                         name=f"{object_name}_{SimplePropagationConfig._fields[i]}",
-                        value=float(post_prop_params[i]),
-                        sirepo_dict=post_prop_params,
+                        value=float(prop_params[i]),
+                        sirepo_dict=prop_params,
                         sirepo_param=i,
+                        connection=connection,
                     )
                 )
-            classes["propagation_parameters"] = PropagationConfig
             if create_objects:
                 objects[object_name] = PropagationConfig(*sirepo_propagation[:])
 
+    if sim_type == "srw":
+        post_prop_params = connection.data["models"]["postPropagation"]
+        sirepo_propagation = []
+        object_name = "post_propagation"
+        for i in range(9):
+            sirepo_propagation.append(
+                SirepoSignal(
+                    name=f"{object_name}_{SimplePropagationConfig._fields[i]}",
+                    value=float(post_prop_params[i]),
+                    sirepo_dict=post_prop_params,
+                    sirepo_param=i,
+                    connection=connection,
+                )
+            )
+        classes["propagation_parameters"] = PropagationConfig
+        if create_objects:
+            objects[object_name] = PropagationConfig(*sirepo_propagation[:])
+
     return classes, objects
 
 
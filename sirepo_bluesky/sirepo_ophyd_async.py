@@ -0,0 +1,408 @@
+"""
+ophyd-async devices generated from Sirepo simulations.
+
+The devices mirror the ophyd devices of :mod:`sirepo_bluesky.sirepo_ophyd`
+(same classes and object names, see ``create_classes()``), but their signals
+are ophyd-async soft signals backed by the dictionaries of the simulation data
+and their triggers return ``AsyncStatus`` objects awaiting an
+:class:`~sirepo_bluesky.async_sirepo_bluesky.AsyncSirepoBluesky` client.
+"""
+import asyncio
+import datetime
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+from event_model import compose_resource
+from ophyd.sim import new_uid
+from ophyd_async.core import (
+    Array1D,
+    AsyncStatus,
+    Device,
+    StandardReadable,
+    StandardReadableFormat,
+    soft_signal_r_and_setter,
+    soft_signal_rw,
+)
+
+from .shadow_handler import read_shadow_buffer
+from .sirepo_ophyd import (
+    RESERVED_OPHYD_TO_SIREPO_ATTRS,
+    RESERVED_SIREPO_TO_OPHYD_ATTRS,
+    SimplePropagationConfig,
+    SirepoSignalCompute,
+    iter_model_elements,
+    signal_class,
+    write_datafile,
+)
+from .srw_handler import read_srw_buffer
+
+logger = logging.getLogger("sirepo-bluesky")
+
+# The attributes of the ophyd-async devices and the methods of the bluesky
+# protocols, which ophyd-async doesn't allow as names of the children:
+DEVICE_RESERVED_ATTRS = frozenset(dir(Device)) | {
+    "check_value",
+    "clear_sub",
+    "collect",
+    "collect_asset_docs",
+    "collect_pages",
+    "complete",
+    "describe",
+    "describe_collect",
+    "describe_configuration",
+    "get_index",
+    "hints",
+    "kickoff",
+    "locate",
+    "pause",
+    "prepare",
+    "read",
+    "read_configuration",
+    "resume",
+    "set",
+    "stage",
+    "stop",
+    "subscribe",
+    "trigger",
+    "unstage",
+}
+
+
+def _datatype(value):
+    if isinstance(value, bool):
+        return bool
+    if isinstance(value, (int, float)):
+        return float
+    if isinstance(value, str):
+        return str
+    return None
+
+
+def _attr_name(param):
+    """The name of the signal of a parameter, which must not clash with the attributes of the devices."""
+    param = RESERVED_SIREPO_TO_OPHYD_ATTRS.get(param, param)
+    param = RESERVED_OPHYD_TO_SIREPO_ATTRS.get(param, param)
+    if param in DEVICE_RESERVED_ATTRS or hasattr(SirepoElement, param):
+        param = f"{param}_"
+    return param
+
+
+class SirepoElement(StandardReadable):
+    """
+    An element of a Sirepo simulation, with a signal per parameter.
+
+    The signals read the current value of the parameter from the simulation
+    data of the connection, and setting them modifies the data. Setting a
+    parameter of a CRL, a crystal or the grazing angle of a mirror also
+    updates the computed parameters of the element (awaiting the
+    stateless-compute requests of the client).
+
+    The classes of the elements are created by ``create_classes()``, with the
+    ``connection``, the ``sirepo_dict`` of the element and its ``sirepo_params``
+    as class attributes.
+    """
+
+    connection = None
+    sirepo_dict = None
+    sirepo_params = {}  # parameter -> (signal name, signal class of the ophyd device)
+
+    def __init__(self, name=""):
+        with self.add_children_as_readables():
+            for param, (attr_name, cls) in self.sirepo_params.items():
+                setattr(self, attr_name, self._make_signal(param, cls))
+        super().__init__(name=name)
+
+    def set_name(self, name, *, child_name_separator="_"):
+        # Same names as the signals of the ophyd devices, e.g. "crl1_tipRadius".
+        super().set_name(name, child_name_separator=child_name_separator)
+
+    def _make_signal(self, param, cls):
+        sirepo_dict = self.sirepo_dict
+        datatype = _datatype(sirepo_dict[param])
+
+        def getter():
+            value = sirepo_dict[param]
+            return float(value) if datatype is float else value
+
+        async def setter(value):
+            sirepo_dict[param] = value
+            self.connection.mark_modified(sirepo_dict, param)
+            if issubclass(cls, SirepoSignalCompute):
+                await self._update_computed_params(cls)
+            return value
+
+        return soft_signal_rw(datatype, getter=getter, setter=setter)
+
+    async def _update_computed_params(self, cls):
+        connection = self.connection
+        # Same computation as the signal of the ophyd device, see SirepoSignalCompute:
+        ret = await getattr(connection, cls.compute_method)(self.sirepo_dict)
+        connection.compute_counts[self.name] += 1
+        ret.pop("state")
+        for param in cls.computed_params:
+            self.sirepo_dict[param] = ret[param]
+            connection.mark_modified(self.sirepo_dict, param)
+
+
+class SirepoReport(StandardReadable):
+    """
+    Base of the devices running a report of a simulation.
+
+    The running simulation of the report is cancelled on the server when the
+    device is paused, stopped or unstaged (e.g. by the RunEngine when a scan
+    is paused, aborted or halted), which fails the status of the trigger.
+    """
+
+    connection = None
+    report_name = None
+
+    async def cancel_trigger(self):
+        """Cancel the simulation of a trigger in progress, returns the reports of the cancelled simulations."""
+        reports = await self.connection.cancel_simulations(report=self.report_name)
+        if reports:
+            logger.info(f"Cancelled the simulation of {self.name}")
+        return reports
+
+    async def pause(self):
+        await self.cancel_trigger()
+
+    async def stop(self, success=False):
+        if not success:
+            await self.cancel_trigger()
+
+    @AsyncStatus.wrap
+    async def unstage(self):
+        await self.cancel_trigger()
+        await super().unstage()
+
+
+class SirepoWatchpoint(SirepoElement, SirepoReport):
+    """
+    A watchpoint of a Sirepo simulation.
+
+    Triggering the watchpoint runs its report with a snapshot of the simulation
+    data, downloads the datafile to ``root_dir`` and reads the statistics of
+    the beam. The datafiles are parsed from the memory and written in the
+    background (see ``flush_assets()``).
+
+    As with the ophyd watchpoints, the datafile of each trigger is a resource
+    (of the "srw" or "shadow" spec, read by ``SRWFileHandler`` and
+    ``ShadowFileHandler``) and the ``image`` signal is the id of its datum.
+    The documents are collected by the RunEngine when the device is read
+    (see ``collect_asset_docs()``).
+    """
+
+    ndim = 2
+
+    def __init__(self, name="", root_dir="/tmp/sirepo-bluesky-data"):
+        self._root_dir = root_dir
+        self._setters = {}
+        self._asset_writes = []
+        self._asset_docs = []
+        with self.add_children_as_readables(StandardReadableFormat.HINTED_SIGNAL):
+            self.flux = self._make_result_signal("flux", float)
+        with self.add_children_as_readables():
+            for result_name in ("mean", "x", "y", "fwhm_x", "fwhm_y", "photon_energy", "duration"):
+                setattr(self, result_name, self._make_result_signal(result_name, float))
+            self.sirepo_data_hash = self._make_result_signal("sirepo_data_hash", str)
+            self.image = self._make_result_signal("image", str)
+        with self.add_children_as_readables(StandardReadableFormat.CONFIG_SIGNAL):
+            self.horizontal_extent = self._make_result_signal("horizontal_extent", Array1D[np.float64])
+            self.vertical_extent = self._make_result_signal("vertical_extent", Array1D[np.float64])
+        super().__init__(name=name)
+
+    def _make_result_signal(self, result_name, datatype):
+        signal, self._setters[result_name] = soft_signal_r_and_setter(datatype)
+        return signal
+
+    @property
+    def report_name(self):
+        return f"watchpointReport{self.sirepo_dict['id']}"
+
+    @AsyncStatus.wrap
+    async def trigger(self):
+        self.connection.data["report"] = self.report_name
+        # The simulation runs with a snapshot of the data, which can be
+        # modified (e.g. by the next step of a plan) in the meantime.
+        connection = self.connection.snapshot()
+        resource_path = Path(datetime.datetime.now().strftime("%Y/%m/%d")) / f"{new_uid()}.dat"
+
+        _, duration = await connection.run_simulation()
+        content = await connection.get_datafile()
+        ret, resource_kwargs = await asyncio.to_thread(self._read_datafile, connection, content)
+        path = Path(self._root_dir) / resource_path
+        self._asset_writes.append(asyncio.create_task(asyncio.to_thread(write_datafile, path, content)))
+        resource_document, datum_factory, _ = compose_resource(
+            start={"uid": "needed for compose_resource() but will be discarded"},
+            spec=connection.data["simulationType"],
+            root=self._root_dir,
+            resource_path=str(resource_path),
+            resource_kwargs=resource_kwargs,
+        )
+        # The uid of the start document is added by the RunEngine:
+        resource_document.pop("run_start")
+        datum_document = datum_factory(datum_kwargs={})
+        self._asset_docs.extend([("resource", resource_document), ("datum", datum_document)])
+
+        results = {
+            "flux": ret["flux"],
+            "mean": ret["mean"],
+            "x": ret["x"],
+            "y": ret["y"],
+            "fwhm_x": ret["fwhm_x"],
+            "fwhm_y": ret["fwhm_y"],
+            "photon_energy": float(np.mean(ret["photon_energy"])),
+            "duration": duration,
+            "sirepo_data_hash": connection.data_hash(),
+            "image": datum_document["datum_id"],
+            "horizontal_extent": np.asarray(ret["horizontal_extent"], dtype=np.float64),
+            "vertical_extent": np.asarray(ret["vertical_extent"], dtype=np.float64),
+        }
+        for result_name, value in results.items():
+            self._setters[result_name](value)
+        logger.debug(f"\nReport for {self.name}: {connection.data['report']}\n")
+
+    async def describe(self):
+        res = await super().describe()
+        res[self.image.name].update(external="FILESTORE:", dtype="array")
+        return res
+
+    def collect_asset_docs(self):
+        """Yield the resource and datum documents of the datafiles of the previous triggers."""
+        docs, self._asset_docs = self._asset_docs, []
+        yield from docs
+
+    async def flush_assets(self):
+        """Wait until the datafiles of the previous triggers are written (done when the device is unstaged)."""
+        writes, self._asset_writes = self._asset_writes, []
+        await asyncio.gather(*writes)
+
+    @AsyncStatus.wrap
+    async def unstage(self):
+        await super().unstage()
+        await self.flush_assets()
+
+    def _read_datafile(self, connection, content):
+        """Parse a datafile, returns the read data and the kwargs of its resource."""
+        conn_data = connection.data
+        if conn_data["simulationType"] == "srw":
+            return read_srw_buffer(content, ndim=self.ndim), {"ndim": self.ndim}
+        nbins = conn_data["models"][conn_data["report"]]["histogramBins"]
+        return read_shadow_buffer(content, histogram_bins=nbins), {"histogram_bins": nbins}
+
+
+class SingleElectronSpectrumReport(SirepoWatchpoint):
+    report_name = "intensityReport"
+    ndim = 1
+
+
+class BeamStatisticsReport(SirepoReport):
+    """The beam statistics report of a Shadow simulation, read as a JSON string."""
+
+    report_name = "beamStatisticsReport"
+
+    def __init__(self, connection, name=""):
+        self.connection = connection
+        with self.add_children_as_readables():
+            self.report, self._set_report = soft_signal_r_and_setter(str)
+            self.duration, self._set_duration = soft_signal_r_and_setter(float)
+        super().__init__(name=name)
+
+    def set_name(self, name, *, child_name_separator="_"):
+        super().set_name(name, child_name_separator=child_name_separator)
+
+    @AsyncStatus.wrap
+    async def trigger(self):
+        self.connection.data["report"] = self.report_name
+        connection = self.connection.snapshot()
+        _, duration = await connection.run_simulation()
+        content = await connection.get_datafile(file_index=-1)
+        self._set_report(json.dumps(json.loads(content.decode())))
+        self._set_duration(duration)
+
+
+class SirepoPropagation(StandardReadable):
+    """The propagation parameters of an element of an SRW beamline (or of the post-propagation)."""
+
+    def __init__(self, connection, prop_params, name=""):
+        with self.add_children_as_readables():
+            for i, field in enumerate(SimplePropagationConfig._fields):
+                setattr(self, field, self._make_signal(connection, prop_params, i))
+        super().__init__(name=name)
+
+    def set_name(self, name, *, child_name_separator="_"):
+        super().set_name(name, child_name_separator=child_name_separator)
+
+    @staticmethod
+    def _make_signal(connection, prop_params, i):
+        def setter(value):
+            prop_params[i] = value
+            connection.mark_modified(prop_params, i)
+            return value
+
+        return soft_signal_rw(float, getter=lambda: float(prop_params[i]), setter=setter)
+
+
+def create_classes(connection, create_objects=True, extra_model_fields=[]):
+    """
+    Create the ophyd-async devices of the elements of a simulation.
+
+    Same as :func:`sirepo_bluesky.sirepo_ophyd.create_classes`, with the same
+    class and object names, but ``connection`` is an ``AsyncSirepoBluesky``
+    client and the devices are ophyd-async devices. The propagation parameters
+    of SRW beamlines are ``SirepoPropagation`` devices.
+
+    Examples
+    --------
+    connection = AsyncSirepoBluesky('http://localhost:8000')
+    await connection.auth('srw', '00000000')
+    classes, objects = create_classes(connection)
+    globals().update(**objects)
+    """
+    classes = {}
+    objects = {}
+
+    sim_type = connection.sim_type
+
+    for model_field, _, el, class_name, object_name, sirepo_dict in iter_model_elements(
+        connection, extra_model_fields
+    ):
+        base_class = SirepoElement
+        if "type" in el and el["type"] == "watch":
+            base_class = SirepoWatchpoint
+        elif "type" in el and el["type"] == "intensityReport":
+            base_class = SingleElectronSpectrumReport
+
+        sirepo_params = {}
+        for k in el:
+            param = RESERVED_SIREPO_TO_OPHYD_ATTRS.get(k, k)
+            if param not in sirepo_dict or _datatype(sirepo_dict[param]) is None:
+                logger.debug(f"Skipping the parameter {param!r} of {object_name}, its type is not supported.")
+                continue
+            sirepo_params[param] = (_attr_name(k), signal_class(el, k))
+
+        cls = type(
+            class_name,
+            (base_class,),
+            {"connection": connection, "sirepo_dict": sirepo_dict, "sirepo_params": sirepo_params},
+        )
+
+        classes[object_name] = cls
+        if create_objects:
+            objects[object_name] = cls(name=object_name)
+
+        if sim_type == "srw" and model_field == "beamline" and create_objects:
+            prop_params = connection.data["models"]["propagation"][str(el["id"])][0]
+            objects[f"{object_name}_propagation"] = SirepoPropagation(
+                connection, prop_params, name=f"{object_name}_propagation"
+            )
+
+    if sim_type == "srw":
+        classes["propagation_parameters"] = SirepoPropagation
+        if create_objects:
+            post_prop_params = connection.data["models"]["postPropagation"]
+            objects["post_propagation"] = SirepoPropagation(connection, post_prop_params, name="post_propagation")
+
+    return classes, objects
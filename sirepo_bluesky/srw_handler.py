@@ -1,12 +1,91 @@
+import io
+import time
+from pathlib import Path
+
 import numpy as np
-import srwpy.uti_plot_com as srw_io
 
 from . import utils
+from .cache import HANDLER_CACHE
+
+# The number of lines of the header of the SRW datafiles (the last one is optional):
+SRW_HEADER_LINES = 11
+
+
+def read_srw_file(filename, ndim=2, timings=None):
+    """Read an SRW datafile and compute the statistics of the beam.
+
+    If ``timings`` is given, the times spent parsing the file ("parse") and
+    computing the statistics ("stats") are stored in it.
+    """
+    start_time = time.monotonic()
+    data, ranges, labels, units = load_srw_file(filename)
+    return _beam_results(data, ranges, labels, units, ndim, start_time, timings)
+
+
+def read_srw_buffer(content, ndim=2, timings=None):
+    """Parse the content of an SRW datafile in memory and compute the statistics of the beam.
+
+    Same as ``read_srw_file()``, without writing ``content`` (the bytes
+    downloaded from the server) to a file first.
+    """
+    start_time = time.monotonic()
+    data, ranges, labels, units = load_srw_buffer(content)
+    return _beam_results(data, ranges, labels, units, ndim, start_time, timings)
+
+
+def load_srw_file(filename):
+    """Read an SRW datafile, see ``load_srw_buffer()``."""
+    return load_srw_buffer(Path(filename).read_bytes())
 
 
-def read_srw_file(filename, ndim=2):
-    data, mode, ranges, labels, units = srw_io.file_load(filename)
-    data = np.array(data)
+def load_srw_buffer(content):
+    """Parse the content of an SRW datafile.
+
+    Returns the data (as a 1D array), ranges, labels and units of the
+    datafile, the same as ``srwpy.uti_plot_com.file_load()``. The values are
+    parsed by NumPy into a single array rather than into a list of floats.
+
+    Raises ``ValueError`` if a value cannot be parsed or if the number of
+    values differs from the mesh of the header (e.g. a truncated datafile).
+    """
+    if isinstance(content, str):
+        content = content.encode()
+    lines = bytes(content).split(b"\n", SRW_HEADER_LINES - 1)
+    header, body = lines[:-1], lines[-1]
+    if body.startswith(b"#"):
+        last_line, _, body = body.partition(b"\n")
+        header.append(last_line)
+    # Same lines as read by srwpy, with their line breaks:
+    header = [f"{line.decode()}\n" for line in header]
+
+    ne, nx, ny = [int(header[i].replace("#", "").split()[0]) for i in (3, 6, 9)]
+    e0, e1, x0, x1, y0, y1 = [float(header[i].replace("#", "").split()[0]) for i in (1, 2, 4, 5, 7, 8)]
+    ranges = (e0, e1, ne, x0, x1, nx, y0, y1, ny)
+
+    labels = ["Photon Energy", "Horizontal Position", "Vertical Position", "Intensity"]
+    units = ["eV", "m", "m", ""]
+    tokens = header[0].split(" [")
+    labels[3] = tokens[0].replace("#", "")
+    if len(tokens) > 1:
+        units[3] = tokens[1].split("] ")[0]
+    for i in range(3):
+        tokens = header[3 * i + 1].split()
+        labels[i] = " ".join(tokens[2:-1])
+        units[i] = tokens[-1].replace("[", "").replace("]", "")
+
+    # The data is in the first column of the lines after the header:
+    if b"\t" in body:
+        data = np.loadtxt(io.BytesIO(body), delimiter="\t", usecols=0, ndmin=1)
+    else:
+        data = np.array(body.split(), dtype=float)
+    if data.size != ne * nx * ny:
+        raise ValueError(
+            f"The datafile has {data.size} values, {ne * nx * ny} are expected from its mesh {ne}x{nx}x{ny}."
+        )
+    return data, ranges, labels, units
+
+
+def _beam_results(data, ranges, labels, units, ndim, start_time, timings):
     if ndim == 2:
         data = data.reshape((ranges[8], ranges[5]), order="C")
         photon_energy = ranges[0]
@@ -17,6 +96,7 @@ def read_srw_file(filename, ndim=2):
 
     horizontal_extent = np.array(ranges[3:5])
     vertical_extent = np.array(ranges[6:8])
+    parse_time = time.monotonic()
 
     ret = {
         "data": data,
@@ -35,10 +115,18 @@ def read_srw_file(filename, ndim=2):
     if ndim == 2:
         ret.update(utils.get_beam_stats(data, horizontal_extent, vertical_extent))
 
+    if timings is not None:
+        timings["parse"] = parse_time - start_time
+        timings["stats"] = time.monotonic() - parse_time
     return ret
 
 
 class SRWFileHandler:
+    """Read the data of an SRW datafile, memory-mapped from its ``.npy`` sidecar if it exists.
+
+    The data parsed from the datafiles is kept in ``sirepo_bluesky.cache.HANDLER_CACHE``.
+    """
+
     specs = {"srw"}
 
     def __init__(self, filename, ndim=2):
@@ -46,5 +134,9 @@ class SRWFileHandler:
         self._ndim = ndim
 
     def __call__(self):
-        d = read_srw_file(self._name, ndim=self._ndim)
-        return d["data"]
+        data = utils.load_sidecar(self._name)
+        if data is None:
+            data = HANDLER_CACHE.load(
+                "srw", self._name, lambda: read_srw_file(self._name, ndim=self._ndim)["data"], ndim=self._ndim
+            )
+        return data
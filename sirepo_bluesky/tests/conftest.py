@@ -1,16 +1,26 @@
 import asyncio
+import contextlib
 import datetime
+import http.server
+import itertools
+import json
+import os
+import threading
 
 import databroker
+import numpy as np
 import pytest
 from bluesky.callbacks import best_effort
 from bluesky.run_engine import RunEngine
 from databroker import Broker
 from ophyd.utils import make_dir_tree
 
+from sirepo_bluesky.hdf5_handler import SirepoHDF5Handler
+from sirepo_bluesky.json_handler import SirepoDataJSONHandler
 from sirepo_bluesky.madx_handler import MADXFileHandler
 from sirepo_bluesky.shadow_handler import ShadowFileHandler
 from sirepo_bluesky.sirepo_bluesky import SirepoBluesky
+from sirepo_bluesky.sirepo_ophyd import SirepoSignalCrystal, create_classes
 from sirepo_bluesky.srw_handler import SRWFileHandler
 
 
@@ -28,6 +38,8 @@ def db():
     db.reg.register_handler("shadow", ShadowFileHandler, overwrite=True)
     db.reg.register_handler("SIREPO_FLYER", SRWFileHandler, overwrite=True)
     db.reg.register_handler("madx", MADXFileHandler, overwrite=True)
+    db.reg.register_handler("SIREPO_DATA_JSON", SirepoDataJSONHandler, overwrite=True)
+    db.reg.register_handler("SIREPO_HDF5", SirepoHDF5Handler, overwrite=True)
 
     return db
 
@@ -140,3 +152,243 @@ def madx_bl2_triplet_tdc_simulation(make_dirs):
     connection = SirepoBluesky("http://localhost:8000")
     data, _ = connection.auth("madx", "00000002")
     return connection
+
+
+class _FakeSirepoHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _respond(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        server = self.server
+        endpoint = self.path.strip("/").split("/")[0]
+        server.requests.append((self.command, self.path, json.loads(body) if body else None))
+        server.connections.add(self.client_address)
+        handler = server.routes.get(endpoint)
+        if handler is None:
+            status, content = 404, b""
+        else:
+            status, content = handler(self.path, json.loads(body) if body else None)
+        if not isinstance(content, bytes):
+            content = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = _respond
+    do_POST = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="function")
+def fake_sirepo():
+    """A minimal local HTTP server to exercise the client without a Sirepo server.
+
+    Register endpoint handlers in ``fake_sirepo.routes``; each handler is called
+    with the request path and the decoded JSON payload and returns a tuple of
+    (status code, response content).
+    """
+    server = http.server.ThreadingHTTPServer(("localhost", 0), _FakeSirepoHandler)
+    server.routes = {}
+    server.requests = []
+    server.connections = set()
+    server.url = f"http://localhost:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope="function")
+def fake_auth(fake_sirepo):
+    """Authenticate the clients of ``fake_sirepo`` to an empty SRW (or other) simulation."""
+
+    def auth(path, payload):
+        data = {
+            "models": {"simulation": {"folder": "/", "name": "fake"}},
+            "simulationType": payload["simulationType"],
+        }
+        return 200, {"state": "ok", "schema": {}, "data": data}
+
+    fake_sirepo.routes["auth-bluesky-login"] = auth
+
+
+@pytest.fixture(scope="function")
+def authenticated_client(fake_sirepo, fake_auth):
+    """Return a factory of the clients of the simulation of ``fake_auth``, authenticated to ``fake_sirepo``."""
+
+    def make(**kwargs):
+        connection = SirepoBluesky(fake_sirepo.url, backoff_factor=0, **kwargs)
+        connection.auth("srw", "00000000")
+        return connection
+
+    return make
+
+
+@pytest.fixture(scope="function")
+def simulation_routes(fake_sirepo, fake_auth):
+    """Return a function making the simulations of ``fake_sirepo`` complete after ``status_calls`` status requests.
+
+    The function returns the number of status requests by simulation id (and
+    report, if any). The datafile of a report is the path of its request.
+    """
+
+    def make(status_calls=3):
+        calls = {}
+
+        def run_simulation(path, payload):
+            calls[payload["simulationId"], payload.get("report")] = 0
+            return 200, {"state": "pending", "nextRequestSeconds": 0.1, "nextRequest": payload}
+
+        def run_status(path, payload):
+            key = payload["simulationId"], payload.get("report")
+            calls[key] += 1
+            if calls[key] < status_calls:
+                return 200, {"state": "running", "nextRequestSeconds": 0.1, "nextRequest": payload}
+            return 200, {"state": "completed", "simulationId": payload["simulationId"]}
+
+        copies = iter(range(1_000_000))
+
+        def copy_simulation(path, payload):
+            sim_id = f"{next(copies):08d}"
+            return 200, {
+                "models": {"simulation": {"simulationId": sim_id, "folder": "/", "name": payload["name"]}}
+            }
+
+        fake_sirepo.routes["run-simulation"] = run_simulation
+        fake_sirepo.routes["run-status"] = run_status
+        fake_sirepo.routes["copy-simulation"] = copy_simulation
+        fake_sirepo.routes["download-data-file"] = lambda path, payload: (200, path.encode())
+        return calls
+
+    return make
+
+
+@pytest.fixture(scope="function")
+def fake_crystal_simulation(fake_sirepo):
+    """Return a factory of a fake SRW simulation of ``fake_sirepo`` with a crystal, and of its ophyd objects.
+
+    The factory takes the elements of the beamline after the crystal and the
+    kwargs of the client, and returns the client and the objects. The
+    crystal orientation is computed by the server from the Miller indices.
+    """
+
+    def make(extra_elements=(), **kwargs):
+        crystal = {"id": 1, "title": "Mono Crystal", "type": "crystal", "position": 20, "h": 1, "k": 1, "l": 1}
+        crystal.update({param: 0 for param in SirepoSignalCrystal.computed_params})
+        beamline = [crystal, *extra_elements]
+        data = {
+            "models": {
+                "simulation": {"folder": "/", "name": "fake", "photonEnergy": 9000},
+                "beamline": beamline,
+                "propagation": {str(element["id"]): [[0] * 9, [0] * 9] for element in beamline},
+                "postPropagation": [0] * 9,
+            },
+            "simulationType": "srw",
+        }
+
+        def compute(path, payload):
+            element = dict(payload["optical_element"])
+            element["dSpacing"] = element["h"] + 10 * element["k"] + 100 * element["l"]
+            return 200, {"state": "completed", **element}
+
+        fake_sirepo.routes["auth-bluesky-login"] = lambda path, payload: (
+            200,
+            {"state": "ok", "schema": {}, "data": data},
+        )
+        fake_sirepo.routes["stateless-compute"] = compute
+        connection = SirepoBluesky(fake_sirepo.url, **kwargs)
+        connection.auth("srw", "00000000")
+        _, objects = create_classes(connection)
+        return connection, objects
+
+    return make
+
+
+@pytest.fixture(scope="function")
+def srw_datafile():
+    """Return a function making the content of an SRW datafile of an intensity.
+
+    The intensity is 2D, or the 1D spectrum of a single point.
+    """
+
+    def make(intensity, horizontal_extent=(-1e-3, 1e-3), vertical_extent=(-1e-3, 1e-3), photon_energy=1000.0):
+        intensity = np.asarray(intensity, dtype=float)
+        if intensity.ndim == 1:
+            ne, ny, nx = intensity.size, 1, 1
+            energy_range = (photon_energy, 2 * photon_energy)
+        else:
+            ne, (ny, nx) = 1, intensity.shape
+            energy_range = (photon_energy, photon_energy)
+        header = [
+            "#C-aligned Intensity (inner loop is vs photon energy, outer loop vs vertical position)",
+            f"#{energy_range[0]} #Initial Photon Energy [eV]",
+            f"#{energy_range[1]} #Final Photon Energy [eV]",
+            f"#{ne} #Number of points vs Photon Energy",
+            f"#{horizontal_extent[0]} #Initial Horizontal Position [m]",
+            f"#{horizontal_extent[1]} #Final Horizontal Position [m]",
+            f"#{nx} #Number of points vs Horizontal Position",
+            f"#{vertical_extent[0]} #Initial Vertical Position [m]",
+            f"#{vertical_extent[1]} #Final Vertical Position [m]",
+            f"#{ny} #Number of points vs Vertical Position",
+        ]
+        values = [repr(value) for value in intensity.ravel()]
+        return "\n".join(header + values).encode() + b"\n"
+
+    return make
+
+
+@pytest.fixture(scope="function")
+def shadow_beam_file():
+    """Return a function writing a Shadow3 beam with lost rays and a spread of energies to a path."""
+    sd = pytest.importorskip("Shadow.ShadowLibExtensions")
+
+    def write(path, npoint=20000):
+        source = sd.Source()
+        source.NPOINT = npoint
+        beam = sd.Beam()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            beam.genSource(source)
+        rng = np.random.default_rng(0)
+        beam.rays[rng.random(len(beam.rays)) < 0.2, 9] = -1.0  # lost rays
+        beam.rays[:, 10] *= 1 + 0.01 * rng.random(len(beam.rays))
+        beam.write(str(path))
+        return str(path)
+
+    return write
+
+
+@pytest.fixture(scope="function")
+def fake_watchpoint(fake_sirepo, simulation_routes, fake_crystal_simulation, srw_datafile, tmp_path):
+    """Return a factory of the watchpoint W2, downstream of the crystal of ``fake_crystal_simulation``.
+
+    The factory takes the image of the datafiles (or a list of the images of
+    the successive downloads), the kwargs of ``srw_datafile`` and of the
+    watchpoint, and returns the client, the objects of the simulation and the
+    watchpoint, which writes its datafiles to ``tmp_path``.
+    """
+
+    def make(images=np.ones((3, 4)), datafile_kwargs=None, **kwargs):
+        simulation_routes(status_calls=1)
+        watchpoint = {"id": 2, "title": "W2", "type": "watch", "position": 20}
+        connection, objects = fake_crystal_simulation(extra_elements=[watchpoint])
+        downloads = itertools.repeat(images) if isinstance(images, np.ndarray) else iter(images)
+        fake_sirepo.routes["download-data-file"] = lambda path, payload: (
+            200,
+            srw_datafile(next(downloads), **(datafile_kwargs or {})),
+        )
+        return connection, objects, type(objects["w2"])(name="w2", root_dir=str(tmp_path), **kwargs)
+
+    return make
+
+
+@pytest.fixture(scope="function")
+def documents(RE):
+    """The (name, document) pairs emitted by the runs of the ``RE`` fixture."""
+    docs = []
+    RE.subscribe(lambda name, doc: docs.append((name, doc)))
+    return docs
@@ -2,18 +2,30 @@ import copy
 import json
 import os
 import pprint
+import threading
+import time
 
 import bluesky.plan_stubs as bps
 import bluesky.plans as bp
+import bluesky.preprocessors as bpp
 import dictdiffer
 import matplotlib.pyplot as plt
 import numpy as np
 import peakutils
 import pytest
 import tfs
+from bluesky.utils import RunEngineInterrupted
 
+import sirepo_bluesky.sirepo_bluesky
+from sirepo_bluesky import utils
+from sirepo_bluesky.cache import canonical_hash
+from sirepo_bluesky.hdf5_handler import SirepoHDF5Handler
+from sirepo_bluesky.json_handler import SirepoDataJSONHandler
 from sirepo_bluesky.madx_flyer import MADXFlyer
-from sirepo_bluesky.sirepo_ophyd import BeamStatisticsReport, create_classes
+from sirepo_bluesky.shadow_handler import beam_moments, load_shadow_beam, phase_space_histograms, ray_columns
+from sirepo_bluesky.sirepo_bluesky import SirepoBluesky, SirepoBlueskyClientException
+from sirepo_bluesky.sirepo_ophyd import BeamStatisticsReport, SirepoReportGroup, create_classes, write_datafile
+from sirepo_bluesky.srw_handler import SRWFileHandler
 
 
 def test_beamline_elements_as_ophyd_objects(srw_tes_simulation):
@@ -28,6 +40,428 @@ def test_beamline_elements_as_ophyd_objects(srw_tes_simulation):
     pprint.pprint(mono_crystal1.read())  # noqa
 
 
+@pytest.mark.parametrize("force_run", [True, False])
+@pytest.mark.parametrize("skip_clean_runs", [False, True])
+def test_beamline_elements_modification_tracking(
+    fake_sirepo, skip_clean_runs, force_run, simulation_routes, fake_crystal_simulation
+):
+    calls = simulation_routes(status_calls=1)
+    connection, objects = fake_crystal_simulation(skip_clean_runs=skip_clean_runs, force_run=force_run)
+    connection.data["report"] = "intensityReport"
+
+    def force_runs():
+        return [payload["forceRun"] for _, path, payload in fake_sirepo.requests if path == "/run-simulation"]
+
+    connection.run_and_download()
+    assert force_runs() == [force_run]
+    requests = len(fake_sirepo.requests)
+
+    # Nothing was modified since the last run:
+    assert not connection.is_modified()
+    result = connection.run_and_download()
+    assert connection.last_run_modified == {}
+    if skip_clean_runs:
+        assert result.cached
+        assert force_runs() == [force_run]
+        assert len(fake_sirepo.requests) == requests
+    else:
+        assert force_runs() == [force_run, False]
+
+    objects["mono_crystal"].h.set(2)
+    objects["mono_crystal_propagation"].resize_after.set(1)
+    assert connection.is_modified()
+    connection.run_and_download()
+    assert force_runs()[-1] is force_run
+    assert connection.last_run_modified["Mono Crystal"][0] == "h"
+    assert connection.last_run_modified["propagation[1]"] == [1]
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize("state", ["error", "cancelled"])
+def test_failed_run_is_not_recorded(fake_sirepo, state, simulation_routes, fake_crystal_simulation):
+    simulation_routes(status_calls=1)
+    connection, objects = fake_crystal_simulation(skip_clean_runs=True)
+    connection.data["report"] = "intensityReport"
+    connection.run_and_download()
+    objects["mono_crystal"].h.set(2)
+
+    def run_status(path, payload):
+        if state == "cancelled":
+            connection.cancel_simulations()
+            return 200, {"state": "running", "nextRequestSeconds": 0.1, "nextRequest": payload}
+        return 200, {"state": "error"}
+
+    fake_sirepo.routes["run-status"], run_status = run_status, fake_sirepo.routes["run-status"]
+    fake_sirepo.routes["run-cancel"] = lambda path, payload: (200, {"state": "canceled"})
+    with pytest.raises(SirepoBlueskyClientException):
+        connection.run_and_download()
+
+    # The modifications are still to be run, and the result of the failed run is not reused:
+    assert connection.is_modified()
+    fake_sirepo.routes["run-status"] = run_status
+    requests = len(fake_sirepo.requests)
+    result = connection.run_and_download()
+    assert not result.cached
+    assert fake_sirepo.requests[requests][1:] == ("/run-simulation", dict(connection.data, forceRun=True))
+    assert connection.last_run_modified["Mono Crystal"][0] == "h"
+    assert not connection.is_modified()
+
+
+def test_data_hash_is_incremental(fake_sirepo, monkeypatch, fake_crystal_simulation):
+    connection, objects = fake_crystal_simulation()
+    hashed = []
+    monkeypatch.setattr(
+        sirepo_bluesky.sirepo_bluesky, "canonical_hash", lambda obj: hashed.append(obj) or canonical_hash(obj)
+    )
+
+    data_hash = connection.data_hash()
+    assert len(hashed) == 1 + len(connection.data["models"]) + 1
+    hashed.clear()
+    assert connection.data_hash() == data_hash
+    # Only the data outside of the models and the digests of the models are hashed:
+    assert len(hashed) == 2
+
+    snapshot = connection.snapshot()
+    objects["mono_crystal"].h.set(2)
+    hashed.clear()
+    new_data_hash = connection.data_hash()
+    assert new_data_hash != data_hash
+    assert connection.data["models"]["beamline"] in hashed
+    assert not any(model in hashed for name, model in connection.data["models"].items() if name != "beamline")
+    # The snapshot has the data at the time it was taken:
+    assert snapshot.data_hash() == data_hash
+    assert connection.data_hash() == new_data_hash
+    # The fields controlling the runs are ignored:
+    connection.data["forceRun"] = True
+    assert connection.data_hash() == new_data_hash
+
+
+def test_beamline_elements_downstream_modifications(fake_sirepo, simulation_routes, fake_crystal_simulation):
+    simulation_routes(status_calls=1)
+    watchpoints = [
+        {"id": 2, "title": "W1", "type": "watch", "position": 10},
+        {"id": 3, "title": "W2", "type": "watch", "position": 30},
+    ]
+    connection, objects = fake_crystal_simulation(extra_elements=watchpoints, skip_clean_runs=True)
+
+    def run_watchpoints():
+        results = {}
+        for report in ("watchpointReport2", "watchpointReport3"):
+            connection.data["report"] = report
+            results[report] = connection.run_and_download()
+        return results
+
+    run_watchpoints()
+
+    # The crystal is downstream of the first watchpoint only:
+    objects["mono_crystal"].h.set(2)
+    objects["mono_crystal_propagation"].resize_after.set(1)
+    num_runs = len(fake_sirepo.requests)
+    assert not connection.is_modified("watchpointReport2")
+    assert connection.is_modified("watchpointReport3")
+    results = run_watchpoints()
+    assert results["watchpointReport2"].cached
+    assert not results["watchpointReport3"].cached
+    assert [path for _, path, _ in fake_sirepo.requests[num_runs:]] == [
+        "/run-simulation",
+        "/run-status",
+        "/download-data-file/srw/00000000/watchpointReport3/-1",
+    ]
+
+    # Moving an element may change all the reports:
+    objects["mono_crystal"].element_position.set(5)
+    assert connection.is_modified("watchpointReport2")
+    assert connection.is_modified("watchpointReport3")
+
+
+def test_report_group(
+    fake_sirepo, make_dirs, simulation_routes, fake_crystal_simulation, srw_datafile, RE, documents
+):
+    simulation_routes(status_calls=2)
+    watchpoints = [
+        {"id": i, "title": f"W{i}", "type": "watch", "position": 10 * i, "histogramBins": 100} for i in (2, 3, 4)
+    ]
+    connection, objects = fake_crystal_simulation(extra_elements=watchpoints)
+    # The intensity at the watchpoint i is i:
+    fake_sirepo.routes["download-data-file"] = lambda path, payload: (
+        200,
+        srw_datafile(np.full((3, 4), float(path.split("/")[-2][-1]))),
+    )
+    detectors = [objects["w2"], objects["w3"], objects["w4"]]
+    SirepoReportGroup(detectors)
+
+    RE(bp.count(detectors, num=2))
+
+    events = [doc for name, doc in documents if name == "event"]
+
+    assert [event["data"]["w2_flux"] for event in events] == [24, 24]
+    assert [event["data"]["w4_flux"] for event in events] == [48, 48]
+    paths = [path.split("/")[1] for _, path, _ in fake_sirepo.requests[1:]]
+    # The simulations of the three watchpoints run together at each step:
+    step = ["run-simulation"] * 3 + ["run-status"] * 6 + ["download-data-file"] * 3
+    assert len(paths) == 2 * len(step)
+    num_requests = len(step)
+    for step_paths in (paths[:num_requests], paths[num_requests:]):
+        assert sorted(step_paths) == sorted(step)
+        last_run = len(step_paths) - step_paths[::-1].index("run-simulation") - 1
+        assert last_run < step_paths.index("download-data-file")
+
+
+def test_report_group_runs_at_each_round(
+    fake_sirepo, make_dirs, simulation_routes, fake_crystal_simulation, srw_datafile, RE
+):
+    simulation_routes(status_calls=1)
+    watchpoints = [{"id": i, "title": f"W{i}", "type": "watch", "position": 10 * i} for i in (2, 3, 4)]
+    connection, objects = fake_crystal_simulation(extra_elements=watchpoints)
+    fake_sirepo.routes["download-data-file"] = lambda path, payload: (200, srw_datafile(np.ones((3, 4))))
+    w2, w3, w4 = objects["w2"], objects["w3"], objects["w4"]
+    SirepoReportGroup([w2, w3, w4])
+
+    def runs():
+        return sum(path == "/run-simulation" for _, path, _ in fake_sirepo.requests)
+
+    @bpp.stage_decorator([w2, w3, w4])
+    @bpp.run_decorator()
+    def plan():
+        # Nothing is modified, but each step runs the reports again:
+        for _ in range(2):
+            yield from bps.trigger_and_read([w2, w3, w4])
+        assert runs() == 2 * 3
+        # The devices which were not triggered in a step don't get its results at the next step:
+        yield from bps.trigger_and_read([w2], name="upstream")
+        yield from bps.trigger_and_read([w3, w4], name="downstream")
+        assert runs() == 4 * 3
+
+    RE(plan())
+
+
+def test_watchpoints_trigger_in_background(
+    fake_sirepo, make_dirs, simulation_routes, fake_crystal_simulation, srw_datafile
+):
+    simulation_routes(status_calls=3)
+    watchpoints = [{"id": i, "title": f"W{i}", "type": "watch", "position": 10 * i} for i in (2, 3)]
+    connection, objects = fake_crystal_simulation(extra_elements=watchpoints)
+    fake_sirepo.routes["download-data-file"] = lambda path, payload: (200, srw_datafile(np.ones((3, 4))))
+
+    statuses = [objects["w2"].trigger(), objects["w3"].trigger()]
+    assert not any(status.done for status in statuses)
+    # The simulations run with the data at the time of the triggers:
+    objects["mono_crystal"].h.set(2)
+    for status in statuses:
+        status.wait(timeout=10)
+
+    assert objects["w2"].flux.get() == objects["w3"].flux.get() == 12
+    timings = objects["w2"].timings
+    assert timings["status_calls"] == 3
+    assert timings["download_bytes"] == len(srw_datafile(np.ones((3, 4))))
+    assert timings["parse"] > 0 and timings["stats"] > 0
+    assert objects["w2"].parse_time.get() == timings["parse"]
+    assert "w2_download_bytes" in objects["w2"].read_configuration()
+    assert "w2_parse_time" not in objects["w2"].read()
+    runs = [payload for _, path, payload in fake_sirepo.requests if path == "/run-simulation"]
+    assert [run["models"]["beamline"][0]["h"] for run in runs] == [1, 1]
+    resources = [doc for name, doc in objects["w3"].collect_asset_docs() if name == "resource"]
+    json_resource = next(doc for doc in resources if doc["spec"] == "SIREPO_DATA_JSON")
+    handler = SirepoDataJSONHandler(os.path.join(json_resource["root"], json_resource["resource_path"]))
+    assert json.loads(handler())["report"] == "watchpointReport3"
+    # Both simulations ran at the same time:
+    paths = [path.split("/")[1] for _, path, _ in fake_sirepo.requests]
+    assert paths.index("download-data-file") > max(i for i, path in enumerate(paths) if path == "run-simulation")
+
+
+def test_sirepo_data_recorded_once(fake_watchpoint, RE, documents):
+    connection, objects, w2 = fake_watchpoint()
+
+    RE(bp.list_scan([w2], objects["mono_crystal"].h, [1, 1, 2, 2, 2]))
+
+    events = [doc for name, doc in documents if name == "event"]
+    resources = [doc for name, doc in documents if name == "resource" and doc["spec"] == "SIREPO_DATA_JSON"]
+    data_hashes = [event["data"]["w2_sirepo_data_hash"] for event in events]
+    datum_ids = [event["data"]["w2_sirepo_data_json"] for event in events]
+    # The data is only recorded when it changes:
+    assert len(resources) == len(set(data_hashes)) == len(set(datum_ids)) == 2
+    assert datum_ids[0] == datum_ids[1] != datum_ids[2] == datum_ids[3] == datum_ids[4]
+    recorded = [
+        json.loads(SirepoDataJSONHandler(os.path.join(doc["root"], doc["resource_path"]))()) for doc in resources
+    ]
+    assert [data["models"]["beamline"][0]["h"] for data in recorded] == [1, 2]
+    assert all("forceRun" not in data for data in recorded)
+    descriptor = next(doc for name, doc in documents if name == "descriptor")
+    assert descriptor["data_keys"]["w2_sirepo_data_json"]["external"] == "FILESTORE:"
+
+
+def test_sirepo_data_modified_directly_between_runs(fake_watchpoint, RE, documents):
+    connection, objects, w2 = fake_watchpoint()
+
+    RE(bp.count([w2]))
+    # A modification which is not recorded with mark_modified():
+    connection.data["models"]["simulation"]["photonEnergy"] = 1000
+    RE(bp.count([w2]))
+
+    resources = [doc for name, doc in documents if name == "resource" and doc["spec"] == "SIREPO_DATA_JSON"]
+    recorded = [
+        json.loads(SirepoDataJSONHandler(os.path.join(doc["root"], doc["resource_path"]))()) for doc in resources
+    ]
+    assert [data["models"]["simulation"]["photonEnergy"] for data in recorded] == [9000, 1000]
+
+
+def test_watchpoint_datafiles_written_in_background(fake_watchpoint, srw_datafile, RE, documents):
+    connection, objects, w2 = fake_watchpoint()
+
+    # The directories of the datafiles are created by the writes:
+    RE(bp.count([w2], num=2))
+
+    assert [doc["data"]["w2_flux"] for name, doc in documents if name == "event"] == [12, 12]
+    resources = [doc for name, doc in documents if name == "resource" and doc["spec"] == "srw"]
+    assert len(resources) == 2
+    for resource in resources:
+        path = os.path.join(resource["root"], resource["resource_path"])
+        assert open(path, "rb").read() == srw_datafile(np.ones((3, 4)))
+        assert not os.path.exists(f"{path}.part")
+        assert SRWFileHandler(path, **resource["resource_kwargs"])().shape == (3, 4)
+
+
+def test_watchpoint_npy_sidecars(fake_watchpoint, RE, documents):
+    image = np.arange(12.0).reshape((3, 4))
+    connection, objects, w2 = fake_watchpoint(image, npy_sidecars=True)
+
+    RE(bp.count([w2], num=2))
+
+    resources = [doc for name, doc in documents if name == "resource" and doc["spec"] == "srw"]
+    assert len(resources) == 2
+    for resource in resources:
+        path = os.path.join(resource["root"], resource["resource_path"])
+        assert os.path.exists(f"{path}.npy")
+        # The sidecar is memory-mapped instead of parsing the datafile:
+        os.remove(path)
+        data = SRWFileHandler(path, **resource["resource_kwargs"])()
+        assert isinstance(data, np.memmap)
+        np.testing.assert_array_equal(data, image)
+
+
+ROI_KEYS = ("flux", "x", "y", "fwhm_x", "fwhm_y")
+
+
+def test_watchpoint_rois(fake_watchpoint, RE, documents):
+    image = np.arange(12.0).reshape((3, 4))
+    rois = [(0, 1, 0, 2), (1.5, 3, 1, 2)]
+    datafile_kwargs = dict(horizontal_extent=(0, 3), vertical_extent=(0, 2))
+    connection, objects, w2 = fake_watchpoint(image, datafile_kwargs, rois=rois)
+    with pytest.raises(ValueError, match="Invalid ROI"):
+        type(w2)(name="w2", rois=[(1, 0, 0, 1)])
+    assert w2.hints["fields"] == ["w2_flux", *[f"w2_roi{i}_{key}" for i in (1, 2) for key in ROI_KEYS]]
+
+    RE(bp.count([w2]))
+
+    (descriptor,) = [doc for name, doc in documents if name == "descriptor"]
+    assert descriptor["configuration"]["w2"]["data"]["w2_roi2_region"] == [1.5, 3, 1, 2]
+    (event,) = [doc for name, doc in documents if name == "event"]
+    assert "w2_roi3_flux" not in event["data"]
+    assert event["data"]["w2_roi1_flux"] == image[:, :2].sum()
+    assert event["data"]["w2_roi2_flux"] == image[1:, 2:].sum()
+    assert event["data"]["w2_roi2_x"] == pytest.approx((2 * 16 + 3 * 18) / 34)
+    assert event["data"]["w2_roi2_y"] == pytest.approx((1 * 13 + 2 * 21) / 34)
+
+
+def test_sidecar_written_before_datafile(tmp_path):
+    # The sidecar and the datafile are written concurrently, the sidecar may be first in a new directory:
+    path = tmp_path / "2024" / "01" / "02" / "datafile.dat"
+    utils.write_sidecar(path, np.arange(3.0))
+    write_datafile(path, b"content")
+    np.testing.assert_array_equal(utils.load_sidecar(path), np.arange(3.0))
+
+
+def test_watchpoint_images_in_hdf5(fake_watchpoint, tmp_path, RE, documents):
+    # The shape of the images changes during the scan:
+    images = [np.full((3, 4), 1.5), np.full((3, 4), 2.5), np.arange(20.0).reshape((4, 5))]
+    connection, objects, w2 = fake_watchpoint(images, asset_format="hdf5", image_dtype="float32")
+
+    RE(bp.list_scan([w2], objects["mono_crystal"].h, [1, 2, 3]))
+
+    resources = [doc for name, doc in documents if name == "resource" and doc["spec"] != "SIREPO_DATA_JSON"]
+    assert [doc["spec"] for doc in resources] == ["SIREPO_HDF5"]
+    datums = [doc for name, doc in documents if name == "datum" and doc["resource"] == resources[0]["uid"]]
+    assert [doc["datum_kwargs"] for doc in datums] == [{"point_number": i} for i in range(3)]
+    events = [doc for name, doc in documents if name == "event"]
+    assert [event["data"]["w2_image"] for event in events] == [doc["datum_id"] for doc in datums]
+    # No datafile is kept:
+    assert [path.suffix for path in tmp_path.rglob("*.*") if path.parent.name != "sirepo_data"] == [".h5"]
+
+    handler = SirepoHDF5Handler(os.path.join(resources[0]["root"], resources[0]["resource_path"]))
+    for doc, image in zip(datums, images):
+        frame = handler(**doc["datum_kwargs"])
+        assert frame.dtype == np.float32
+        np.testing.assert_array_equal(frame, image)
+    np.testing.assert_array_equal(handler.get_frames(0, 2), np.stack(images[:2]))
+    assert handler.get_frames().shape == (3, 4, 5)
+    handler.close()
+
+
+def test_shadow_watchpoint_phase_space(fake_sirepo, tmp_path, simulation_routes, shadow_beam_file, RE, documents):
+    path = shadow_beam_file(tmp_path / "beam.dat")
+    simulation_routes(status_calls=1)
+    fake_sirepo.routes["download-data-file"] = lambda _, payload: (200, open(path, "rb").read())
+    data = {
+        "models": {
+            "simulation": {"folder": "/", "name": "fake"},
+            "beamline": [{"id": 2, "title": "W2", "type": "watch", "position": 20}],
+            "watchpointReport2": {"histogramBins": 20},
+        },
+        "simulationType": "shadow",
+    }
+    fake_sirepo.routes["auth-bluesky-login"] = lambda _, payload: (
+        200,
+        {"state": "ok", "schema": {}, "data": data},
+    )
+    connection = SirepoBluesky(fake_sirepo.url)
+    connection.auth("shadow", "00000000")
+    classes, _ = create_classes(connection, create_objects=False)
+    with pytest.raises(ValueError, match="Unknown phase-space products"):
+        classes["w2"](name="w2", phase_space=["x_y"])
+    w2 = classes["w2"](name="w2", root_dir=str(tmp_path), phase_space=["x_xp", "energy", "moments"])
+
+    RE(bp.count([w2]))
+
+    (event,) = [doc for name, doc in documents if name == "event"]
+    assert "w2_z_zp_histogram" not in event["data"]
+    columns = ray_columns(load_shadow_beam(path), (1, 4, 6, 3, 10, 11, 23))
+    expected = phase_space_histograms(columns, {"x_xp": (1, 4), "energy": (11,)}, nbins=20)
+    for name, (histogram, extent) in expected.items():
+        np.testing.assert_array_equal(event["data"][f"w2_{name}_histogram"], histogram)
+        np.testing.assert_array_equal(event["data"][f"w2_{name}_extent"], extent)
+    assert np.shape(event["data"]["w2_energy_histogram"]) == (20,)
+    for key, value in beam_moments(columns).items():
+        assert event["data"][f"w2_moments_{key}"] == value
+    # The X-Z histogram of the image is still recorded:
+    np.testing.assert_array_equal(event["data"]["w2_shape"], [20, 20])
+
+
+def test_watchpoint_simulations_cancelled(fake_sirepo, make_dirs, simulation_routes, fake_crystal_simulation, RE):
+    simulation_routes(status_calls=1000)
+    fake_sirepo.routes["run-cancel"] = lambda path, payload: (200, {"state": "canceled"})
+    watchpoints = [{"id": i, "title": f"W{i}", "type": "watch", "position": 10 * i} for i in (2, 3)]
+    connection, objects = fake_crystal_simulation(extra_elements=watchpoints)
+
+    # Unstaging a device during its trigger:
+    status = objects["w3"].trigger()
+    while not connection.active_reports:
+        time.sleep(0.01)
+    objects["w3"].unstage()
+    with pytest.raises(Exception, match="watchpointReport3 was cancelled"):
+        status.wait(timeout=1)
+
+    # Pausing (and aborting) a scan:
+    threading.Timer(0.5, RE.request_pause).start()
+    with pytest.raises(RunEngineInterrupted):
+        RE(bp.count([objects["w2"]]))
+    assert RE.state == "paused"
+    assert connection.active_reports == []
+    RE.abort()
+
+    cancels = [payload for _, path, payload in fake_sirepo.requests if path == "/run-cancel"]
+    assert [payload["report"] for payload in cancels] == ["watchpointReport3", "watchpointReport2"]
+
+
 def test_empty_simulation(srw_empty_simulation):
     classes, objects = create_classes(connection=srw_empty_simulation)
     globals().update(**objects)
@@ -377,7 +811,7 @@ def test_beam_statistics_report_and_watchpoint(RE, db, shadow_tes_simulation):
 
     (uid,) = RE(bp.scan([bsr, w9], toroid.r_maj, 10000, 50000, 5))  # noqa F821
     hdr = db[uid]
-    tbl = hdr.table()
+    tbl = hdr.table(fill=True)
     print(tbl)
 
     w9_data_1 = json.loads(tbl["w9_sirepo_data_json"][1])
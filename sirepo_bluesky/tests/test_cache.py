@@ -0,0 +1,182 @@
+import concurrent.futures
+import os
+
+import numpy as np
+import pytest
+
+from sirepo_bluesky.cache import HANDLER_CACHE, ComputeCache, HandlerCache, SimulationCache
+from sirepo_bluesky.sirepo_bluesky import SirepoBluesky
+from sirepo_bluesky.srw_handler import SRWFileHandler
+
+
+def _data(report="intensityReport", **models):
+    return {"models": {"simulation": {"name": "fake"}, **models}, "report": report}
+
+
+def test_simulation_cache_key():
+    key = SimulationCache.key("srw", _data(undulator={"period": 20, "length": 3}))
+    assert key == SimulationCache.key("srw", _data(undulator={"length": 3, "period": 20}))
+    assert key != SimulationCache.key("shadow", _data(undulator={"period": 20, "length": 3}))
+    assert key != SimulationCache.key("srw", _data(undulator={"period": 21, "length": 3}))
+    assert key != SimulationCache.key("srw", _data(report="watchpointReport12", undulator={"period": 20}))
+    assert key != SimulationCache.key("srw", _data(undulator={"period": 20, "length": 3}), file_index=0)
+
+    # The copies of a simulation have the same key:
+    copy = _data(undulator={"period": 20, "length": 3})
+    copy["models"]["simulation"].update({"name": "copy", "simulationId": "11111111"})
+    assert key == SimulationCache.key("srw", copy)
+
+
+def test_simulation_cache_lru_eviction(tmp_path):
+    cache = SimulationCache(tmp_path, max_bytes=2500)
+    for i in range(3):
+        cache.put(f"key{i}", {"state": "completed"}, os.urandom(1000))
+    assert len(cache) == 2
+    assert "key0" not in cache
+    assert cache.evictions == 1
+
+    # key1 becomes the most recently used entry
+    status, datafile = cache.get("key1")
+    assert status == {"state": "completed"}
+    assert datafile.stat().st_size == 1000
+    cache.put("key3", {"state": "completed"}, os.urandom(1000))
+    assert "key1" in cache
+    assert "key2" not in cache
+    assert cache.get("key2") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+    assert cache.size <= 2500
+
+    # The entries are reused by new instances of the cache:
+    assert set(SimulationCache(tmp_path)._entries) == {"key1", "key3"}
+
+
+def test_run_and_download_uses_cache(fake_sirepo, tmp_path, simulation_routes):
+    simulation_routes(status_calls=1)
+    cache = SimulationCache(tmp_path / "cache")
+    connection = SirepoBluesky(fake_sirepo.url, cache=cache)
+    connection.auth("srw", "00000000")
+    connection.data["report"] = "intensityReport"
+
+    result = connection.run_and_download(tmp_path / "first.dat", hash_name="md5")
+    assert not result.cached
+    num_requests = len(fake_sirepo.requests)
+
+    cached_result = connection.run_and_download(tmp_path / "second.dat", hash_name="md5")
+    assert cached_result.cached
+    assert cached_result.status == result.status
+    assert cached_result.hexdigest == result.hexdigest
+    assert (tmp_path / "second.dat").read_bytes() == (tmp_path / "first.dat").read_bytes()
+    assert connection.run_and_download().content == (tmp_path / "first.dat").read_bytes()
+    assert len(fake_sirepo.requests) == num_requests
+
+    connection.data["models"]["simulation"]["photonEnergy"] = 1000
+    assert not connection.run_and_download(tmp_path / "third.dat").cached
+    assert len(fake_sirepo.requests) > num_requests
+    assert cache.stats()["hits"] == 2
+
+
+def test_run_and_download_coalesces_identical_runs(fake_sirepo, tmp_path, simulation_routes):
+    calls = simulation_routes()
+    connection = SirepoBluesky(fake_sirepo.url, cache=SimulationCache(tmp_path / "cache"))
+    connection.auth("srw", "00000000")
+    connection.data["report"] = "intensityReport"
+    copies = [connection.copy_sim(f"copy {i}") for i in range(4)]
+    for copy in copies:
+        copy.data["report"] = "intensityReport"
+
+    with concurrent.futures.ThreadPoolExecutor(len(copies)) as executor:
+        results = list(executor.map(lambda copy: copy.run_and_download(), copies))
+
+    # Only one of the (identical) copies ran on the server:
+    assert len(calls) == 1
+    assert sum(result.cached for result in results) == len(copies) - 1
+    assert len({result.content for result in results}) == 1
+
+
+def _compute_route(path, payload):
+    element = dict(payload["optical_element"])
+    if payload["method"] == "crystal_init":
+        element["dSpacing"] = 3.1355
+    else:
+        element["energy"] = payload.get("photon_energy")
+    return 200, {"state": "completed", **element}
+
+
+def test_compute_cache(fake_sirepo, tmp_path, authenticated_client):
+    fake_sirepo.routes["stateless-compute"] = _compute_route
+    cache = ComputeCache(max_entries=4, cache_dir=tmp_path)
+    connection = authenticated_client(compute_cache=cache)
+    connection.data["models"]["simulation"]["photonEnergy"] = 9000
+
+    def num_computes():
+        return sum(path == "/stateless-compute" for _, path, _ in fake_sirepo.requests)
+
+    for _ in range(3):
+        res = connection.compute_crystal_orientation({"type": "crystal", "heightAmplitude": 1})
+        assert res.pop("state") == "completed"
+        assert res == {"type": "crystal", "heightAmplitude": 1, "dSpacing": 3.1355, "energy": 9000}
+        connection.compute_crl_characteristics({"type": "crl", "numberOfLenses": 2})
+    assert num_computes() == 3
+    assert cache.stats()["hits"] == 6
+
+    # A different photon energy is computed again:
+    connection.data["models"]["simulation"]["photonEnergy"] = 10000
+    assert connection.compute_crl_characteristics({"type": "crl", "numberOfLenses": 2})["energy"] == 10000
+    assert num_computes() == 4
+
+    # The least recently used responses are evicted, the others persist across sessions:
+    connection.compute_crl_characteristics({"type": "crl", "numberOfLenses": 3})
+    assert len(cache) == 4
+    assert cache.evictions == 1
+    assert len(ComputeCache(cache_dir=tmp_path)) == 4
+
+
+def test_handler_cache_lru_eviction(tmp_path):
+    cache = HandlerCache(max_bytes=2500)
+    paths = [tmp_path / f"datafile{i}.dat" for i in range(4)]
+    for path in paths:
+        path.write_bytes(b"")
+    reads = []
+
+    def read(i):
+        reads.append(i)
+        return np.full(100, i, dtype=np.float64)  # 800 bytes
+
+    for i in range(3):
+        assert cache.load("srw", paths[i], lambda: read(i))[0] == i
+    # The cached data is read-only:
+    data = cache.load("srw", paths[1], lambda: read(1))
+    with pytest.raises(ValueError):
+        data[0] = 0
+    # The budget holds 3 entries, the least recently used (0, then 2) are evicted:
+    cache.load("srw", paths[3], lambda: read(3))
+    cache.load("srw", paths[0], lambda: read(0))
+    assert cache.key("srw", paths[2]) not in cache
+    assert reads == [0, 1, 2, 3, 0]
+    assert cache.stats() == {"hits": 1, "misses": 5, "evictions": 2, "entries": 3, "size": 2400}
+
+    # Another read of a file is another entry:
+    cache.load("srw", paths[0], lambda: read(0), ndim=1)
+    assert reads[-1] == 0 and len(reads) == 6
+    # The data larger than the budget is not cached:
+    assert cache.put("large", np.zeros(1000)).size == 1000
+    assert "large" not in cache
+
+
+def test_srw_handlers_share_cache(tmp_path, srw_datafile):
+    HANDLER_CACHE.clear()
+    path = tmp_path / "intensity.dat"
+    path.write_bytes(srw_datafile(np.ones((3, 4))))
+    hits = HANDLER_CACHE.hits
+
+    first = SRWFileHandler(str(path))()
+    second = SRWFileHandler(str(path))()
+    assert second is first
+    assert HANDLER_CACHE.hits == hits + 1
+
+    # A modified datafile is read again:
+    path.write_bytes(srw_datafile(np.full((4, 5), 2.0)))
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+    assert SRWFileHandler(str(path))().shape == (4, 5)
+    HANDLER_CACHE.clear()
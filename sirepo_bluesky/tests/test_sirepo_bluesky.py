@@ -0,0 +1,577 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pytest
+
+from sirepo_bluesky import utils
+from sirepo_bluesky.async_sirepo_bluesky import AsyncSirepoBluesky
+from sirepo_bluesky.cache import SimulationCache
+from sirepo_bluesky.shadow_handler import (
+    PHASE_SPACE_PROJECTIONS,
+    ShadowFileHandler,
+    histogram2d,
+    load_shadow_beam,
+    read_shadow_file,
+    write_ray_columns,
+)
+from sirepo_bluesky.sirepo_bluesky import (
+    TIMING_COUNTS,
+    TIMING_PHASES,
+    SimulationPoller,
+    SirepoBlueskyClientException,
+)
+from sirepo_bluesky.srw_handler import load_srw_buffer, load_srw_file, read_srw_buffer, read_srw_file
+
+
+def test_session_is_reused(fake_sirepo, authenticated_client):
+    fake_sirepo.routes["simulation-list"] = lambda path, payload: (200, [])
+    connection = authenticated_client()
+
+    for _ in range(10):
+        connection.simulation_list()
+
+    # All requests go through a single keep-alive connection:
+    assert len(fake_sirepo.requests) == 11
+    assert len(fake_sirepo.connections) == 1
+
+
+def test_copy_sim_shares_session(fake_sirepo, authenticated_client):
+    fake_sirepo.routes["copy-simulation"] = lambda path, payload: (
+        200,
+        {"models": {"simulation": {"simulationId": "11111111", "folder": "/", "name": payload["name"]}}},
+    )
+    connection = authenticated_client(pool_size=4)
+
+    copy = connection.copy_sim("copy")
+    assert copy.sim_id == "11111111"
+    assert copy.session is connection.session
+    assert copy.pool_size == 4
+
+
+def test_session_is_recreated_after_fork(fake_sirepo, authenticated_client):
+    connection = authenticated_client()
+    session = connection.session
+    connection._session_pid = os.getpid() + 1  # pretend the client was forked
+    assert connection.session is not session
+
+
+@pytest.mark.parametrize("status_codes, expected_calls", [([503, 502, 200], 3), ([200], 1)])
+def test_idempotent_requests_are_retried(fake_sirepo, status_codes, expected_calls, authenticated_client):
+    responses = iter(status_codes)
+    fake_sirepo.routes["simulation-list"] = lambda path, payload: (next(responses), [])
+    connection = authenticated_client()
+
+    assert connection.simulation_list() == []
+    assert len(fake_sirepo.requests) == 1 + expected_calls
+
+
+def test_retries_are_bounded(fake_sirepo, authenticated_client):
+    fake_sirepo.routes["simulation-list"] = lambda path, payload: (503, [])
+    connection = authenticated_client(max_retries=2)
+
+    with pytest.raises(SirepoBlueskyClientException, match="status: 503"):
+        connection.simulation_list()
+    assert len(fake_sirepo.requests) == 1 + 3
+
+
+def test_non_idempotent_requests_are_not_retried(fake_sirepo, authenticated_client):
+    fake_sirepo.routes["run-simulation"] = lambda path, payload: (503, {})
+    connection = authenticated_client()
+    connection.data["report"] = "intensityReport"
+
+    with pytest.raises(SirepoBlueskyClientException, match="status: 503"):
+        connection.run_simulation()
+    assert len(fake_sirepo.requests) == 1 + 1
+
+
+@pytest.mark.parametrize("intensity", [np.arange(12.0).reshape((3, 4)), np.arange(1.0, 6.0)])
+def test_srw_buffer_same_as_file(intensity, tmp_path, srw_datafile):
+    content = srw_datafile(intensity, horizontal_extent=(-2e-3, 1e-3))
+    path = tmp_path / "datafile.dat"
+    path.write_bytes(content)
+
+    from_file = read_srw_file(path, ndim=intensity.ndim)
+    from_buffer = read_srw_buffer(content, ndim=intensity.ndim)
+
+    assert from_buffer.keys() == from_file.keys()
+    for key, value in from_file.items():
+        np.testing.assert_equal(from_buffer[key], value, err_msg=key)
+
+
+@pytest.mark.parametrize(
+    "body, match",
+    [(b"1.0\n2.0\nnan?\n", "could not convert"), (b"1.0\n2.0\n", "has 2 values, 12 are expected")],
+)
+def test_srw_buffer_malformed_datafile(body, match, srw_datafile):
+    header = srw_datafile(np.zeros((3, 4))).split(b"\n")[:10]
+    with pytest.raises(ValueError, match=match):
+        load_srw_buffer(b"\n".join(header) + b"\n" + body)
+
+
+@pytest.mark.parametrize("mesh", [(1, 40, 30), (50, 1, 1)])
+def test_srw_loader_same_as_srwpy(mesh, tmp_path):
+    srwlib = pytest.importorskip("srwpy.srwlib")
+    srw_io = pytest.importorskip("srwpy.uti_plot_com")
+    ne, nx, ny = mesh
+    intensity = np.random.default_rng(0).random(ne * nx * ny) * 1e12
+    path = tmp_path / "intensity.dat"
+    # A datafile written by SRW, with the number of components in the header:
+    srwlib.srwl_uti_save_intens_ascii(
+        intensity, srwlib.SRWLRadMesh(100, 200, ne, -1e-3, 1e-3, nx, -2e-3, 2e-3, ny), str(path)
+    )
+
+    data, _, ranges, labels, units = srw_io.file_load(str(path))
+    for loaded in (load_srw_file(path), load_srw_buffer(path.read_bytes())):
+        np.testing.assert_array_equal(loaded[0], np.array(data))
+        assert loaded[1:] == (tuple(ranges), labels, units)
+
+
+def _meshgrid_beam_stats(image, x_extent, y_extent):
+    """The moments of the beam computed over the whole image."""
+    X, Y = np.meshgrid(np.linspace(*x_extent, image.shape[1]), np.linspace(*y_extent, image.shape[0]))
+    image = image.astype(np.float64)
+    mean_x, mean_y = np.sum(X * image) / image.sum(), np.sum(Y * image) / image.sum()
+    sigma_x = np.sqrt(np.sum((X - mean_x) ** 2 * image) / image.sum())
+    sigma_y = np.sqrt(np.sum((Y - mean_y) ** 2 * image) / image.sum())
+    skewness_x = np.sum((X - mean_x) ** 3 * image) / image.sum() / sigma_x**3
+    return mean_x, mean_y, sigma_x, sigma_y, skewness_x
+
+
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_beam_stats_from_marginals(dtype):
+    x, y = np.meshgrid(np.linspace(-1, 1, 300), np.linspace(-2, 2, 200))
+    # A skewed beam, centered on (0.2, -0.5):
+    image = np.exp(-((x - 0.2) ** 2) / 0.02 - (y + 0.5) ** 2 / 0.1) * (1 + 0.5 * np.tanh(5 * (x - 0.2)))
+    image = image.astype(dtype)
+
+    stats = utils.get_beam_stats(image, [-1, 1], [-2, 2], percentiles=(0, 50, 100))
+    mean_x, mean_y, sigma_x, sigma_y, skewness_x = _meshgrid_beam_stats(image, [-1, 1], [-2, 2])
+    assert stats["shape"] == (200, 300)
+    assert stats["flux"] == pytest.approx(image.sum(dtype=np.float64), rel=1e-12)
+    assert stats["mean"] == pytest.approx(stats["flux"] / image.size, rel=1e-12)
+    assert stats["x"] == pytest.approx(mean_x, rel=1e-9)
+    assert stats["y"] == pytest.approx(mean_y, rel=1e-9)
+    assert stats["fwhm_x"] == pytest.approx(utils.sigma_to_fwhm * sigma_x, rel=1e-9)
+    assert stats["fwhm_y"] == pytest.approx(utils.sigma_to_fwhm * sigma_y, rel=1e-9)
+    assert stats["skewness_x"] == pytest.approx(skewness_x, rel=1e-9) and abs(skewness_x) > 0.01
+    assert abs(stats["skewness_y"]) < 1e-6
+    assert stats["peak"] == image.max()
+    peak = np.unravel_index(image.argmax(), image.shape)
+    assert (stats["peak_x"], stats["peak_y"]) == (x[peak], y[peak])
+    assert stats["percentiles_y"][1] == pytest.approx(-0.5, abs=4 / 199)
+    np.testing.assert_array_equal(stats["percentiles_x"][[0, 2]], [-1, 1])
+
+
+def test_beam_stats_without_flux():
+    stats = utils.get_beam_stats(np.zeros((3, 4)), [-1, 1], [-1, 1])
+    assert stats["flux"] == 0 and stats["mean"] == 0
+    for key in ("x", "y", "fwhm_x", "fwhm_y", "peak", "peak_x", "peak_y", "skewness_x", "skewness_y"):
+        assert np.isnan(stats[key])
+    assert np.isnan(stats["percentiles_x"]).all() and stats["percentiles_x"].shape == (3,)
+
+
+def test_roi_stats_same_as_slicing():
+    image = np.random.default_rng(0).random((40, 60))
+    rois = [(-1, 1, -2, 2), (-0.5, 0.2, 0.1, 1.5), (0.3, 0.3, -1, 1), (2, 3, -2, 2)]
+    stats = utils.get_roi_stats(image, [-1, 1], [-2, 2], rois)
+    x, y = np.linspace(-1, 1, 60), np.linspace(-2, 2, 40)
+    for i, (x_min, x_max, y_min, y_max) in enumerate(rois):
+        columns = (x >= x_min) & (x <= x_max)
+        rows = (y >= y_min) & (y <= y_max)
+        roi = image[np.ix_(rows, columns)]
+        assert stats["flux"][i] == pytest.approx(roi.sum(), rel=1e-12, abs=1e-12)
+        if not roi.size:
+            assert np.isnan([stats[key][i] for key in ("x", "y", "fwhm_x", "fwhm_y")]).all()
+            continue
+        expected = utils.get_beam_stats(roi, x[columns][[0, -1]], y[rows][[0, -1]])
+        for key in ("x", "y", "fwhm_x", "fwhm_y"):
+            assert stats[key][i] == pytest.approx(expected[key], rel=1e-9, abs=1e-12)
+    # The whole image:
+    expected = utils.get_beam_stats(image, [-1, 1], [-2, 2])
+    assert stats["flux"][0] == pytest.approx(expected["flux"], rel=1e-12)
+    assert stats["fwhm_y"][0] == pytest.approx(expected["fwhm_y"], rel=1e-9)
+
+
+def test_shadow_reader_same_as_shadow3(tmp_path, shadow_beam_file):
+    sd = pytest.importorskip("Shadow.ShadowLibExtensions")
+    shadow_tools = pytest.importorskip("Shadow.ShadowTools")
+    path = shadow_beam_file(tmp_path / "beam.dat")
+
+    beam = sd.Beam()
+    beam.load(path)
+    np.testing.assert_array_equal(load_shadow_beam(path), beam.rays)
+    for nbins in (10, 101):
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            expected = beam.histo2(1, 3, nolost=1, nbins=nbins)
+            energies = shadow_tools.getshcol(path, col=11)
+        ret = read_shadow_file(path, histogram_bins=nbins)
+        np.testing.assert_allclose(ret["data"], expected["histogram"], rtol=1e-12)
+        np.testing.assert_allclose(ret["horizontal_extent"], 1e3 * np.array(expected["xrange"][:2]))
+        np.testing.assert_allclose(ret["vertical_extent"], 1e3 * np.array(expected["yrange"][:2]))
+        assert ret["photon_energy"] == pytest.approx(np.mean(energies), rel=1e-12)
+
+
+@pytest.mark.parametrize("xrange, yrange", [([-1, 1], [-2, 2]), ([0.25, 0.25], [-2, 2]), ([0, 0], [1, 1])])
+def test_histogram2d_same_as_numpy(xrange, yrange):
+    rng = np.random.default_rng(0)
+    x, y = rng.normal(size=1000), 2 * rng.normal(size=1000)
+    x[:10], y[10:20] = 0.25, 1.0  # values on the bounds of the degenerate ranges
+    weights = rng.random(1000)
+    expected, _, _ = np.histogram2d(x, y, bins=10, range=[xrange, yrange], weights=weights)
+    np.testing.assert_allclose(histogram2d(x, y, 10, xrange, yrange, weights=weights), expected, rtol=1e-12)
+    with pytest.raises(ValueError, match="reversed"):
+        histogram2d(x, y, 10, [1, -1], yrange)
+    with pytest.raises(ValueError, match="not finite"):
+        histogram2d(x, y, 10, xrange, [-np.inf, 1])
+
+
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_shadow_handler_rebins_ray_columns(tmp_path, dtype, shadow_beam_file):
+    sd = pytest.importorskip("Shadow.ShadowLibExtensions")
+    source = shadow_beam_file(tmp_path / "source.dat")
+    path = str(tmp_path / "assets" / "beam.dat")
+
+    # The columns may be written before the datafile, in a new directory:
+    columns = write_ray_columns(path, load_shadow_beam(source), columns=(1, 3, 4, 6, 23), dtype=dtype)
+    shutil.copyfile(source, path)
+    beam = sd.Beam()
+    beam.load(path)
+    assert columns == (1, 3, 4, 6, 23, 10)
+    table = np.load(f"{path}.rays.npy")
+    assert table.shape == (6, len(beam.rays)) and table.dtype == dtype
+
+    handler = ShadowFileHandler(path, histogram_bins=10, ray_columns=columns)
+    rtol = 1e-12 if dtype == "float64" else 1e-5
+    np.testing.assert_allclose(handler(), read_shadow_file(path, histogram_bins=10)["data"], rtol=1e-12)
+    # The rays are histogrammed again with the bins, ranges and columns requested at read time:
+    os.remove(path)
+    for kwargs in ({"nbins": 33}, {"col_h": 4, "col_v": 6, "nbins": 20}, {"xrange": [-0.01, 0.01], "nolost": 0}):
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            expected = beam.histo2(
+                kwargs.get("col_h", 1),
+                kwargs.get("col_v", 3),
+                nbins=kwargs.get("nbins", 10),
+                nolost=kwargs.get("nolost", 1),
+                ref=23,
+                xrange=kwargs.get("xrange"),
+            )
+        np.testing.assert_allclose(handler(**kwargs), expected["histogram"], rtol=rtol, atol=1e-6)
+    with pytest.raises(FileNotFoundError):
+        handler(col_h=11)  # not a stored column
+
+
+def test_shadow_phase_space_same_as_shadow3(tmp_path, shadow_beam_file):
+    sd = pytest.importorskip("Shadow.ShadowLibExtensions")
+    path = shadow_beam_file(tmp_path / "beam.dat")
+    beam = sd.Beam()
+    beam.load(path)
+
+    ret = read_shadow_file(path, histogram_bins=10, phase_space=list(PHASE_SPACE_PROJECTIONS), phase_space_bins=30)
+    products = ret["phase_space"]
+    assert list(products) == list(PHASE_SPACE_PROJECTIONS)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for name, cols in PHASE_SPACE_PROJECTIONS.items():
+            histogram, extent = products[name]
+            if len(cols) == 2:
+                expected = beam.histo2(*cols, nbins=30, nolost=1, ref=23)
+                np.testing.assert_allclose(extent, [*expected["xrange"][:2], *expected["yrange"][:2]])
+            else:
+                expected = beam.histo1(*cols, nbins=30, nolost=1, ref=23)
+                np.testing.assert_allclose(extent, expected["xrange"])
+            np.testing.assert_allclose(histogram, expected["histogram"], rtol=1e-12)
+    assert "moments" not in ret
+
+    ret = read_shadow_file(path, histogram_bins=10, phase_space=["moments"])
+    assert ret["phase_space"] == {}
+    x, xp, z, zp, weights = beam.getshcol((1, 4, 3, 6, 23), nolost=1)
+    for plane, (u, up) in {"x": (x, xp), "z": (z, zp)}.items():
+        covariance = np.cov(u, up, aweights=weights, bias=True)
+        moments = ret["moments"]
+        assert moments[f"sigma_{plane}"] == pytest.approx(np.sqrt(covariance[0, 0]), rel=1e-9)
+        assert moments[f"sigma_{plane}p"] == pytest.approx(np.sqrt(covariance[1, 1]), rel=1e-9)
+        assert moments[f"cov_{plane}_{plane}p"] == pytest.approx(covariance[0, 1], rel=1e-9, abs=1e-30)
+        assert moments[f"emittance_{plane}"] == pytest.approx(np.sqrt(np.linalg.det(covariance)), rel=1e-6)
+
+
+def test_async_client_runs_simulations_concurrently(fake_sirepo, simulation_routes):
+    calls = simulation_routes()
+    num_copies = 20
+
+    async def run():
+        async with AsyncSirepoBluesky(fake_sirepo.url) as connection:
+            await connection.auth("srw", "00000000")
+            copies = [await connection.copy_sim(f"copy {i}") for i in range(num_copies)]
+            for copy in copies:
+                assert copy.session is connection.session
+                copy.data["report"] = "intensityReport"
+            results = await asyncio.gather(*[copy.run_simulation() for copy in copies])
+            datafiles = await asyncio.gather(*[copy.get_datafile() for copy in copies])
+            return copies, results, datafiles
+
+    start_time = time.monotonic()
+    copies, results, datafiles = asyncio.run(run())
+    elapsed_time = time.monotonic() - start_time
+
+    assert len(calls) == num_copies
+    assert all(count == 3 for count in calls.values())
+    for copy, (res, duration), datafile in zip(copies, results, datafiles):
+        assert res == {"state": "completed", "simulationId": copy.sim_id}
+        assert datafile == f"/download-data-file/srw/{copy.sim_id}/intensityReport/-1".encode()
+    # The status polls of all simulations are interleaved:
+    assert elapsed_time < num_copies * 0.3
+
+
+def test_async_client_runs_reports(fake_sirepo, tmp_path, simulation_routes):
+    simulation_routes(status_calls=1)
+    reports = ["watchpointReport2", "watchpointReport3", "intensityReport"]
+
+    async def run():
+        async with AsyncSirepoBluesky(fake_sirepo.url) as connection:
+            await connection.auth("srw", "00000000")
+            connection.data["report"] = "intensityReport"
+            result = await connection.run_and_download(tmp_path / "datafile.dat", hash_name="md5")
+            results = await connection.run_reports(reports)
+            return connection, result, results
+
+    connection, result, results = asyncio.run(run())
+    datafile = b"/download-data-file/srw/00000000/intensityReport/-1"
+    assert (tmp_path / "datafile.dat").read_bytes() == datafile
+    assert result.hexdigest == hashlib.md5(datafile).hexdigest() and not result.cached
+    assert list(results) == reports
+    for report, report_result in results.items():
+        assert report_result.content == f"/download-data-file/srw/00000000/{report}/-1".encode()
+        assert not connection.is_modified(report)
+    assert connection.data["report"] == "intensityReport"
+
+
+@pytest.mark.parametrize("option", ["cache", "skip_clean_runs", "defer_compute"])
+def test_async_client_rejects_sync_options(option, tmp_path):
+    value = {"cache": SimulationCache(tmp_path), "skip_clean_runs": True, "defer_compute": True}[option]
+    with pytest.raises(TypeError, match=option):
+        AsyncSirepoBluesky("http://localhost:8000", **{option: value})
+
+
+def test_async_client_has_no_sync_entry_points():
+    connection = AsyncSirepoBluesky("http://localhost:8000")
+    for name in ("cached_result", "cache_result", "deferred_compute", "_start_simulation", "_post"):
+        assert not hasattr(connection, name), name
+    with pytest.raises(TypeError, match="SirepoBluesky clients"):
+        SimulationPoller().submit(connection)
+
+
+def test_poller_resolves_simulations_out_of_order(fake_sirepo, simulation_routes, authenticated_client):
+    simulation_routes()
+    remaining_calls = {}
+
+    def run_status(path, payload):
+        remaining_calls[payload["simulationId"]] -= 1
+        if remaining_calls[payload["simulationId"]] > 0:
+            return 200, {"state": "running", "nextRequestSeconds": 0.05, "nextRequest": payload}
+        return 200, {"state": "completed"}
+
+    fake_sirepo.routes["run-status"] = run_status
+    connection = authenticated_client()
+    copies = [connection.copy_sim(f"copy {i}") for i in range(10)]
+
+    poller = SimulationPoller()
+    futures = {}
+    for i, copy in enumerate(copies):
+        # The simulations of the later copies finish first:
+        remaining_calls[copy.sim_id] = len(copies) - i
+        copy.data["report"] = "intensityReport"
+        futures[poller.submit(copy)] = copy
+
+    finished = []
+    for future in concurrent.futures.as_completed(futures, timeout=10):
+        res, duration = future.result()
+        assert res["state"] == "completed"
+        finished.append(futures[future].sim_id)
+    poller.shutdown()
+
+    assert finished == [copy.sim_id for copy in reversed(copies)]
+
+
+def test_poller_reports_failed_simulations(fake_sirepo, simulation_routes, authenticated_client):
+    simulation_routes()
+    fake_sirepo.routes["run-status"] = lambda path, payload: (200, {"state": "error"})
+    connection = authenticated_client()
+    connection.data["report"] = "intensityReport"
+
+    poller = SimulationPoller()
+    future = poller.submit(connection)
+    with pytest.raises(SirepoBlueskyClientException, match="failed to complete: error"):
+        future.result(timeout=10)
+    poller.shutdown()
+
+
+def test_poller_max_status_calls(fake_sirepo, simulation_routes, authenticated_client):
+    simulation_routes(status_calls=100)
+    connection = authenticated_client()
+    connection.data["report"] = "intensityReport"
+
+    poller = SimulationPoller(max_status_calls=2)
+    future = poller.submit(connection)
+    with pytest.raises(SirepoBlueskyClientException, match="failed to complete: running"):
+        future.result(timeout=10)
+    poller.shutdown()
+    assert len(fake_sirepo.requests) == 1 + 1 + 2
+
+
+@pytest.mark.parametrize("hash_name", [None, "md5", "sha256"])
+def test_download_datafile(fake_sirepo, tmp_path, hash_name, authenticated_client):
+    content = os.urandom(1_000_000)
+    fake_sirepo.routes["download-data-file"] = lambda path, payload: (200, content)
+    connection = authenticated_client()
+    connection.data["report"] = "intensityReport"
+
+    path, hexdigest = connection.download_datafile(tmp_path / "result.dat", chunk_size=4096, hash_name=hash_name)
+
+    assert path == tmp_path / "result.dat"
+    assert path.read_bytes() == content
+    assert hexdigest == (hashlib.new(hash_name, content).hexdigest() if hash_name else None)
+    assert fake_sirepo.requests[-1][1] == "/download-data-file/srw/00000000/intensityReport/-1"
+    assert not (tmp_path / "result.dat.part").exists()
+
+
+def test_download_datafile_failure(fake_sirepo, tmp_path, authenticated_client):
+    fake_sirepo.routes["download-data-file"] = lambda path, payload: (404, b"")
+    connection = authenticated_client()
+    connection.data["report"] = "intensityReport"
+
+    with pytest.raises(SirepoBlueskyClientException, match="status: 404"):
+        connection.download_datafile(tmp_path / "result.dat")
+    assert not list(tmp_path.iterdir())
+
+
+def test_async_download_datafile(fake_sirepo, tmp_path, fake_auth):
+    content = os.urandom(1_000_000)
+    fake_sirepo.routes["download-data-file"] = lambda path, payload: (200, content)
+
+    async def download():
+        async with AsyncSirepoBluesky(fake_sirepo.url) as connection:
+            await connection.auth("srw", "00000000")
+            connection.data["report"] = "intensityReport"
+            return await connection.download_datafile(tmp_path / "result.dat", chunk_size=4096, hash_name="md5")
+
+    path, hexdigest = asyncio.run(download())
+    assert path.read_bytes() == content
+    assert hexdigest == hashlib.md5(content).hexdigest()
+
+
+def _wait_for_reports(connection, num_reports, timeout=10):
+    start_time = time.monotonic()
+    while len(connection.active_reports) < num_reports:
+        assert time.monotonic() - start_time < timeout
+        time.sleep(0.01)
+
+
+def test_cancel_simulations(fake_sirepo, simulation_routes, authenticated_client):
+    calls = simulation_routes(status_calls=1000)
+    fake_sirepo.routes["run-cancel"] = lambda path, payload: (200, {"state": "canceled"})
+    connection = authenticated_client()
+    poller = SimulationPoller()
+
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        connection.data["report"] = "intensityReport"
+        run_future = executor.submit(connection.snapshot().run_simulation)
+        connection.data["report"] = "watchpointReport2"
+        poller_future = poller.submit(connection)
+        _wait_for_reports(connection, 2)
+
+        assert connection.cancel_simulations(report="intensityReport") == ["intensityReport"]
+        with pytest.raises(SirepoBlueskyClientException, match="intensityReport was cancelled"):
+            run_future.result(timeout=1)
+        assert not poller_future.done()
+
+        assert connection.cancel_simulations() == ["watchpointReport2"]
+        with pytest.raises(SirepoBlueskyClientException, match="watchpointReport2 was cancelled"):
+            poller_future.result(timeout=1)
+    poller.shutdown()
+
+    cancels = [payload for _, path, payload in fake_sirepo.requests if path == "/run-cancel"]
+    assert [payload["report"] for payload in cancels] == ["intensityReport", "watchpointReport2"]
+    assert all(count < 1000 for count in calls.values())
+    assert connection.active_reports == []
+    assert connection.cancel_simulations() == []
+
+
+def test_cancel_simulations_timeout(fake_sirepo, simulation_routes, authenticated_client):
+    simulation_routes(status_calls=1000)
+
+    def run_cancel(path, payload):
+        time.sleep(2)
+        return 200, {"state": "canceled"}
+
+    fake_sirepo.routes["run-cancel"] = run_cancel
+    connection = authenticated_client(cancel_timeout=0.2)
+    connection.data["report"] = "intensityReport"
+
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        run_future = executor.submit(connection.run_simulation)
+        _wait_for_reports(connection, 1)
+        start_time = time.monotonic()
+        # The server does not respond in time, the cancellation is given up on:
+        assert connection.cancel_simulations() == ["intensityReport"]
+        assert time.monotonic() - start_time < 1
+        with pytest.raises(SirepoBlueskyClientException, match="was cancelled"):
+            run_future.result(timeout=1)
+
+
+def test_async_cancel_simulations(fake_sirepo, simulation_routes):
+    simulation_routes(status_calls=1000)
+    fake_sirepo.routes["run-cancel"] = lambda path, payload: (200, {"state": "canceled"})
+
+    async def run():
+        async with AsyncSirepoBluesky(fake_sirepo.url) as connection:
+            await connection.auth("srw", "00000000")
+            connection.data["report"] = "intensityReport"
+            task = asyncio.create_task(connection.run_simulation())
+            while not connection.active_reports:
+                await asyncio.sleep(0.01)
+            assert await connection.cancel_simulations() == ["intensityReport"]
+            assert task.cancelled()
+            assert connection.active_reports == []
+
+    asyncio.run(run())
+    cancels = [payload for _, path, payload in fake_sirepo.requests if path == "/run-cancel"]
+    assert [payload["report"] for payload in cancels] == ["intensityReport"]
+
+
+@pytest.mark.parametrize("to_file", [False, True])
+def test_run_and_download_timings(fake_sirepo, tmp_path, to_file, simulation_routes, authenticated_client):
+    simulation_routes()
+    # The run-simulation response is "pending":
+    states = iter(["pending", "running", "running", "completed"])
+    content = os.urandom(100_000)
+
+    def run_status(path, payload):
+        state = next(states)
+        return 200, {"state": state, "nextRequestSeconds": 0.05, "nextRequest": payload}
+
+    fake_sirepo.routes["run-status"] = run_status
+    fake_sirepo.routes["download-data-file"] = lambda path, payload: (200, content)
+    connection = authenticated_client()
+    connection.data["report"] = "intensityReport"
+
+    result = connection.run_and_download(tmp_path / "result.dat" if to_file else None)
+
+    timings = result.timings
+    assert timings == connection.last_timings
+    assert set(timings) == set(TIMING_PHASES + TIMING_COUNTS)
+    assert timings["status_calls"] == 4
+    # The time between two responses is counted in the phase of the first one:
+    assert timings["queue"] >= 2 * 0.05
+    assert timings["compute"] >= 0.05
+    assert timings["poll_slack"] >= 0.05
+    assert timings["upload"] > 0 and timings["download"] > 0
+    assert (timings["write"] > 0) == to_file
+    assert timings["upload_bytes"] == len(json.dumps(connection.data))
+    assert timings["download_bytes"] == len(content)
+    assert sum(timings[phase] for phase in ("upload", "queue", "compute", "poll_slack")) <= result.duration
@@ -0,0 +1,105 @@
+import asyncio
+import os
+
+import bluesky.plans as bp
+import numpy as np
+import pytest
+from bluesky.run_engine import call_in_bluesky_event_loop
+
+from sirepo_bluesky.async_sirepo_bluesky import AsyncSirepoBluesky
+from sirepo_bluesky.srw_handler import SRWFileHandler
+
+pytest.importorskip("ophyd_async")
+
+from sirepo_bluesky.sirepo_ophyd_async import SirepoPropagation, SirepoWatchpoint, create_classes  # noqa: E402
+
+
+def test_ophyd_async_devices(fake_sirepo, tmp_path, simulation_routes, fake_crystal_simulation, srw_datafile):
+    simulation_routes(status_calls=3)
+    watchpoints = [{"id": i, "title": f"W{i}", "type": "watch", "position": 10 * i} for i in (2, 3)]
+    # Register the routes of the simulation:
+    fake_crystal_simulation(extra_elements=watchpoints)
+    fake_sirepo.routes["download-data-file"] = lambda path, payload: (200, srw_datafile(np.ones((3, 4))))
+
+    async def run():
+        async with AsyncSirepoBluesky(fake_sirepo.url) as connection:
+            await connection.auth("srw", "00000000")
+            classes, objects = create_classes(connection, create_objects=False)
+            assert set(classes) == {"mono_crystal", "w2", "w3", "propagation_parameters"}
+            assert issubclass(classes["w2"], SirepoWatchpoint)
+            assert classes["propagation_parameters"] is SirepoPropagation
+            assert not objects
+
+            _, objects = create_classes(connection)
+            crystal = objects["mono_crystal"]
+            w2, w3 = (classes[name](name=name, root_dir=str(tmp_path)) for name in ("w2", "w3"))
+            assert crystal.h.name == "mono_crystal_h"
+            assert objects["mono_crystal_propagation"].hrange_mod.name == ("mono_crystal_propagation_hrange_mod")
+
+            # Setting the signals modifies the data and computes the crystal orientation:
+            await crystal.h.set(2)
+            assert connection.data["models"]["beamline"][0]["h"] == 2
+            assert await crystal.dSpacing.get_value() == 112
+            assert connection.compute_counts["mono_crystal"] == 1
+            await objects["post_propagation"].vres_mod.set(2)
+            assert connection.data["models"]["postPropagation"][8] == 2
+
+            # The triggers run the simulations with the data at the time of the triggers:
+            statuses = [w2.trigger(), w3.trigger()]
+            await crystal.h.set(3)
+            await asyncio.gather(*statuses)
+            await w2.unstage()
+            return crystal, w2, w3, await w2.read(), await w2.describe(), await crystal.read()
+
+    crystal, w2, w3, reading, description, crystal_reading = asyncio.run(run())
+
+    assert reading["w2_flux"]["value"] == 12
+    assert description["w2_image"]["external"] == "FILESTORE:"
+    # The datafile is a resource, written once the device is unstaged:
+    (resource_name, resource), (datum_name, datum) = w2.collect_asset_docs()
+    assert (resource_name, datum_name) == ("resource", "datum")
+    assert not list(w2.collect_asset_docs())
+    assert resource["spec"] == "srw" and resource["root"] == str(tmp_path)
+    assert datum["resource"] == resource["uid"] and reading["w2_image"]["value"] == datum["datum_id"]
+    path = os.path.join(resource["root"], resource["resource_path"])
+    with open(path, "rb") as f:
+        assert f.read() == srw_datafile(np.ones((3, 4)))
+    np.testing.assert_array_equal(SRWFileHandler(path, **resource["resource_kwargs"])(), np.ones((3, 4)))
+    assert crystal_reading["mono_crystal_h"]["value"] == 3
+    assert w2.hints == {"fields": ["w2_flux"]}
+    runs = [payload for _, path, payload in fake_sirepo.requests if path == "/run-simulation"]
+    assert sorted(run["report"] for run in runs) == ["watchpointReport2", "watchpointReport3"]
+    assert [run["models"]["beamline"][0]["h"] for run in runs] == [2, 2]
+    # Both simulations ran at the same time:
+    paths = [path.split("/")[1] for _, path, _ in fake_sirepo.requests]
+    assert paths.index("download-data-file") > max(i for i, path in enumerate(paths) if path == "run-simulation")
+
+
+def test_ophyd_async_watchpoint_assets_in_run(
+    fake_sirepo, tmp_path, simulation_routes, fake_crystal_simulation, srw_datafile, RE, documents
+):
+    simulation_routes(status_calls=1)
+    fake_crystal_simulation(extra_elements=[{"id": 2, "title": "W2", "type": "watch", "position": 20}])
+    fake_sirepo.routes["download-data-file"] = lambda path, payload: (200, srw_datafile(np.ones((3, 4))))
+
+    async def connect():
+        connection = AsyncSirepoBluesky(fake_sirepo.url)
+        await connection.auth("srw", "00000000")
+        return connection
+
+    connection = call_in_bluesky_event_loop(connect())
+    classes, _ = create_classes(connection, create_objects=False)
+    w2 = classes["w2"](name="w2", root_dir=str(tmp_path))
+    RE(bp.count([w2], num=2))
+    call_in_bluesky_event_loop(connection.aclose())
+
+    resources = [doc for name, doc in documents if name == "resource"]
+    datums = [doc for name, doc in documents if name == "datum"]
+    events = [doc for name, doc in documents if name == "event"]
+    assert len(resources) == len(datums) == 2
+    assert [event["data"]["w2_image"] for event in events] == [datum["datum_id"] for datum in datums]
+    (start,) = [doc for name, doc in documents if name == "start"]
+    for resource in resources:
+        assert resource["run_start"] == start["uid"]
+        path = os.path.join(resource["root"], resource["resource_path"])
+        np.testing.assert_array_equal(SRWFileHandler(path, **resource["resource_kwargs"])(), np.ones((3, 4)))
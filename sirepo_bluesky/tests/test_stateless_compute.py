@@ -6,10 +6,11 @@ import bluesky.plan_stubs as bps
 import bluesky.plans as bp
 import dictdiffer
 import numpy as np
+import pytest
 import vcr
 
 import sirepo_bluesky.tests
-from sirepo_bluesky.sirepo_ophyd import create_classes
+from sirepo_bluesky.sirepo_ophyd import SirepoSignalCompute, create_classes
 from sirepo_bluesky.utils.json_yaml_converter import dict_to_file
 
 cassette_location = os.path.join(os.path.dirname(sirepo_bluesky.tests.__file__), "vcr_cassettes")
@@ -250,6 +251,62 @@ def test_stateless_compute_with_RE(RE, srw_chx_simulation, db):
         assert tbl_radius == radius, "Radius was not properly changed in the Run Engine."
 
 
+def test_compute_signals_define_their_computation():
+    with pytest.raises(TypeError, match="must define"):
+
+        class SirepoSignalNoCompute(SirepoSignalCompute):
+            computed_params = ("focalDistance",)
+
+    with pytest.raises(TypeError, match="has no method"):
+
+        class SirepoSignalUnknownCompute(SirepoSignalCompute):
+            computed_params = ("focalDistance",)
+            compute_method = "compute_focal_distance"
+
+    with pytest.raises(TypeError, match="abstract"):
+        SirepoSignalCompute(sirepo_dict={}, sirepo_param="h", name="h")
+
+
+def test_stateless_compute_deferred(fake_sirepo, fake_crystal_simulation):
+    connection, objects = fake_crystal_simulation()
+    crystal = objects["mono_crystal"]
+
+    with connection.deferred_compute():
+        crystal.h.set(2)
+        crystal.k.set(2)
+        crystal.l.set(0)
+        assert connection.compute_counts["mono_crystal"] == 0
+    # crystal_init and crystal_orientation requests, once:
+    assert len(fake_sirepo.requests) == 1 + 2
+    assert connection.compute_counts["mono_crystal"] == 1
+    assert crystal.dSpacing.get() == 22
+
+    # Reading the element computes the pending parameters:
+    connection.defer_compute = True
+    crystal.h.set(4)
+    crystal.l.set(1)
+    assert crystal.dSpacing.get() == 124
+    assert connection.compute_counts["mono_crystal"] == 2
+    assert crystal.dSpacing.get() == 124
+    assert connection.compute_counts["mono_crystal"] == 2
+
+
+@pytest.mark.parametrize("defer_compute, num_computes", [(False, 6), (True, 4)])
+def test_stateless_compute_deferred_grid_scan(defer_compute, num_computes, fake_crystal_simulation, RE):
+    connection, objects = fake_crystal_simulation(defer_compute=defer_compute)
+    crystal = objects["mono_crystal"]
+    dspacings = []
+    RE.subscribe(
+        lambda name, doc: dspacings.append(doc["data"]["mono_crystal_dSpacing"]) if name == "event" else None
+    )
+
+    RE(bp.grid_scan([crystal], crystal.h, 1, 2, 2, crystal.k, 1, 2, 2))
+
+    # One computation per step with the deferred computations:
+    assert connection.compute_counts["mono_crystal"] == num_computes
+    assert dspacings == [111, 121, 112, 122]
+
+
 def _remove_dict_strings(dict):
     newarr = []
     for key in dict:
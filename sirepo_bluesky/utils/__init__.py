@@ -1,30 +1,158 @@
+import os
+from pathlib import Path
+
 import numpy as np
 
 sigma_to_fwhm = 2 * np.sqrt(2 * np.log(2))
 
 
-def get_beam_stats(image, x_extent, y_extent):
-    n_y, n_x = image.shape
-    image_sum = image.sum()
+def get_beam_stats(image, x_extent, y_extent, percentiles=(10, 50, 90)):
+    """Compute the statistics of the beam from its 2D intensity map.
 
-    if image.sum() > 0:
-        X, Y = np.meshgrid(np.linspace(*x_extent, n_x), np.linspace(*y_extent, n_y))
+    The moments are computed from the horizontal and vertical marginals of
+    the image (its sums over the rows and the columns), accumulated in
+    float64 for any dtype of the image, so the extra memory is O(nx + ny).
 
-        mean_x = np.sum(X * image) / image_sum
-        mean_y = np.sum(Y * image) / image_sum
+    Parameters
+    ----------
+    image : numpy.ndarray
+        The intensity, of shape (ny, nx).
+    x_extent, y_extent : sequence
+        The positions of the first and last columns (rows) of the image.
+    percentiles : sequence of float, optional
+        The percentiles of the marginals to compute, in [0, 100].
 
-        sigma_x = np.sqrt(np.sum((X - mean_x) ** 2 * image) / image_sum)
-        sigma_y = np.sqrt(np.sum((Y - mean_y) ** 2 * image) / image_sum)
+    Returns
+    -------
+    dict
+        The "shape", "flux" and "mean" of the image, the centroid ("x", "y"),
+        the FWHM of the equivalent Gaussian ("fwhm_x", "fwhm_y"), the
+        position and value of the maximum pixel ("peak_x", "peak_y", "peak"),
+        the skewness ("skewness_x", "skewness_y") and the positions of the
+        ``percentiles`` of the cumulative marginals ("percentiles_x",
+        "percentiles_y"). The statistics of the beam are NaN if the flux is
+        not positive.
+    """
+    n_y, n_x = image.shape
+    x = np.linspace(*x_extent, n_x)
+    y = np.linspace(*y_extent, n_y)
+    marginal_x = image.sum(axis=0, dtype=np.float64)
+    marginal_y = image.sum(axis=1, dtype=np.float64)
+    image_sum = marginal_x.sum()
 
+    ret = {"shape": (n_y, n_x), "flux": image_sum, "mean": image_sum / image.size if image.size else np.nan}
+    if image_sum > 0:
+        peak_y, peak_x = np.unravel_index(np.argmax(image), image.shape)
+        ret.update({"peak_x": x[peak_x], "peak_y": y[peak_y], "peak": image[peak_y, peak_x]})
     else:
-        mean_x, mean_y, sigma_x, sigma_y = np.nan, np.nan, np.nan, np.nan
+        ret.update({"peak_x": np.nan, "peak_y": np.nan, "peak": np.nan})
+    for axis, positions, marginal in (("x", x, marginal_x), ("y", y, marginal_y)):
+        ret.update(_marginal_stats(axis, positions, marginal, image_sum, percentiles))
+    return ret
 
+
+def _marginal_stats(axis, positions, marginal, total, percentiles):
+    """The centroid, FWHM, skewness and percentiles of a marginal of the beam, see ``get_beam_stats()``."""
+    if not total > 0:
+        return {
+            axis: np.nan,
+            f"fwhm_{axis}": np.nan,
+            f"skewness_{axis}": np.nan,
+            f"percentiles_{axis}": np.full(len(percentiles), np.nan),
+        }
+    mean = np.dot(positions, marginal) / total
+    deviations = positions - mean
+    variance = np.dot(deviations**2, marginal) / total
+    sigma = np.sqrt(variance)
+    skewness = np.dot(deviations**3, marginal) / total / sigma**3 if sigma > 0 else np.nan
+    # The first position where the cumulative marginal reaches each percentile:
+    cumulative = np.cumsum(marginal) / total
+    indices = np.searchsorted(cumulative, np.asarray(percentiles, dtype=np.float64) / 100)
     return {
-        "shape": (n_y, n_x),
-        "flux": image_sum,
-        "mean": image.mean(),
-        "x": mean_x,
-        "y": mean_y,
-        "fwhm_x": sigma_to_fwhm * sigma_x,
-        "fwhm_y": sigma_to_fwhm * sigma_y,
+        axis: mean,
+        f"fwhm_{axis}": sigma_to_fwhm * sigma,
+        f"skewness_{axis}": skewness,
+        f"percentiles_{axis}": positions[np.minimum(indices, len(positions) - 1)],
     }
+
+
+def get_roi_stats(image, x_extent, y_extent, rois):
+    """Compute the flux, centroid and FWHM of the beam in rectangular regions of interest of its image.
+
+    The statistics of all the ROIs are computed at once from the cumulative
+    sums of the image along its columns and rows: the marginals of each ROI
+    are differences of two rows (columns) of these tables, so each ROI costs
+    O(nx + ny) whatever its size.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        The intensity, of shape (ny, nx).
+    x_extent, y_extent : sequence
+        The positions of the first and last columns (rows) of the image.
+    rois : sequence
+        The ROIs, as ``(x_min, x_max, y_min, y_max)`` in the units of the
+        extents. The pixels whose positions are within these bounds are in
+        the ROI.
+
+    Returns
+    -------
+    dict
+        The "flux", "x", "y", "fwhm_x" and "fwhm_y" of the ROIs, as arrays
+        with one value per ROI. The centroid and FWHM of the ROIs without a
+        positive flux are NaN.
+    """
+    n_y, n_x = image.shape
+    x = np.linspace(*x_extent, n_x)
+    y = np.linspace(*y_extent, n_y)
+    rois = np.asarray(rois, dtype=np.float64).reshape((-1, 4))
+    in_x = (x >= rois[:, [0]]) & (x <= rois[:, [1]])
+    in_y = (y >= rois[:, [2]]) & (y <= rois[:, [3]])
+    # The positions are monotonic, so the pixels of each ROI are the rows
+    # [first_row, last_row) and the columns [first_column, last_column):
+    first_row, first_column = in_y.argmax(axis=1), in_x.argmax(axis=1)
+    last_row, last_column = first_row + in_y.sum(axis=1), first_column + in_x.sum(axis=1)
+
+    column_sums = np.zeros((n_y + 1, n_x))
+    np.cumsum(image, axis=0, dtype=np.float64, out=column_sums[1:])
+    row_sums = np.zeros((n_y, n_x + 1))
+    np.cumsum(image, axis=1, dtype=np.float64, out=row_sums[:, 1:])
+    marginal_x = (column_sums[last_row] - column_sums[first_row]) * in_x
+    marginal_y = (row_sums[:, last_column] - row_sums[:, first_column]).T * in_y
+    flux = marginal_x.sum(axis=1)
+
+    ret = {"flux": flux}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        total = np.where(flux > 0, flux, np.nan)
+        for axis, positions, marginal in (("x", x, marginal_x), ("y", y, marginal_y)):
+            mean = marginal @ positions / total
+            variance = np.sum((positions - mean[:, np.newaxis]) ** 2 * marginal, axis=1) / total
+            ret[axis] = mean
+            ret[f"fwhm_{axis}"] = sigma_to_fwhm * np.sqrt(variance)
+    return ret
+
+
+def sidecar_path(filename):
+    """The path of the ``.npy`` sidecar of a datafile, with the data read from the datafile."""
+    return f"{filename}.npy"
+
+
+def write_sidecar(filename, data):
+    """Write the data read from a datafile to its ``.npy`` sidecar, creating its directory if needed.
+
+    The sidecar may be written before the datafile (see ``sirepo_ophyd.write_datafile()``).
+    """
+    path = sidecar_path(filename)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    part_path = f"{path}.part"
+    with open(part_path, "wb") as f:
+        np.save(f, np.ascontiguousarray(data))
+    os.replace(part_path, path)
+
+
+def load_sidecar(filename):
+    """Memory-map the ``.npy`` sidecar of a datafile (read-only), returns None if there is no sidecar."""
+    path = sidecar_path(filename)
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode="r")
@@ -71,6 +71,8 @@ if __name__ == "__main__":
     ret = re_env(**kwargs_re)
     globals().update(**ret)
 
+    from sirepo_bluesky.hdf5_handler import SirepoHDF5Handler
+    from sirepo_bluesky.json_handler import SirepoDataJSONHandler
     from sirepo_bluesky.srw_handler import SRWFileHandler
 
     if args.env_type == "stepper":
@@ -88,4 +90,6 @@ if __name__ == "__main__":
             f"Unknown environment type: {args.env_type}.\nAvailable environment types: {env_choices}"
         )
 
+    handlers["SIREPO_DATA_JSON"] = SirepoDataJSONHandler
+    handlers["SIREPO_HDF5"] = SirepoHDF5Handler
     register_handlers(db, handlers)  # noqa: F821